@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Change detection: cost of diffing a crawl against the snapshot of the previous one, per listing
+and at the end of the crawl (delistings and the new snapshot), with memory held by the detector.
+The current crawl keeps 97% of the listings, 2% of them with a new price, and adds 3% new ones.
+
+    python benchmarks/bench_changes.py [listings ...]
+"""
+import hashlib
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from car_finder.changes import ChangeDetector, Snapshot  # noqa: E402
+
+
+def fingerprint(i):
+    return hashlib.sha1(f'https://www.drive2.com/cars/{i}/'.encode()).digest()
+
+
+def crawl(n, rng):
+    """
+    :return: (fingerprint hex digest, price) of the listings of the current crawl, in crawl order
+    """
+    listings = []
+    for i in range(n):
+        if rng.random() < 0.03:
+            continue
+        price = 500000 + i % 3000 * 1000
+        if rng.random() < 0.02:
+            price += 10000
+        listings.append((fingerprint(i).hex(), price))
+    listings.extend((fingerprint(n + i).hex(), 700000) for i in range(n * 3 // 100))
+    rng.shuffle(listings)
+    return listings
+
+
+def main(*sizes):
+    rng = random.Random(0)
+    for n in sizes or (100000, 1000000, 3000000):
+        with tempfile.TemporaryDirectory() as workdir:
+            path = os.path.join(workdir, 'snapshot.bin')
+            start = time.perf_counter()
+            Snapshot.write(path, sorted((fingerprint(i), 500000 + i % 3000 * 1000) for i in range(n)))
+            written = time.perf_counter() - start
+            listings = crawl(n, rng)
+
+            detector = ChangeDetector(path)
+            start = time.perf_counter()
+            detector.open()
+            opened = time.perf_counter() - start
+            changes = {}
+            start = time.perf_counter()
+            for key, price in listings:
+                change = detector.observe(key, price)
+                if change is not None:
+                    changes[change['change']] = changes.get(change['change'], 0) + 1
+            observed = time.perf_counter() - start
+            memory = detector.prices.itemsize * len(detector.prices) + detector.snapshot.starts.itemsize * len(
+                detector.snapshot.starts) + sys.getsizeof(detector.new) + sum(map(sys.getsizeof, detector.new))
+            start = time.perf_counter()
+            changes['delisted'] = sum(1 for _ in detector.delisted())
+            detector.close()
+            closed = time.perf_counter() - start
+
+            print(f'{n:>9} listings: snapshot {os.path.getsize(path) / 2 ** 20:6.1f} MiB written in {written:5.2f}s, '
+                  f'open {opened:5.2f}s, {observed / len(listings) * 1e6:5.2f} us/listing, close {closed:5.2f}s, '
+                  f'detector {memory / 2 ** 20:6.1f} MiB, {changes}')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent dupefilter lookup cost and memory: in-memory set vs Bloom filter store.
+
+    python benchmarks/bench_dupefilter.py [fingerprints]
+"""
+import hashlib
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from car_finder.dupefilters import BloomStore  # noqa: E402
+
+
+def fingerprints(n, salt=''):
+    return [hashlib.sha1(f'{salt}{i}'.encode()).hexdigest() for i in range(n)]
+
+
+def bench_set(seen, unseen):
+    tracemalloc.start()
+    store = set()
+    for fp in seen:
+        store.add(fp)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    start = time.perf_counter()
+    hits = sum(fp in store for fp in unseen)
+    return memory, (time.perf_counter() - start) / len(unseen), hits
+
+
+def bench_bloom(seen, unseen, error_rate):
+    with tempfile.TemporaryDirectory() as path:
+        store = BloomStore(path, len(seen), error_rate, ttl=3600, generations=4)
+        store.open()
+        for fp in seen:
+            store.seen(fp)
+        memory = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+        start = time.perf_counter()
+        hits = sum(fp in store for fp in unseen)
+        elapsed = time.perf_counter() - start
+        store.close()
+    return memory, elapsed / len(unseen), hits
+
+
+def main(n=1000000):
+    seen = fingerprints(n)
+    unseen = fingerprints(min(n, 200000), salt='unseen')
+    memory, lookup, hits = bench_set(seen, unseen)
+    print(f'{"set":>12}: {memory / 2 ** 20:8.1f} MiB, {lookup * 1e6:6.2f} us/lookup, false positives: {hits}')
+    for error_rate in (0.01, 0.001):
+        memory, lookup, hits = bench_bloom(seen, unseen, error_rate)
+        print(f'bloom {error_rate:<6}: {memory / 2 ** 20:8.1f} MiB, {lookup * 1e6:6.2f} us/lookup, '
+              f'false positives: {hits / len(unseen):.4%}')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
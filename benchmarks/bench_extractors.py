@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Detail page extraction micro-benchmark.
+
+Compares the single-pass `extract_car_sale_info` with the former per-field
+`response.xpath` queries over the saved pages in benchmarks/fixtures.
+Runs in a single process, so the numbers are docs/sec per core.
+
+    python benchmarks/bench_extractors.py [rounds]
+"""
+import glob
+import os
+import sys
+import timeit
+
+from scrapy.http import HtmlResponse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from car_finder.extractors import extract_car_sale_info  # noqa: E402
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'sale_*.html')
+
+
+def per_field_xpath(body):
+    response = HtmlResponse('https://www.drive2.com/cars/', body=body, encoding='utf-8')
+    years_pattern = "//div[@class='c-car-forsale']/ul/li[contains(text(), 'Manufactured') or contains(text(), 'Purchased')]"
+    return dict(
+        manufactured=response.xpath(years_pattern).extract_first(),
+        purchased=response.xpath(years_pattern).extract_first(),
+        brand=response.xpath('//a[@data-ym-target="car2brand"]/text()').extract_first(),
+        model=response.xpath('//a[@data-ym-target="car2model"]/text()').extract_first(),
+        generation=response.xpath('//a[@data-ym-target="car2gen"]/text()').extract_first(),
+        mileage=response.xpath("//div[@class='c-car-forsale']/ul/li[contains(text(), 'Mileage')]").extract_first(),
+        engine=response.xpath("//div[@class='c-car-forsale']/ul/li[contains(text(), 'Engine')]").extract_first(),
+        gearbox=response.xpath("//div[@class='c-car-forsale']/ul/li[contains(text(), 'Manual') or contains(text(), 'Automatic')]").extract_first(),
+    )
+
+
+def single_pass(body):
+    return extract_car_sale_info(body.decode('utf-8'))
+
+
+def main(rounds=200):
+    pages = []
+    for path in sorted(glob.glob(FIXTURES)):
+        with open(path, 'rb') as f:
+            pages.append(f.read())
+    for func in (per_field_xpath, single_pass):
+        elapsed = timeit.timeit(lambda: [func(body) for body in pages], number=rounds)
+        print(f'{func.__name__:>16}: {rounds * len(pages) / elapsed:8.1f} docs/sec')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+HTTP cache storages: store and retrieve time and disk usage of detail pages,
+scrapy FilesystemCacheStorage and DbmCacheStorage vs LogCacheStorage.
+
+    python benchmarks/bench_httpcache.py [responses]
+"""
+import glob
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from scrapy import Request, Spider  # noqa: E402
+from scrapy.extensions.httpcache import DbmCacheStorage, FilesystemCacheStorage  # noqa: E402
+from scrapy.http import HtmlResponse  # noqa: E402
+from scrapy.settings import Settings  # noqa: E402
+from scrapy.utils.test import get_crawler  # noqa: E402
+
+from car_finder.httpcache import LogCacheStorage  # noqa: E402
+
+FIXTURES = os.path.join(ROOT, 'benchmarks', 'fixtures', 'sale_*.html')
+
+
+def disk_usage(path):
+    files = [os.path.join(root, name) for root, _, names in os.walk(path) for name in names]
+    return sum(os.path.getsize(name) for name in files), len(files)
+
+
+def bench(storage_cls, spider, pairs):
+    with tempfile.TemporaryDirectory() as path:
+        storage = storage_cls(Settings({'HTTPCACHE_DIR': path}))
+        storage.open_spider(spider)
+        start = time.perf_counter()
+        for request, response in pairs:
+            storage.store_response(spider, request, response)
+        store = time.perf_counter() - start
+        storage.close_spider(spider)
+
+        start = time.perf_counter()
+        storage = storage_cls(Settings({'HTTPCACHE_DIR': path}))
+        storage.open_spider(spider)
+        opened = time.perf_counter() - start
+        start = time.perf_counter()
+        for request, response in pairs:
+            assert storage.retrieve_response(spider, request).body == response.body
+        retrieve = time.perf_counter() - start
+        storage.close_spider(spider)
+        size, files = disk_usage(path)
+    return store / len(pairs), opened, retrieve / len(pairs), size, files
+
+
+def main(n=20000):
+    crawler = get_crawler(Spider)
+    spider = Spider('bench')
+    spider.crawler = crawler
+    bodies = [open(name, 'rb').read() for name in sorted(glob.glob(FIXTURES))]
+    pairs = []
+    for i in range(n):
+        url = f'https://www.drive2.com/cars/bench/{i}/'
+        pairs.append((Request(url), HtmlResponse(url, body=bodies[i % len(bodies)], headers={
+            'Content-Type': 'text/html; charset=utf-8'})))
+    for storage_cls in (FilesystemCacheStorage, DbmCacheStorage, LogCacheStorage):
+        store, opened, retrieve, size, files = bench(storage_cls, spider, pairs)
+        print(f'{storage_cls.__name__:>22}: store {store * 1e6:7.1f} us, open {opened * 1e3:7.1f} ms, '
+              f'retrieve {retrieve * 1e6:7.1f} us, {size / 2 ** 20:7.1f} MiB in {files} files')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Listing page parsing micro-benchmark.
+
+Compares `parse_listing_page` (one walk per card over a plain lxml tree) with the former
+`lxml.html` document and five per-card `xpath` helpers over the saved carsearch.cshtml
+responses in benchmarks/fixtures. Runs in a single process, so the numbers are pages/sec per core.
+
+    python benchmarks/bench_listing_parser.py [rounds]
+"""
+import glob
+import json
+import logging
+import os
+import sys
+import timeit
+
+from lxml import html
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from car_finder.extractors import base_url, parse_listing_page  # noqa: E402
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'carsearch_*.json')
+
+logger = logging.getLogger(__name__)
+
+
+def first(el, path):
+    try:
+        return el.xpath(path)[0]
+    except IndexError:
+        logger.debug(f'Can not parse {path} from elem: {el}')
+
+
+def per_card_xpath(body):
+    d = json.loads(body.strip())
+    cards = []
+    for el in html.fromstring(d['html']).xpath('//body/div/div[contains(@class, "c-car-card-sa")]'):
+        title = first(el, 'div//span[@class="c-car-title  c-link"]')
+        if title is None or not title.text:
+            continue
+        price, url = first(el, 'div//span[@class="c-car-card-sa__price"]'), first(el, 'a[@class="u-link-area"]')
+        img, geo = first(el, 'div/div/img'), first(el, 'div/div[@class="c-car-card-sa__location"]/span')
+        cards.append(dict(price=price.text if price is not None else None, title=title.text,
+                          url=base_url.format(url.attrib['href']) if url is not None else None,
+                          image_url=img.attrib['src'] if img is not None else None,
+                          geo=geo.text if geo is not None else None))
+    return d.get('start', None), cards
+
+
+def single_walk(body):
+    return parse_listing_page(body)
+
+
+def main(rounds=500):
+    logging.basicConfig(level=logging.INFO)
+    pages = []
+    for path in sorted(glob.glob(FIXTURES)):
+        with open(path, 'rb') as f:
+            pages.append(f.read())
+    for body in pages:
+        assert per_card_xpath(body) == single_walk(body)
+    for func in (per_card_xpath, single_walk):
+        elapsed = timeit.timeit(lambda: [func(body) for body in pages], number=rounds)
+        print(f'{func.__name__:>16}: {rounds * len(pages) / elapsed:8.1f} pages/sec')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
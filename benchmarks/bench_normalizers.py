@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Field normalizers benchmark: car_finder.normalizers vs the former per-call
+re.template/character loop implementations.
+
+    python benchmarks/bench_normalizers.py [values]
+"""
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from car_finder import normalizers  # noqa: E402
+
+RUB_IN_USD = 75
+# re.template is gone in Python 3.12+, per-call compile keeps the old cost profile
+compile_template = getattr(re, 'template', re.compile)
+
+PRICES = ['1 250 000 ₽', '$12 500', '980 000 ₽', '2 300 000 ₽']
+YEARS = ['Manufactured in 2013, purchased in 2015', 'Manufactured in 2008', 'Purchased in 2019']
+
+
+def legacy_extract_price(value):
+    if '$' in value:
+        return int(''.join([char for char in value if char.isdigit()])) * RUB_IN_USD
+    elif '₽' in value:
+        return int(''.join([char for char in value if char.isdigit()]))
+
+
+def legacy_extract_manufactured(value):
+    try:
+        return int(compile_template(r'manufactured in (\d\d\d\d)', flags=re.IGNORECASE).findall(value)[0])
+    except IndexError:
+        pass
+
+
+def legacy_extract_purchased(value):
+    try:
+        return int(compile_template(r'purchased in (\d\d\d\d)', flags=re.IGNORECASE).findall(value)[0])
+    except IndexError:
+        pass
+
+
+def report(name, func, values, rounds=5):
+    elapsed = min(timeit.repeat(lambda: func(values), number=1, repeat=rounds))
+    print(f'{name:>28}: {len(values) / elapsed:12.0f} values/sec')
+
+
+def main(n=100000):
+    prices = (PRICES * (n // len(PRICES) + 1))[:n]
+    years = (YEARS * (n // len(YEARS) + 1))[:n]
+    report('legacy price', lambda values: [legacy_extract_price(v) for v in values], prices)
+    report('price', lambda values: [normalizers.extract_price(v) for v in values], prices)
+    report('price batch', lambda values: normalizers.normalize_batch('price', values), prices)
+    report('legacy manufactured', lambda values: [legacy_extract_manufactured(v) for v in values], years)
+    report('manufactured batch', lambda values: normalizers.normalize_batch('manufactured', values), years)
+    report('legacy purchased', lambda values: [legacy_extract_purchased(v) for v in values], years)
+    report('purchased batch', lambda values: normalizers.normalize_batch('purchased', values), years)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar export: ParquetExportPipeline write throughput, size on disk and time to load
+the whole crawl back, against JSON lines of the same items.
+
+    python benchmarks/bench_parquet_export.py [items]
+"""
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pyarrow.parquet as pq  # noqa: E402
+from scrapy.utils.serialize import ScrapyJSONEncoder  # noqa: E402
+from twisted.internet import defer  # noqa: E402
+
+from car_finder.items import CarItem, CarProfile  # noqa: E402
+from car_finder.pipelines import ParquetExportPipeline  # noqa: E402
+
+BRANDS = ('Toyota', 'Volkswagen', 'BMW', 'Kia', 'Hyundai', 'Lada', 'Skoda', 'Mercedes-Benz')
+
+
+def make_items(n):
+    items = []
+    for i in range(n):
+        brand = BRANDS[i % len(BRANDS)]
+        url = f'https://www.drive2.com/cars/{brand.lower()}/{i}/'
+        fingerprint = hashlib.sha1(url.encode()).hexdigest()
+        items.append(CarItem(
+            url_fingerprint=fingerprint, url=url, title=f'{brand} {i % 50}', price=500000 + i % 3000000 // 1000 * 1000,
+            brand=brand, model=f'Model {i % 30}', generation='II', manufactured=2000 + i % 24, purchased=2005 + i % 19,
+            city='Moscow', country='Russia', image_urls=[f'https://a.d-cd.net/{i}.jpg'],
+            profile=CarProfile(mileage=i % 300000, capacity=1.6, horse_power=110 + i % 200, engine_type='gasoline',
+                               transmission='automatic'),
+        ))
+    return items
+
+
+def write_parquet(path, items, row_group_size=10000):
+    pipeline = ParquetExportPipeline(path, row_group_size, row_group_size * 5, 'zstd')
+    pipeline.crawl_date = '2024-01-31'
+    pipeline.file_name = 'bench.parquet'
+
+    def flush(partition):
+        # in the reactor thread pool during a crawl
+        columns = pipeline.buffers.pop(partition)
+        pipeline.buffered -= len(columns['url'])
+        pipeline.write(partition, columns)
+        return defer.succeed(None)
+
+    pipeline.flush = flush
+    for item in items:
+        pipeline.process_item(item, None)
+    for partition in list(pipeline.buffers):
+        flush(partition)
+    pipeline.close_writers()
+
+
+def write_jsonl(path, items):
+    encode = ScrapyJSONEncoder().encode
+    with open(path, 'w') as f:
+        for item in items:
+            f.write(encode(dict(item)) + '\n')
+
+
+def disk_usage(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def main(n=200000):
+    items = make_items(n)
+    with tempfile.TemporaryDirectory() as workdir:
+        parquet_path = os.path.join(workdir, 'parquet')
+        jsonl_path = os.path.join(workdir, 'items.jsonl')
+        for name, write, path, load in (
+                ('parquet', write_parquet, parquet_path, lambda: pq.read_table(parquet_path).num_rows),
+                ('jsonl', write_jsonl, jsonl_path, lambda: sum(1 for line in open(jsonl_path) if json.loads(line)))):
+            start = time.perf_counter()
+            write(path, items)
+            written = time.perf_counter() - start
+            start = time.perf_counter()
+            rows = load()
+            loaded = time.perf_counter() - start
+            print(f'{name:>8}: {n / written:9.0f} items/sec, {disk_usage(path) / 2 ** 20:7.1f} MiB, '
+                  f'{rows} rows loaded in {loaded:.3f}s')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
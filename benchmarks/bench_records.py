@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Item construction benchmark: ItemLoader carried in request meta vs CarRecord.
+
+Reports memory retained per in-flight detail request and items/sec for the
+full card -> request -> detail -> item path.
+
+    python benchmarks/bench_records.py [requests]
+"""
+import os
+import sys
+import time
+import tracemalloc
+
+import scrapy
+from scrapy.loader import ItemLoader
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from car_finder.items import CarItem, CarRecord, Country  # noqa: E402
+from car_finder.pipelines import CarRecordPipeline  # noqa: E402
+
+CARD = dict(price='1 250 000 ₽', title='Toyota Camry', url='https://www.drive2.com/cars/toyota/camry/{}/',
+            image_url='https://a.d-cd.net/{}.jpg', geo='Moscow, Russia')
+INFO = dict(years='Manufactured in 2013, purchased in 2015', mileage='Mileage: 142 000 km',
+            engine='Engine: gasoline 2.5 l, 181 hp', transmission='Automatic gearbox',
+            brand='Toyota', model='Camry', generation='XV50')
+
+
+def make_card(i):
+    return {key: value.format(i) for key, value in CARD.items()}
+
+
+def loader_request(card):
+    country_loader = ItemLoader(item=Country())
+    country_loader.add_value('country', card['geo'])
+    loader = ItemLoader(item=CarItem())
+    loader.add_value('price', card['price'])
+    loader.add_value('title', card['title'])
+    loader.add_value('url', card['url'])
+    loader.add_value('city', card['geo'])
+    loader.add_value('country', card['geo'])
+    loader.add_value('image_urls', card['image_url'])
+    return scrapy.Request(card['url'], meta={'loader': loader, 'download_slot': 'Drive2'})
+
+
+def loader_item(request):
+    loader = request.meta['loader']
+    loader.add_value('url_fingerprint', 'f' * 40)
+    loader.add_value('manufactured', INFO['years'])
+    loader.add_value('purchased', INFO['years'])
+    loader.add_value('brand', INFO['brand'])
+    loader.add_value('model', INFO['model'])
+    loader.add_value('generation', INFO['generation'])
+    return loader.load_item()
+
+
+def record_request(card):
+    return scrapy.Request(card['url'], meta={'card': card, 'download_slot': 'Drive2'})
+
+
+def record_item(request, pipeline=CarRecordPipeline()):
+    return pipeline.process_item(CarRecord.from_card(request.meta['card'], INFO, 'f' * 40), None)
+
+
+def measure(make_request, make_item, n):
+    cards = [make_card(i) for i in range(n)]
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    requests = [make_request(card) for card in cards]
+    per_request = (tracemalloc.get_traced_memory()[0] - before) / n
+    tracemalloc.stop()
+    start = time.perf_counter()
+    for request in requests:
+        make_item(request)
+    items_per_sec = n / (time.perf_counter() - start)
+    return per_request, items_per_sec
+
+
+def main(n=20000):
+    for name, make_request, make_item in (('loader', loader_request, loader_item),
+                                          ('record', record_request, record_item)):
+        per_request, items_per_sec = measure(make_request, make_item, n)
+        print(f'{name:>8}: {per_request:8.0f} bytes/in-flight request, {items_per_sec:8.0f} items/sec')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Redis export throughput: per-item RPUSH (scrapy_redis RedisPipeline) vs BufferedRedisPipeline.
+
+Uses the redis server at REDIS_HOST:REDIS_PORT when given, fakeredis (with lupa
+for the dedupe scripts) otherwise.
+
+    REDIS_HOST=localhost python benchmarks/bench_redis_export.py [items]
+"""
+import os
+import sys
+import time
+
+from scrapy.utils.serialize import ScrapyJSONEncoder
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from car_finder.pipelines import BufferedRedisPipeline  # noqa: E402
+
+KEY = 'bench:items'
+DEDUPE_KEY = 'bench:fingerprints'
+
+
+def get_server():
+    if os.getenv('REDIS_HOST'):
+        import redis
+        return redis.Redis(host=os.getenv('REDIS_HOST'), port=int(os.getenv('REDIS_PORT', 6379)))
+    import fakeredis
+    return fakeredis.FakeRedis()
+
+
+def make_items(n):
+    return [dict(url_fingerprint=f'{i:040x}', url=f'https://www.drive2.com/cars/toyota/camry/{i}/',
+                 title='Toyota Camry', price=1250000 + i, city='Moscow', country='Russia',
+                 image_urls=[f'https://a.d-cd.net/{i}.jpg'], brand='Toyota', model='Camry',
+                 generation='XV50', manufactured=2013, purchased=2015) for i in range(n)]
+
+
+def per_item(server, items):
+    encode = ScrapyJSONEncoder().encode
+    for item in items:
+        server.rpush(KEY, encode(item))
+
+
+def buffered(server, items, export_format, dedupe=False, batch_size=500):
+    pipeline = BufferedRedisPipeline(server, KEY, batch_size, 0, export_format, DEDUPE_KEY if dedupe else None)
+    for i in range(0, len(items), batch_size):
+        pipeline.write(items[i:i + batch_size])
+
+
+def main(n=50000):
+    server = get_server()
+    items = make_items(n)
+    cases = [
+        ('per item rpush', lambda: per_item(server, items)),
+        ('buffered json', lambda: buffered(server, items, 'json')),
+        ('buffered json dedupe', lambda: buffered(server, items, 'json', dedupe=True)),
+        ('buffered json-rows', lambda: buffered(server, items, 'json-rows')),
+        ('buffered msgpack', lambda: buffered(server, items, 'msgpack')),
+    ]
+    for name, run in cases:
+        server.delete(KEY, DEDUPE_KEY)
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        size = sum(len(value) for value in server.lrange(KEY, 0, -1))
+        print(f'{name:>22}: {n / elapsed:10.0f} items/sec, {server.llen(KEY):>6} list entries, {size:>10} bytes')
+    server.delete(KEY, DEDUPE_KEY)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
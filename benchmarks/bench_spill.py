@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Memory of a full crawl with and without spilling pending requests to disk: RSS and pending requests
+sampled over a replayed crawl of a synthetic archive (benchmarks/replay_crawl.py), for each
+SPILL_THRESHOLD. Detail pages pile up when listing pages come faster than they are fetched.
+
+    python benchmarks/bench_spill.py [PAGES CARDS] [--thresholds 0 1000] [-s NAME=VALUE ...]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+# fast replay without politeness delays. Listing pages always go before detail pages (no price band
+# applies, the backlog never lowers page priority), so the backlog grows to the whole catalog: the worst case
+DEFAULT_SETTINGS = ('DOWNLOAD_DELAY=0', 'THROTTLE_ENABLED=0', 'PRIORITY_PRICE_BANDS=1', 'PRIORITY_BRAND_QUOTA=1000000',
+                    'PAGINATION_PAGES_IN_FLIGHT=8', 'LOG_LEVEL=ERROR')
+
+
+def run(archive, synthetic, threshold, settings, port):
+    command = [sys.executable, os.path.join(BENCHMARKS, 'replay_crawl.py'), archive, '--port', str(port),
+               '--sample', '1', '--json', '-s', f'SPILL_THRESHOLD={threshold}']
+    if synthetic:
+        command += ['--synthetic', *map(str, synthetic)]
+    for setting in DEFAULT_SETTINGS + tuple(settings):
+        command += ['-s', setting]
+    output = subprocess.run(command, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('pages', type=int, nargs='?', default=10)
+    parser.add_argument('cards', type=int, nargs='?', default=50)
+    parser.add_argument('--thresholds', type=int, nargs='+', default=[0, 1000])
+    parser.add_argument('--port', type=int, default=8820)
+    parser.add_argument('-s', dest='settings', action='append', default=[], metavar='NAME=VALUE')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        archive = os.path.join(workdir, 'archive.jsonl.gz')
+        synthetic = (args.pages, args.cards)
+        for threshold in args.thresholds:
+            report = run(archive, synthetic, threshold, args.settings, args.port)
+            synthetic = None
+            samples = report['samples']
+            rss = [mb for _, mb, _ in samples]
+            print(f'SPILL_THRESHOLD={threshold}: {report["items"]} items in {report["elapsed"]}s, '
+                  f'peak RSS {report["peak_rss_mb"]} MiB, peak pending {max(pending for _, _, pending in samples)}')
+            step = max(len(samples) // 10, 1)
+            for elapsed, mb, pending in samples[::step] + samples[-1:]:
+                print(f'  {elapsed:7.1f}s {mb:8.1f} MiB {pending:8} pending')
+            print(f'  RSS spread {min(rss)}..{max(rss)} MiB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+End-to-end Drive2Spider run against a local replay server: items/sec, CPU per request,
+peak RSS and time to first item, with the project middlewares and pipelines.
+
+Record an archive from the live site once:
+
+    REPLAY_RECORD_PATH=drive2.jsonl.gz scrapy crawl Drive2
+
+or build a synthetic one from benchmarks/fixtures pages, then replay it:
+
+    python benchmarks/replay_crawl.py drive2.jsonl.gz [--synthetic PAGES CARDS]
+        [--latency 0.2] [--jitter 0.1] [--error-rate 0.05] [-s NAME=VALUE ...] [--sample 1] [--json]
+
+BufferedRedisPipeline is left out unless --redis is given. CPU is the crawler process only,
+parsing offloaded to a process pool (PARSE_OFFLOAD_EXECUTOR='process') is not included.
+"""
+import argparse
+import glob
+import io
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+from multiprocessing import Event, Process
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from car_finder.replay import ReplayArchive, serve  # noqa: E402
+
+FIXTURES = os.path.join(ROOT, 'benchmarks', 'fixtures', 'sale_*.html')
+IMAGES = 10
+# empty pages past the last one, requested when a brand shrank since the totals of PAGINATION_STATS_PATH
+EXTRA_PAGES = 8
+CARD = ('<div class="c-car-card-sa"><a class="u-link-area" href="/cars/{brand}/{i}/"></a>'
+        '<div><div><img src="https://a.d-cd.net/{image}.jpg"></div>'
+        '<div class="c-car-card-sa__location"><span>Moscow</span></div>'
+        '<span class="c-car-card-sa__price">{price} ₽</span>'
+        '<span class="c-car-title  c-link">{brand} {i}</span></div></div>')
+
+
+def image_body(n):
+    from PIL import Image
+    buf = io.BytesIO()
+    Image.new('RGB', (320, 240), (n * 20 % 256, 80, 160)).save(buf, 'JPEG')
+    return buf.getvalue()
+
+
+def build_synthetic_archive(path, pages, cards):
+    from car_finder.brands import DEFAULT_BRANDS
+    from car_finder.spiders.Drive2 import url_template
+    sales = [open(name, 'rb').read() for name in sorted(glob.glob(FIXTURES))]
+    json_headers = {'Content-Type': ['application/json; charset=utf-8']}
+    html_headers = {'Content-Type': ['text/html; charset=utf-8']}
+    archive = ReplayArchive(path)
+    for brand, brand_id in DEFAULT_BRANDS.items():
+        for page in range(pages + EXTRA_PAGES):
+            start = page * cards
+            if page >= pages:
+                body = {'start': None, 'html': '<div></div>'}
+            else:
+                html = ''.join(CARD.format(brand=brand, i=i, image=i % IMAGES, price=1000000 + i)
+                               for i in range(start, start + cards))
+                body = {'start': start + cards, 'html': f'<div>{html}</div>'}
+            archive.write(url_template.format(brand_id=brand_id, start=start), 200, json_headers,
+                          json.dumps(body).encode())
+        for i in range(pages * cards):
+            archive.write(f'https://www.drive2.com/cars/{brand}/{i}/', 200, html_headers, sales[i % len(sales)])
+    for n in range(IMAGES):
+        archive.write(f'https://a.d-cd.net/{n}.jpg', 200, {'Content-Type': ['image/jpeg']}, image_body(n))
+    archive.close()
+
+
+def wait_for_server(server, ready, port, timeout=30):
+    """
+    Waits until the replay server process listens on the port. A server left on the port by another run
+    does not count: the benchmark would silently replay its archive.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if ready.wait(0.1):
+            return
+        if not server.is_alive():
+            raise RuntimeError(f'Replay server could not listen on port {port}, is it taken?')
+    raise RuntimeError(f'Replay server did not start on port {port}')
+
+
+def current_rss_mb():
+    # Linux only, resource gives the peak RSS
+    with open('/proc/self/statm') as f:
+        return round(int(f.read().split()[1]) * resource.getpagesize() / 2 ** 20, 1)
+
+
+def crawl(port, overrides, redis, sample_interval=0):
+    """
+    :param sample_interval: seconds between samples of (elapsed seconds, RSS in MiB, pending requests)
+        added to the report as `samples`, 0 for none
+    """
+    from scrapy import signals
+    from twisted.internet import task
+    from scrapy.crawler import CrawlerProcess
+    from scrapy.utils.project import get_project_settings
+    from car_finder.spiders.Drive2 import Drive2Spider
+
+    os.chdir(ROOT)
+    settings = get_project_settings()
+    workdir = tempfile.mkdtemp(prefix='replay-crawl-')
+    pipelines = dict(settings.getdict('ITEM_PIPELINES'))
+    if not redis:
+        pipelines.pop('car_finder.pipelines.BufferedRedisPipeline', None)
+    settings.setdict({
+        'REPLAY_SERVER_URL': f'http://127.0.0.1:{port}',
+        'REPLAY_RECORD_PATH': None,
+        'DOWNLOAD_HANDLERS': {
+            'http': 'car_finder.replay.ReplayDownloadHandler',
+            'https': 'car_finder.replay.ReplayDownloadHandler',
+        },
+        'ITEM_PIPELINES': pipelines,
+        'IMAGES_STORE': workdir,
+        'IMAGES_CACHE_INDEX': os.path.join(workdir, 'images-index'),
+        'PAGINATION_STATS_PATH': os.path.join(workdir, 'pagination.json'),
+        'NOTIFIER_FINISHED_URL': None,
+        'LOG_LEVEL': 'WARNING',
+    }, priority='cmdline')
+    settings.setdict(overrides, priority='cmdline')
+
+    times = {}
+    samples = []
+
+    def sample():
+        stats = crawler.stats
+        pending = stats.get_value('scheduler/enqueued', 0) - stats.get_value('scheduler/dequeued', 0)
+        samples.append((round(time.perf_counter() - times['opened'], 1), current_rss_mb(), pending))
+
+    samplers = []
+
+    def opened(spider):
+        times['opened'] = time.perf_counter()
+        if sample_interval:
+            # the reactor is installed by CrawlerProcess
+            samplers.append(task.LoopingCall(sample))
+            samplers[0].start(sample_interval)
+
+    def scraped(item, response, spider):
+        times.setdefault('first_item', time.perf_counter())
+
+    def closed(spider, reason):
+        times['closed'] = time.perf_counter()
+        if samplers and samplers[0].running:
+            sample()
+            samplers[0].stop()
+
+    process = CrawlerProcess(settings)
+    crawler = process.create_crawler(Drive2Spider)
+    crawler.signals.connect(opened, signal=signals.spider_opened)
+    crawler.signals.connect(scraped, signal=signals.item_scraped)
+    crawler.signals.connect(closed, signal=signals.spider_closed)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    process.crawl(crawler)
+    process.start()
+    after = resource.getrusage(resource.RUSAGE_SELF)
+
+    stats = crawler.stats.get_stats()
+    elapsed = times['closed'] - times['opened']
+    requests = stats.get('downloader/request_count', 0)
+    items = stats.get('item_scraped_count', 0)
+    cpu = after.ru_utime + after.ru_stime - usage.ru_utime - usage.ru_stime
+    report = {
+        'items': items,
+        'requests': requests,
+        'elapsed': round(elapsed, 3),
+        'items_per_sec': round(items / elapsed, 2),
+        'cpu_ms_per_request': round(cpu * 1000 / requests, 3) if requests else None,
+        'peak_rss_mb': round(after.ru_maxrss / 1024, 1),
+        'time_to_first_item': round(times['first_item'] - times['opened'], 3) if 'first_item' in times else None,
+        'responses_429': stats.get('downloader/response_status_count/429', 0),
+        'responses_403': stats.get('downloader/response_status_count/403', 0),
+        'retries': stats.get('retry/count', 0),
+        'finish_reason': stats.get('finish_reason'),
+    }
+    if sample_interval:
+        report['samples'] = samples
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('archive')
+    parser.add_argument('--synthetic', nargs=2, type=int, metavar=('PAGES', 'CARDS'),
+                        help='build a synthetic archive with PAGES listing pages of CARDS cards per brand')
+    parser.add_argument('--port', type=int, default=8800)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--jitter', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0, help='share of 429/403 responses')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('-s', dest='settings', action='append', default=[], metavar='NAME=VALUE')
+    parser.add_argument('--redis', action='store_true', help='keep BufferedRedisPipeline')
+    parser.add_argument('--sample', type=float, default=0, metavar='SECONDS',
+                        help='sample RSS and pending requests every SECONDS')
+    parser.add_argument('--json', action='store_true', help='print the report as a JSON line')
+    args = parser.parse_args()
+
+    if args.synthetic:
+        build_synthetic_archive(args.archive, *args.synthetic)
+    overrides = dict(setting.split('=', 1) for setting in args.settings)
+    ready = Event()
+    server = Process(target=serve, args=(args.archive, args.port, args.latency, args.jitter, args.error_rate, args.seed,
+                                         ready), daemon=True)
+    server.start()
+    try:
+        wait_for_server(server, ready, args.port)
+        report = crawl(args.port, overrides, args.redis, args.sample)
+    finally:
+        server.terminate()
+        server.join()
+    if args.json:
+        print(json.dumps(report))
+        return
+    for name, value in report.items():
+        print(f'{name:>20}: {value}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import time
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+# brand name -> carsearch context id
+DEFAULT_BRANDS = {
+    'alfaromeo': 'b_17',
+    'audi': 'b_2',
+    'bmw': 'b_3',
+    'chevrolet': 'b_20',
+    'citroen': 'b_4',
+    'ford': 'b_40',
+    'honda': 'b_43',
+    'infiniti': 'b_7',
+    'kia': 'b_25',
+    'lexus': 'b_9',
+    'mazda': 'b_29',
+    'mercedes': 'b_47',
+    'mitsubishi': 'b_51',
+    'nissan': 'b_52',
+    'opel': 'b_54',
+    'saab': 'b_30',
+    'seat': 'b_14',
+    'skoda': 'b_15',
+    'subaru': 'b_62',
+    'suzuki': 'b_63',
+    'toyota': 'b_64',
+    'volvo': 'b_16',
+    'volkswagen': 'b_65',
+    'hyundai': 'b_6',
+}
+POLICY_FIELDS = ('interval', 'max_pages', 'max_requests')
+# runs started on a schedule are a few seconds short of the interval
+DUE_SLACK = 0.05
+
+
+class BrandCatalog:
+    """
+    Brands to crawl (name -> carsearch context id) and their crawl policy:
+
+    * `interval`: seconds between crawls of the brand, a run crawls only the brands which are due
+      according to the start times of their last finished crawls kept in BRAND_SCHEDULE_PATH
+    * `max_pages`, `max_requests`: listing pages and detail pages of the brand one crawl requests
+      at most, 0 for no limit
+
+    Brands come from the BRAND_CATALOG_PATH file, from drive2's catalog page cached in
+    BRAND_CATALOG_CACHE when BRAND_CATALOG_URL is set, or from the built-in list.
+    """
+
+    def __init__(self, brands, defaults, policies=None, schedule_path=None, cache_path=None, url=None, refresh=0):
+        self.brands = {}
+        self.ids = {}
+        self.set_brands(brands)
+        self.defaults = defaults
+        self.policies = policies or {}
+        self.schedule_path = schedule_path
+        self.last_crawled = load_json(schedule_path) if schedule_path else {}
+        self.cache_path = cache_path
+        self.url = url
+        self.refresh = refresh
+        self.started = time.time()
+        self.pages = Counter()
+        self.requests = Counter()
+        self.spent = set()
+
+    @classmethod
+    def from_settings(cls, settings):
+        defaults = {field: settings.getint(f'BRAND_{field.upper()}') for field in POLICY_FIELDS}
+        policies = {brand: dict(policy) for brand, policy in settings.getdict('BRAND_POLICIES').items()}
+        path = settings.get('BRAND_CATALOG_PATH')
+        url = settings.get('BRAND_CATALOG_URL')
+        cache_path = settings.get('BRAND_CATALOG_CACHE')
+        schedule_path = settings.get('BRAND_SCHEDULE_PATH')
+        if settings.getbool('DISTRIBUTED_ENABLED'):
+            # every worker must see the same brands
+            if url or schedule_path:
+                logger.warning('Brand catalog refresh and crawl intervals are disabled in distributed mode')
+            url = schedule_path = None
+        brands = None
+        if path:
+            brands, file_policies = load_catalog_file(path)
+            policies.update(file_policies)
+            url = None
+        elif url and cache_path:
+            brands = load_json(cache_path).get('brands')
+        return cls(brands or DEFAULT_BRANDS, defaults, policies, schedule_path, cache_path, url,
+                   settings.getint('BRAND_CATALOG_REFRESH'))
+
+    def set_brands(self, brands):
+        self.brands = dict(brands)
+        self.ids = {brand_id: brand for brand, brand_id in self.brands.items()}
+
+    def brand_id(self, brand):
+        return self.brands[brand]
+
+    def brand_of(self, brand_id):
+        return self.ids[brand_id]
+
+    def policy(self, brand):
+        policy = dict(self.defaults)
+        policy.update(self.policies.get(brand, {}))
+        return policy
+
+    def stale(self):
+        """
+        :return: True if drive2's catalog should be fetched again before the crawl
+        """
+        if not self.url:
+            return False
+        fetched = load_json(self.cache_path).get('fetched', 0) if self.cache_path else 0
+        return time.time() - fetched >= self.refresh
+
+    def update(self, brands):
+        """
+        Replaces brands with the ones found on drive2's catalog page and caches them.
+        """
+        self.set_brands(brands)
+        if self.cache_path:
+            save_json(self.cache_path, {'fetched': time.time(), 'brands': self.brands})
+        logger.info(f'Brand catalog refreshed: {len(self.brands)} brands')
+
+    def select(self, names=None):
+        """
+        :param names: brands requested by the spider arguments, crawled whether they are due or not
+        :return: names of brands to crawl by this run
+        """
+        if names:
+            unknown = [name for name in names if name not in self.brands]
+            if unknown:
+                logger.error(f'Unknown brands are skipped: {", ".join(unknown)}')
+            return [name for name in names if name in self.brands]
+        selected = [brand for brand in self.brands if self.due(brand)]
+        if len(selected) < len(self.brands):
+            logger.info(f'{len(selected)} of {len(self.brands)} brands are due: {", ".join(selected)}')
+        return selected
+
+    def due(self, brand):
+        last = self.last_crawled.get(brand)
+        if not self.schedule_path or last is None:
+            return True
+        return self.started - last >= self.policy(brand)['interval'] * (1 - DUE_SLACK)
+
+    def take_page(self, brand):
+        """
+        :return: False once the brand has spent its listing or detail page budget
+        """
+        limit = self.policy(brand)['max_pages']
+        if brand in self.spent or limit and self.pages[brand] >= limit:
+            self.spend(brand, f'{limit} listing pages')
+            return False
+        self.pages[brand] += 1
+        return True
+
+    def take_request(self, brand):
+        """
+        :return: False once the brand has spent its detail page budget
+        """
+        limit = self.policy(brand)['max_requests']
+        if limit and self.requests[brand] >= limit:
+            self.spend(brand, f'{limit} detail pages')
+            return False
+        self.requests[brand] += 1
+        return True
+
+    def spend(self, brand, budget):
+        if brand not in self.spent:
+            logger.info(f'Brand {brand} has spent its budget of {budget}')
+            self.spent.add(brand)
+
+    def crawled(self, brand):
+        self.last_crawled[brand] = self.started
+
+    def save(self):
+        if self.schedule_path:
+            save_json(self.schedule_path, self.last_crawled)
+
+
+def load_catalog_file(path):
+    """
+    :param path: JSON file of brand name -> context id, or -> dict with `id` and policy fields
+    :return: tuple of (brands, policies)
+    """
+    brands, policies = {}, {}
+    for brand, entry in load_json(path).items():
+        if isinstance(entry, dict):
+            brands[brand] = entry['id']
+            policy = {field: entry[field] for field in POLICY_FIELDS if field in entry}
+            if policy:
+                policies[brand] = policy
+        else:
+            brands[brand] = entry
+    return brands, policies
+
+
+def load_json(path):
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logger.error(f'Could not load {path}: {e}')
+        return {}
+
+
+def save_json(path, data):
+    try:
+        with open(path, 'w') as f:
+            json.dump(data, f)
+    except OSError as e:
+        logger.error(f'Could not save {path}: {e}')
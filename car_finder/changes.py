@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+import bisect
+import heapq
+import json
+import logging
+import mmap
+import os
+import struct
+from array import array
+
+from scrapy import signals
+from scrapy_redis import connection
+from twisted.internet import defer, threads
+
+logger = logging.getLogger(__name__)
+
+# url fingerprint (sha1 digest), price in rubles
+RECORD = struct.Struct('<20sq')
+NO_PRICE = -1
+UNSEEN = -2
+PREFIXES = 1 << 16
+
+
+class Snapshot:
+    """
+    Url fingerprints and prices of a crawl in a flat file of fixed size records sorted by fingerprint,
+    looked up by binary search over the memory mapped file. The search starts from the range of records
+    sharing the first two bytes of the fingerprint.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.mm = None
+        self.size = 0
+        self.starts = None
+
+    def open(self):
+        if os.path.exists(self.path) and os.path.getsize(self.path):
+            self.file = open(self.path, 'rb')
+            self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.size = len(self.mm) // RECORD.size
+        # index of the first record of every 2 byte prefix
+        counts = array('q', [0]) * (PREFIXES + 1)
+        for key, _ in self.records():
+            counts[int.from_bytes(key[:2], 'big') + 1] += 1
+        for prefix in range(PREFIXES):
+            counts[prefix + 1] += counts[prefix]
+        self.starts = counts
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.file.close()
+            self.mm = self.file = None
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        # fingerprint of the record, enough for bisect
+        offset = index * RECORD.size
+        return self.mm[offset:offset + 20]
+
+    def find(self, key):
+        """
+        :return: index of the record of the fingerprint digest, -1 if it is not in the snapshot
+        """
+        prefix = int.from_bytes(key[:2], 'big')
+        index = bisect.bisect_left(self, key, self.starts[prefix], self.starts[prefix + 1])
+        if index < self.size and self[index] == key:
+            return index
+        return -1
+
+    def price(self, index):
+        return RECORD.unpack_from(self.mm, index * RECORD.size)[1]
+
+    def records(self):
+        if self.mm is None:
+            return iter(())
+        return RECORD.iter_unpack(self.mm)
+
+    @staticmethod
+    def write(path, records, chunk=10000):
+        """
+        :param records: (fingerprint digest, price) tuples sorted by fingerprint
+        """
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            buffer = []
+            for record in records:
+                buffer.append(RECORD.pack(*record))
+                if len(buffer) >= chunk:
+                    f.write(b''.join(buffer))
+                    buffer = []
+            f.write(b''.join(buffer))
+        os.replace(tmp, path)
+
+
+class ChangeDetector:
+    """
+    Diffs listings of a crawl against the snapshot of the previous crawl by url fingerprint.
+    New listings and price changes are reported as they are observed, delistings (listings of
+    the previous crawl not observed by this one) when the crawl is over.
+
+    Memory is one price per listing of the previous crawl plus the new listings.
+    """
+
+    def __init__(self, path):
+        self.snapshot = Snapshot(path)
+        self.prices = None
+        self.new = {}
+
+    def open(self):
+        self.snapshot.open()
+        # price observed by this crawl of every listing of the snapshot
+        self.prices = array('q', [UNSEEN]) * len(self.snapshot)
+
+    def observe(self, fingerprint, price):
+        """
+        :param fingerprint: url fingerprint hex digest
+        :param price: price in rubles, None if unknown
+        :return: change dict, None if the listing is known and its price did not change
+        """
+        key = bytes.fromhex(fingerprint)
+        price = NO_PRICE if price is None else price
+        index = self.snapshot.find(key)
+        if index < 0:
+            known = key in self.new
+            self.new[key] = price
+            if known:
+                return None
+            return {'change': 'new', 'url_fingerprint': fingerprint, 'price': none_price(price)}
+        previous = self.prices[index]
+        if previous == UNSEEN:
+            previous = self.snapshot.price(index)
+        self.prices[index] = price
+        if price == NO_PRICE or price == previous:
+            return None
+        return {'change': 'price_changed', 'url_fingerprint': fingerprint, 'price': price, 'old_price': none_price(previous)}
+
+    def delisted(self):
+        for (key, price), current in zip(self.snapshot.records(), self.prices):
+            if current == UNSEEN:
+                yield {'change': 'delisted', 'url_fingerprint': key.hex(), 'old_price': none_price(price)}
+
+    def close(self, complete=True):
+        """
+        Replaces the snapshot with listings of this crawl. Listings not observed by an incomplete
+        crawl are kept with their old price.
+        """
+        current = ((key, old if price == UNSEEN else price)
+                   for (key, old), price in zip(self.snapshot.records(), self.prices)
+                   if price != UNSEEN or not complete)
+        Snapshot.write(self.snapshot.path + '.next', heapq.merge(current, sorted(self.new.items())))
+        self.snapshot.close()
+        os.replace(self.snapshot.path + '.next', self.snapshot.path)
+
+
+def none_price(price):
+    return None if price == NO_PRICE else price
+
+
+class ChangeTracker:
+    """
+    Pushes new listings, price changes and delistings compared to the previous crawl to CHANGES_REDIS_KEY
+    list as JSON documents, in batches of CHANGES_BATCH_SIZE. The spider reports every listing card it sees.
+
+    Delistings are pushed only when the crawl finished without losing listing pages, otherwise listings
+    not seen are kept in the snapshot for the next crawl.
+    """
+
+    def __init__(self, crawler, detector, server, key, batch_size):
+        self.crawler = crawler
+        self.detector = detector
+        self.server = server
+        self.key = key
+        self.batch_size = batch_size
+        self.buffer = []
+        self.complete = True
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        path = settings.get('CHANGES_SNAPSHOT_PATH')
+        if not path:
+            return None
+        if settings.getbool('DISTRIBUTED_ENABLED'):
+            logger.warning('Change detection is disabled in distributed mode, a worker sees only a part of the listings')
+            return None
+        tracker = cls(
+            crawler,
+            ChangeDetector(path),
+            connection.from_settings(settings),
+            settings.get('CHANGES_REDIS_KEY') % {'spider': crawler.spidercls.name},
+            settings.getint('CHANGES_BATCH_SIZE'),
+        )
+        crawler.signals.connect(tracker.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(tracker.spider_closed, signal=signals.spider_closed)
+        return tracker
+
+    def spider_opened(self, spider):
+        self.detector.open()
+        logger.info(f'Detecting changes against {len(self.detector.snapshot)} listings of the previous crawl')
+
+    def observe(self, fingerprint, price, url):
+        change = self.detector.observe(fingerprint, price)
+        if change is not None:
+            change['url'] = url
+            self.emit(change)
+
+    def mark_incomplete(self, reason):
+        if self.complete:
+            logger.warning(f'Delistings will not be reported: {reason}')
+        self.complete = False
+
+    def emit(self, change):
+        self.crawler.stats.inc_value(f'changes/{change["change"]}')
+        self.buffer.append(json.dumps(change))
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return defer.succeed(None)
+        batch, self.buffer = self.buffer, []
+        d = threads.deferToThread(self.server.rpush, self.key, *batch)
+        d.addErrback(lambda failure: logger.error(f'Failed to push {len(batch)} changes to redis: {failure.value}'))
+        return d
+
+    def spider_closed(self, spider, reason):
+        complete = self.complete and reason == 'finished'
+        if complete:
+            for change in self.detector.delisted():
+                self.emit(change)
+        stats = self.crawler.stats
+        logger.info(f'Changes: {stats.get_value("changes/new", 0)} new, {stats.get_value("changes/price_changed", 0)} '
+                    f'price changes, {stats.get_value("changes/delisted", 0)} delisted')
+        self.detector.close(complete)
+        return self.flush()
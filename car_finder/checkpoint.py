@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+
+from scrapy import signals
+from scrapy_redis import connection
+from twisted.internet import task
+
+logger = logging.getLogger(__name__)
+
+
+class FileCheckpointStore:
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            return f.read()
+
+    def save(self, data):
+        # a crash while writing keeps the previous checkpoint
+        path = self.path + '.tmp'
+        with open(path, 'w') as f:
+            f.write(data)
+        os.replace(path, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class RedisCheckpointStore:
+    def __init__(self, server, key):
+        self.server = server
+        self.key = key
+
+    def load(self):
+        data = self.server.get(self.key)
+        return data.decode() if data is not None else None
+
+    def save(self, data):
+        self.server.set(self.key, data)
+
+    def clear(self):
+        self.server.delete(self.key)
+
+
+class Checkpointer:
+    """
+    Saves crawl progress every CHECKPOINT_INTERVAL seconds, only when it has changed:
+    state of the spider (`spider.checkpoint_state()`) and requests with `checkpoint` meta key
+    which are scheduled but have not got a response yet, by url. The spider state is small and
+    compared on each save, pending requests are serialized only once signals have changed them.
+
+    The checkpoint is removed once the crawl is finished. With CHECKPOINT_RESUME the next run
+    continues from it. On a clean shutdown with JOBDIR pending requests are kept by the scheduler,
+    the checkpoint is marked `queued` so they are not requested twice.
+    """
+
+    def __init__(self, crawler, store, interval, resume):
+        self.crawler = crawler
+        self.store = store
+        self.interval = interval
+        self.resume_enabled = resume
+        self.jobdir = bool(crawler.settings.get('JOBDIR'))
+        self.pending = {}
+        self.pending_changed = True
+        self.spider = None
+        self.saved_state = None
+        self.loop = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        backend = settings.get('CHECKPOINT_BACKEND')
+        if not backend:
+            return None
+        if settings.getbool('DISTRIBUTED_ENABLED'):
+            logger.warning('Checkpoints are disabled in distributed mode, brand leases are restarted instead')
+            return None
+        spider_name = crawler.spidercls.name
+        if backend == 'redis':
+            key = settings.get('CHECKPOINT_REDIS_KEY') % {'spider': spider_name}
+            store = RedisCheckpointStore(connection.from_settings(settings), key)
+        else:
+            path = settings.get('CHECKPOINT_PATH')
+            if not path:
+                path = os.path.join(settings.get('JOBDIR') or '.', f'{spider_name}.checkpoint.json')
+            store = FileCheckpointStore(path)
+        checkpointer = cls(crawler, store, settings.getfloat('CHECKPOINT_INTERVAL'), settings.getbool('CHECKPOINT_RESUME'))
+        crawler.signals.connect(checkpointer.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(checkpointer.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(checkpointer.request_scheduled, signal=signals.request_scheduled)
+        crawler.signals.connect(checkpointer.request_done, signal=signals.request_dropped)
+        crawler.signals.connect(checkpointer.request_done, signal=signals.request_left_downloader)
+        crawler.signals.connect(checkpointer.response_received, signal=signals.response_received)
+        return checkpointer
+
+    def resume(self):
+        """
+        :return: the last checkpoint when resuming, None for a fresh crawl
+        """
+        if not self.resume_enabled:
+            return None
+        data = self.store.load()
+        if data is None:
+            logger.info('No checkpoint to resume from, starting a new crawl')
+            return None
+        state = json.loads(data)
+        self.pending = dict(state['pending']) if state['queued'] else {}
+        logger.info(f'Resuming from checkpoint: {len(state["pending"])} pending requests')
+        return state
+
+    def spider_opened(self, spider):
+        self.spider = spider
+        self.loop = task.LoopingCall(self.save)
+        self.loop.start(self.interval, now=False)
+
+    def request_scheduled(self, request, spider):
+        payload = request.meta.get('checkpoint')
+        if payload is not None:
+            self.pending[request.url] = payload
+            self.pending_changed = True
+
+    def request_done(self, request, spider):
+        if self.pending.pop(request.url, None) is not None:
+            self.pending_changed = True
+
+    def response_received(self, response, request, spider):
+        # cached responses do not go through the downloader
+        self.request_done(request, spider)
+
+    def save(self, queued=False):
+        state = self.spider.checkpoint_state()
+        spider_state = json.dumps(state)
+        if not self.pending_changed and (spider_state, queued) == self.saved_state:
+            return
+        state['pending'] = self.pending
+        state['queued'] = queued
+        try:
+            self.store.save(json.dumps(state))
+        except Exception as e:
+            logger.error(f'Could not save checkpoint: {e}')
+            return
+        self.pending_changed = False
+        self.saved_state = (spider_state, queued)
+        self.crawler.stats.inc_value('checkpoint/saved')
+
+    def spider_closed(self, spider, reason):
+        if self.loop and self.loop.running:
+            self.loop.stop()
+        if reason == 'finished':
+            self.store.clear()
+        else:
+            self.save(queued=self.jobdir)
+            logger.info(f'Saved checkpoint of the {reason} crawl, resume it with CHECKPOINT_RESUME=1')
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+
+from scrapy.core.downloader.handlers.http11 import HTTP11DownloadHandler
+from scrapy.utils.httpobj import urlparse_cached
+from twisted.web.client import HTTPConnectionPool
+
+from car_finder.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+
+def pool_label(key):
+    """
+    :param key: connection pool key of scrapy agents, ending with the bind address:
+        (scheme, host, port, bind) for direct connections, (b'http-proxy', proxy host, proxy port, bind)
+        for plain http through a proxy, (scheme, host, port, proxy host, proxy port, auth, bind) for CONNECT tunnels
+    :return: proxy host:port or 'direct'
+    """
+    if key[0] == b'http-proxy':
+        host, port = key[1], key[2]
+    elif len(key) >= 7:
+        host, port = key[3], key[4]
+    else:
+        return 'direct'
+    return f'{host.decode() if isinstance(host, bytes) else host}:{port}'
+
+
+def http2_unsupported(error):
+    """
+    :return: True if the download failed on the HTTP/2 protocol itself and not on the network or
+        the server response: ALPN negotiated http/1.1, the server does not speak HTTP/2 or closed
+        the connection on the HTTP/2 preface before the request was sent (no ALPN)
+    """
+    from h2.exceptions import H2Error
+    try:
+        from scrapy.core._http2.stream import InactiveStreamClosed
+    except ImportError:
+        from scrapy.core.http2.stream import InactiveStreamClosed
+    # errors of a lost connection come in twisted ResponseFailed, wrapped by scrapy's DownloadFailedError
+    reasons = []
+    while error is not None:
+        reasons += [error, *getattr(error, 'reasons', ())]
+        error = error.__cause__
+    return any(isinstance(getattr(reason, 'value', reason), (H2Error, InactiveStreamClosed)) for reason in reasons)
+
+
+class InstrumentedConnectionPool(HTTPConnectionPool):
+    """
+    Keep-alive pool counting new and reused connections per proxy. Setup time of a new connection
+    covers TCP connect and the proxy CONNECT tunnel, i.e. building the Tor circuit.
+    """
+
+    def __init__(self, reactor, stats):
+        super().__init__(reactor, persistent=True)
+        self.stats = stats
+        self.setup_time = 0
+
+    def getConnection(self, key, endpoint):
+        self.stats.inc_value('connections/requested')
+        registry.inc('connections_requested', proxy=pool_label(key))
+        d = super().getConnection(key, endpoint)
+        self.update_reuse_ratio()
+        return d
+
+    def _newConnection(self, key, endpoint):
+        self.stats.inc_value('connections/new')
+        d = super()._newConnection(key, endpoint)
+        d.addCallback(self._connected, key, time.perf_counter())
+        return d
+
+    def _connected(self, connection, key, start):
+        elapsed = time.perf_counter() - start
+        label = pool_label(key)
+        registry.histogram('connection_setup_seconds', proxy=label).observe(elapsed)
+        registry.inc('connections_opened', proxy=label)
+        self.setup_time += elapsed
+        self.stats.set_value('connections/setup_time', round(self.setup_time / self.stats.get_value('connections/new'), 3))
+        return connection
+
+    def update_reuse_ratio(self):
+        requested = self.stats.get_value('connections/requested', 0)
+        if requested:
+            reused = requested - self.stats.get_value('connections/new', 0)
+            self.stats.set_value('connections/reused', reused)
+            self.stats.set_value('connections/reuse_ratio', round(reused / requested, 3))
+
+
+class PooledDownloadHandler(HTTP11DownloadHandler):
+    """
+    HTTP/1.1 handler keeping up to DOWNLOAD_POOL_SIZE idle keep-alive connections per proxy and target
+    host for DOWNLOAD_POOL_KEEPALIVE seconds, with connection reuse stats.
+
+    With HTTP2_ENABLED https requests not going through a proxy use HTTP/2 (requires h2),
+    hosts which do not negotiate it fall back to HTTP/1.1. Other errors are raised as usual,
+    so RetryMiddleware handles them.
+    """
+
+    def __init__(self, crawler):
+        super().__init__(crawler)
+        from twisted.internet import reactor
+        settings = crawler.settings
+        # Scrapy has no hook for its pool and sets a lenient HTTP/1.1 client factory on it,
+        # private to the Scrapy versions pinned in requirements.txt
+        factory = self._pool._factory
+        self._pool = InstrumentedConnectionPool(reactor, crawler.stats)
+        self._pool._factory = factory
+        self._pool.maxPersistentPerHost = settings.getint('DOWNLOAD_POOL_SIZE')
+        self._pool.cachedConnectionTimeout = settings.getint('DOWNLOAD_POOL_KEEPALIVE')
+        self.stats = crawler.stats
+        self.h2 = None
+        # hosts answering over HTTP/2 and hosts which failed it before answering once
+        self.http2_hosts = set()
+        self.http11_hosts = set()
+        if settings.getbool('HTTP2_ENABLED'):
+            try:
+                from scrapy.core.downloader.handlers.http2 import H2DownloadHandler
+            except ImportError as e:
+                logger.warning(f'HTTP/2 is disabled: {e}')
+            else:
+                self.h2 = H2DownloadHandler(crawler)
+
+    async def download_request(self, request):
+        parsed = urlparse_cached(request)
+        if self.h2 is None or parsed.scheme != 'https' or request.meta.get('proxy') \
+                or parsed.netloc in self.http11_hosts:
+            return await super().download_request(request)
+        try:
+            response = await self.h2.download_request(request)
+        except Exception as e:
+            if parsed.netloc in self.http2_hosts or not http2_unsupported(e):
+                raise
+            if parsed.netloc not in self.http11_hosts:
+                logger.info(f'HTTP/2 is not supported by {parsed.netloc}, using HTTP/1.1: {e}')
+                self.http11_hosts.add(parsed.netloc)
+            return await super().download_request(request)
+        self.http2_hosts.add(parsed.netloc)
+        self.stats.inc_value('connections/http2_requests')
+        return response
+
+    async def close(self):
+        if self.h2 is not None:
+            await self.h2.close()
+        await super().close()
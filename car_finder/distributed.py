@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+import heapq
+import itertools
+import json
+import logging
+import os
+import socket
+import time
+
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider
+from scrapy.utils.misc import build_from_crawler, load_object
+from scrapy_redis import connection, defaults
+from scrapy_redis.scheduler import Scheduler
+from twisted.internet import task
+
+logger = logging.getLogger(__name__)
+
+# Extends the lease only while it is held by the worker
+RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# Job state cleared when a new job is seeded
+JOB_KEYS = ('done', 'brands', 'stats', 'finished')
+
+
+def get_queue(server, settings, spider):
+    return load_object(settings.get('SCHEDULER_QUEUE_CLASS', defaults.SCHEDULER_QUEUE_CLASS))(
+        server=server,
+        spider=spider,
+        key=settings.get('SCHEDULER_QUEUE_KEY', defaults.SCHEDULER_QUEUE_KEY) % {'spider': spider.name},
+    )
+
+
+class DistributedScheduler(Scheduler):
+    """
+    scrapy_redis scheduler sharing requests between workers of a job. Requests with `lease`
+    meta key (listing pages of a brand leased by this worker) stay in a local queue and go first,
+    so pagination keeps feeding detail pages to all workers.
+    The shared queue is never flushed by a worker, JobCoordinator cleans up the finished job.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.local = []
+        self.order = itertools.count()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        scheduler = cls(
+            server=connection.from_settings(settings),
+            persist=True,
+            queue_key=settings.get('SCHEDULER_QUEUE_KEY', defaults.SCHEDULER_QUEUE_KEY),
+            queue_cls=settings.get('SCHEDULER_QUEUE_CLASS', defaults.SCHEDULER_QUEUE_CLASS),
+            dupefilter=build_from_crawler(load_object(settings.get('DUPEFILTER_CLASS')), crawler),
+            idle_before_close=settings.getint('SCHEDULER_IDLE_BEFORE_CLOSE'),
+        )
+        scheduler.stats = crawler.stats
+        return scheduler
+
+    def __len__(self):
+        return len(self.local) + len(self.queue)
+
+    def open(self, spider):
+        super().open(spider)
+        return self.df.open()
+
+    def close(self, reason):
+        super().close(reason)
+        return self.df.close(reason)
+
+    def enqueue_request(self, request):
+        if not request.meta.get('lease'):
+            return super().enqueue_request(request)
+        if not request.dont_filter and self.df.request_seen(request):
+            self.df.log(request, self.spider)
+            return False
+        heapq.heappush(self.local, (-request.priority, next(self.order), request))
+        self.stats.inc_value('scheduler/enqueued/local')
+        return True
+
+    def next_request(self):
+        if self.local:
+            self.stats.inc_value('scheduler/dequeued/local')
+            return heapq.heappop(self.local)[2]
+        return super().next_request()
+
+
+class JobCoordinator:
+    """
+    Coordinates the workers of a distributed job through redis:
+
+    * the first worker seeds brand start requests, others pull them from the shared queue
+    * a brand is paginated only by the worker holding its lease, leases of a dead worker
+      expire and its unfinished brands are restarted by another worker
+    * the job is finished once all brands are done, the shared queue is empty and all workers
+      are idle on two idle checks in a row; only the worker noticing it notifies about the job
+
+    :param brands: names of all brands of the job
+    """
+
+    def __init__(self, crawler, server, prefix, brands, lease_ttl, heartbeat_interval):
+        self.crawler = crawler
+        self.server = server
+        self.prefix = prefix
+        self.brands = brands
+        self.lease_ttl = lease_ttl
+        self.heartbeat_interval = heartbeat_interval
+        self.worker = f'{socket.gethostname()}:{os.getpid()}'
+        self.renew_script = server.register_script(RENEW_SCRIPT)
+        self.release_script = server.register_script(RELEASE_SCRIPT)
+        self.leases = set()
+        self.busy = False
+        self.quiet = False
+        self.finisher = False
+        self.totals = {}
+        self.queue = None
+        self.heartbeat = None
+
+    @classmethod
+    def from_crawler(cls, crawler, brands):
+        settings = crawler.settings
+        if not settings.getbool('DISTRIBUTED_ENABLED'):
+            return None
+        coordinator = cls(
+            crawler,
+            connection.from_settings(settings),
+            settings.get('DISTRIBUTED_KEY') % {'spider': crawler.spidercls.name},
+            list(brands),
+            settings.getfloat('DISTRIBUTED_LEASE_TTL'),
+            settings.getfloat('DISTRIBUTED_HEARTBEAT_INTERVAL'),
+        )
+        crawler.signals.connect(coordinator.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(coordinator.spider_idle, signal=signals.spider_idle)
+        crawler.signals.connect(coordinator.request_reached_downloader, signal=signals.request_reached_downloader)
+        crawler.signals.connect(coordinator.spider_closed, signal=signals.spider_closed)
+        return coordinator
+
+    def key(self, name):
+        return f'{self.prefix}:{name}'
+
+    def spider_opened(self, spider):
+        self.queue = get_queue(self.server, self.crawler.settings, spider)
+        self.set_busy(False)
+        self.heartbeat = task.LoopingCall(self.renew)
+        self.heartbeat.start(self.heartbeat_interval, now=False)
+        logger.info(f'Worker {self.worker} joined distributed job {self.prefix}')
+
+    def seed(self):
+        """
+        :return: True if this worker starts a new job and should schedule the start requests
+        """
+        if not self.server.set(self.prefix, self.worker, nx=True):
+            logger.info(f'Distributed job {self.prefix} is already started by {self.server.get(self.prefix).decode()}')
+            return False
+        # state left by a job which was never finished
+        self.server.delete(*[self.key(name) for name in JOB_KEYS])
+        logger.info(f'Seeding distributed job {self.prefix}')
+        return True
+
+    def hold(self, brand):
+        """
+        :return: True if this worker holds or has just acquired the brand lease
+        """
+        if brand in self.leases:
+            return True
+        if self.server.sismember(self.key('done'), brand):
+            return False
+        if not self.server.set(self.key(f'leases:{brand}'), self.worker, nx=True, px=int(self.lease_ttl * 1000)):
+            return False
+        logger.info(f'Acquired lease of brand {brand}')
+        self.leases.add(brand)
+        return True
+
+    def release(self, brand):
+        self.leases.discard(brand)
+        self.release_script(keys=[self.key(f'leases:{brand}')], args=[self.worker])
+
+    def brand_finished(self, brand, found):
+        pipe = self.server.pipeline()
+        pipe.sadd(self.key('done'), brand)
+        pipe.hset(self.key('brands'), brand, found)
+        pipe.execute()
+        self.release(brand)
+
+    def renew(self):
+        for brand in list(self.leases):
+            if not self.renew_script(keys=[self.key(f'leases:{brand}')], args=[self.worker, int(self.lease_ttl * 1000)]):
+                logger.warning(f'Lost lease of brand {brand}')
+                self.leases.discard(brand)
+        self.set_busy(self.busy)
+
+    def set_busy(self, busy):
+        self.busy = busy
+        self.server.hset(self.key('workers'), self.worker, json.dumps({'busy': busy, 'ts': time.time()}))
+
+    def request_reached_downloader(self, request, spider):
+        if not self.busy:
+            self.set_busy(True)
+
+    def live_workers(self):
+        workers = {}
+        for worker, state in self.server.hgetall(self.key('workers')).items():
+            state = json.loads(state)
+            if time.time() - state['ts'] > self.lease_ttl:
+                logger.warning(f'Worker {worker.decode()} is gone')
+                self.server.hdel(self.key('workers'), worker)
+                continue
+            workers[worker] = state
+        return workers
+
+    def report(self):
+        stats = self.crawler.stats
+        self.server.hset(self.key('stats'), self.worker, json.dumps({
+            'items': stats.get_value('item_scraped_count', 0),
+            'errors': stats.get_value('log_count/ERROR', 0),
+            'retries': stats.get_value('retry/count', 0),
+        }))
+
+    def spider_idle(self, spider):
+        self.set_busy(False)
+        self.report()
+        if self.server.exists(self.key('finished')) or self.job_finished(spider):
+            return
+        raise DontCloseSpider
+
+    def job_finished(self, spider):
+        workers = self.live_workers()
+        if len(self.queue) or any(state['busy'] for state in workers.values()):
+            self.quiet = False
+            return False
+        if not self.quiet:
+            # a worker might have just popped the last request, confirm on the next idle check
+            self.quiet = True
+            return False
+        self.quiet = False
+        pending = set(self.brands) - {brand.decode() for brand in self.server.smembers(self.key('done'))}
+        if pending:
+            self.restart(spider, sorted(pending))
+            return False
+        self.totals = self.get_totals(len(workers))
+        self.finisher = bool(self.server.set(self.key('finished'), self.worker, nx=True, ex=int(self.lease_ttl * 10)))
+        if self.finisher:
+            logger.info(f'Distributed job {self.prefix} is finished')
+        return True
+
+    def restart(self, spider, brands):
+        """
+        Restart unfinished brands nobody holds a lease of, e.g. of a dead worker.
+        """
+        for brand in brands:
+            if self.hold(brand):
+                logger.warning(f'Restarting unfinished brand {brand}')
+                self.crawler.engine.crawl(spider.restart_brand(brand))
+
+    def get_totals(self, workers):
+        totals = {'items': 0, 'errors': 0, 'retries': 0}
+        for stats in self.server.hvals(self.key('stats')):
+            for name, value in json.loads(stats).items():
+                totals[name] += value
+        totals['brands'] = {brand.decode(): int(found) for brand, found in self.server.hgetall(self.key('brands')).items()}
+        totals['workers'] = workers
+        return totals
+
+    def spider_closed(self, spider, reason):
+        if self.heartbeat and self.heartbeat.running:
+            self.heartbeat.stop()
+        for brand in list(self.leases):
+            self.release(brand)
+        self.server.hdel(self.key('workers'), self.worker)
+        if self.finisher:
+            # `finished` expires by itself, late workers still see the job is over
+            self.server.delete(self.prefix, *[self.key(name) for name in JOB_KEYS if name != 'finished'])
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import math
+import mmap
+import os
+import time
+
+from scrapy import signals
+from scrapy.dupefilters import RFPDupeFilter
+from scrapy_redis import connection
+
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter:
+    """
+    Bloom filter over a memory mapped file, keyed by hex request fingerprints.
+    """
+
+    def __init__(self, path, capacity, error_rate):
+        self.path = path
+        self.bits = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(int(round(self.bits / capacity * math.log(2))), 1)
+        size = (self.bits + 7) // 8
+        with open(path, 'ab') as f:
+            if f.tell() < size:
+                f.truncate(size)
+        self.file = open(path, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), size)
+
+    def _positions(self, fingerprint):
+        h1 = int(fingerprint[:16], 16)
+        h2 = int(fingerprint[16:32], 16) | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def __contains__(self, fingerprint):
+        return all(self.map[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(fingerprint))
+
+    def add(self, fingerprint):
+        for pos in self._positions(fingerprint):
+            self.map[pos >> 3] |= 1 << (pos & 7)
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class BloomStore:
+    """
+    Fingerprints with TTL kept in `generations` rotating Bloom filters,
+    each one collecting fingerprints for ttl / generations seconds.
+    Memory use is fixed by capacity and error rate, not by the number of fingerprints.
+    """
+
+    def __init__(self, path, capacity, error_rate, ttl, generations):
+        self.path = path
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.span = ttl / generations
+        self.generations = generations
+        self.filters = []
+        os.makedirs(path, exist_ok=True)
+
+    @property
+    def meta_path(self):
+        return os.path.join(self.path, 'generations.json')
+
+    def open(self):
+        starts = []
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                starts = json.load(f)
+        self.filters = [(start, self._filter(start)) for start in starts]
+        self.rotate()
+
+    def _filter(self, start):
+        return BloomFilter(os.path.join(self.path, f'{int(start)}.bloom'), self.capacity, self.error_rate)
+
+    def rotate(self):
+        now = time.time()
+        if not self.filters or now - self.filters[-1][0] >= self.span:
+            self.filters.append((now, self._filter(now)))
+        while len(self.filters) > self.generations or now - self.filters[0][0] >= self.span * (self.generations + 1):
+            start, expired = self.filters.pop(0)
+            expired.close()
+            os.remove(expired.path)
+        with open(self.meta_path, 'w') as f:
+            json.dump([start for start, _ in self.filters], f)
+
+    def __contains__(self, fingerprint):
+        return any(fingerprint in bloom for _, bloom in self.filters)
+
+    def add(self, fingerprint):
+        if time.time() - self.filters[-1][0] >= self.span:
+            self.rotate()
+        self.filters[-1][1].add(fingerprint)
+
+    def seen(self, fingerprint):
+        if fingerprint in self:
+            return True
+        self.add(fingerprint)
+        return False
+
+    def close(self):
+        for _, bloom in self.filters:
+            bloom.close()
+
+
+# Returns 1 if fingerprint was added less than ttl seconds ago, adds it otherwise
+SEEN_SCRIPT = """
+local added = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if added and tonumber(added) > tonumber(ARGV[2]) - tonumber(ARGV[3]) then
+    return 1
+end
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+return 0
+"""
+
+
+class RedisStore:
+    """
+    Fingerprints with TTL in a redis sorted set scored by the time they were added.
+    """
+    CLEANUP_EVERY = 10000
+
+    def __init__(self, server, key, ttl):
+        self.server = server
+        self.key = key
+        self.ttl = ttl
+        self.script = server.register_script(SEEN_SCRIPT)
+        self.added = 0
+
+    def open(self):
+        self.cleanup()
+
+    def cleanup(self):
+        self.server.zremrangebyscore(self.key, '-inf', time.time() - self.ttl)
+
+    def __contains__(self, fingerprint):
+        added = self.server.zscore(self.key, fingerprint)
+        return added is not None and added > time.time() - self.ttl
+
+    def add(self, fingerprint):
+        self.server.zadd(self.key, {fingerprint: time.time()})
+        self.added_one()
+
+    def seen(self, fingerprint):
+        if self.script(keys=[self.key], args=[fingerprint, time.time(), self.ttl]):
+            return True
+        self.added_one()
+        return False
+
+    def added_one(self):
+        self.added += 1
+        if self.added % self.CLEANUP_EVERY == 0:
+            self.cleanup()
+
+    def close(self):
+        self.cleanup()
+
+
+class PersistentDupeFilter(RFPDupeFilter):
+    """
+    Requests with `persist_fingerprint` meta key (detail pages) are checked against
+    a store shared between crawls, PERSISTENT_DUPEFILTER_BACKEND is 'bloom' or 'redis'.
+    Other requests are filtered in memory as usual.
+
+    A fingerprint is kept in the store once its page is fetched, so a failed page is requested
+    again by the next crawl. `persist_fingerprint` is True or the fingerprint to keep, e.g. the one
+    of the request before redirects.
+    """
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        dupefilter = super().from_crawler(crawler)
+        dupefilter.store = cls.get_store(crawler.settings, crawler.spidercls.name)
+        dupefilter.stats = crawler.stats
+        if dupefilter.store:
+            crawler.signals.connect(dupefilter.response_received, signal=signals.response_received)
+        return dupefilter
+
+    @staticmethod
+    def get_store(settings, spider_name):
+        backend = settings.get('PERSISTENT_DUPEFILTER_BACKEND')
+        ttl = settings.getfloat('PERSISTENT_DUPEFILTER_TTL')
+        if backend == 'bloom':
+            return BloomStore(
+                settings.get('PERSISTENT_DUPEFILTER_PATH'),
+                settings.getint('PERSISTENT_DUPEFILTER_CAPACITY'),
+                settings.getfloat('PERSISTENT_DUPEFILTER_ERROR_RATE'),
+                ttl,
+                settings.getint('PERSISTENT_DUPEFILTER_GENERATIONS'),
+            )
+        if backend == 'redis':
+            key = settings.get('PERSISTENT_DUPEFILTER_REDIS_KEY') % {'spider': spider_name}
+            return RedisStore(connection.from_settings(settings), key, ttl)
+
+    def open(self):
+        super().open()
+        if self.store:
+            self.store.open()
+
+    def close(self, reason):
+        if self.store:
+            self.store.close()
+        return super().close(reason)
+
+    def request_seen(self, request):
+        if self.store is None or not request.meta.get('persist_fingerprint'):
+            return super().request_seen(request)
+        if self.persistent_fingerprint(request) in self.store:
+            self.stats.inc_value('dupefilter/persistent/filtered')
+            return True
+        # not fetched yet, duplicates scheduled by this crawl are filtered in memory
+        return super().request_seen(request)
+
+    def response_received(self, response, request, spider):
+        if request.meta.get('persist_fingerprint') and response.status == 200:
+            self.store.add(self.persistent_fingerprint(request))
+
+    def persistent_fingerprint(self, request):
+        fingerprint = request.meta['persist_fingerprint']
+        return fingerprint if isinstance(fingerprint, str) else self.request_fingerprint(request)
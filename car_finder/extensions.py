@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+
+# Define here your extensions
+#
+# See documentation in:
+# https://doc.scrapy.org/en/latest/topics/extensions.html
+import json
+import logging
+import pickle
+import time
+from io import BytesIO
+
+from scrapy import signals
+from scrapy.crawler import Crawler
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.httpobj import urlparse_cached
+from twisted.internet import defer, task
+from twisted.web import resource, server
+from twisted.web.client import Agent, FileBodyProducer, HTTPConnectionPool, readBody
+from twisted.web.http_headers import Headers
+
+from car_finder.metrics import RETRY_BUCKETS, SIZE_BUCKETS, enable_timing, registry
+
+logger = logging.getLogger(__name__)
+
+
+class CrawlNotifier:
+    """
+    Posts crawl stats to the REST API when the spider finishes and, optionally,
+    periodic progress heartbeats. Requests are non-blocking, time out after
+    NOTIFIER_TIMEOUT seconds and are retried NOTIFIER_RETRIES times.
+    """
+
+    def __init__(self, crawler, finished_url, progress_url, heartbeat_interval, timeout, retries, retry_delay):
+        self.crawler = crawler
+        self.finished_url = finished_url
+        self.progress_url = progress_url
+        self.heartbeat_interval = heartbeat_interval
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.heartbeat = None
+        self.pool = None
+        self.agent = None
+
+    @classmethod
+    def from_crawler(cls, crawler: Crawler):
+        settings = crawler.settings
+        finished_url = settings.get('NOTIFIER_FINISHED_URL')
+        if not finished_url:
+            raise NotConfigured('NOTIFIER_FINISHED_URL is not set')
+        notifier = cls(
+            crawler,
+            finished_url,
+            settings.get('NOTIFIER_PROGRESS_URL'),
+            settings.getfloat('NOTIFIER_HEARTBEAT_INTERVAL'),
+            settings.getfloat('NOTIFIER_TIMEOUT'),
+            settings.getint('NOTIFIER_RETRIES'),
+            settings.getfloat('NOTIFIER_RETRY_DELAY'),
+        )
+        crawler.signals.connect(notifier.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(notifier.spider_closed, signal=signals.spider_closed)
+        return notifier
+
+    def spider_opened(self, spider):
+        from twisted.internet import reactor
+        self.pool = HTTPConnectionPool(reactor)
+        self.agent = Agent(reactor, pool=self.pool)
+        if self.progress_url and self.heartbeat_interval:
+            self.heartbeat = task.LoopingCall(self.send_progress, spider)
+            self.heartbeat.start(self.heartbeat_interval, now=False)
+
+    def spider_closed(self, spider, reason):
+        if self.heartbeat and self.heartbeat.running:
+            self.heartbeat.stop()
+        coordinator = getattr(spider, 'coordinator', None)
+        if coordinator and not coordinator.finisher:
+            # one notification per distributed job, sent by the worker which finished it
+            logger.info(f'Worker of {spider.name} closed ({reason}), the job is not finished by this worker')
+            self.pool.closeCachedConnections()
+            return
+        payload = self.get_payload(spider)
+        payload['reason'] = reason
+        logger.info(f'Notifying {self.finished_url} that {spider.name} finished: {reason}')
+        d = self.post(self.finished_url, payload)
+        d.addCallback(lambda _: self.pool.closeCachedConnections())
+        return d
+
+    def send_progress(self, spider):
+        # heartbeats are best effort, a slow API must not pile them up
+        return self.post(self.progress_url, self.get_payload(spider), retries=0)
+
+    def get_payload(self, spider):
+        stats = self.crawler.stats.get_stats()
+        payload = {
+            'spider': spider.name,
+            'brands': dict(getattr(spider, 'counter', {})),
+            'items': stats.get('item_scraped_count', 0),
+            'errors': stats.get('log_count/ERROR', 0),
+            'retries': stats.get('retry/count', 0),
+            'stats': stats,
+        }
+        changes = getattr(spider, 'changes', None)
+        if changes:
+            # the delta is in redis, the API does not need to diff the whole catalog
+            payload['changes'] = {
+                'key': changes.key,
+                'new': stats.get('changes/new', 0),
+                'price_changed': stats.get('changes/price_changed', 0),
+                'delisted': stats.get('changes/delisted', 0),
+            }
+        coordinator = getattr(spider, 'coordinator', None)
+        if coordinator and coordinator.totals:
+            payload.update(coordinator.totals)
+        return payload
+
+    @defer.inlineCallbacks
+    def post(self, url, payload, retries=None):
+        """
+        :return: Deferred fired with True when the API accepted the payload, never errbacks
+        """
+        from twisted.internet import reactor
+        retries = self.retries if retries is None else retries
+        body = json.dumps(payload, default=str).encode()
+        for attempt in range(retries + 1):
+            if attempt:
+                yield task.deferLater(reactor, self.retry_delay * 2 ** (attempt - 1), lambda: None)
+            try:
+                d = self.agent.request(b'POST', url.encode(), Headers({b'Content-Type': [b'application/json']}),
+                                       FileBodyProducer(BytesIO(body)))
+                d.addTimeout(self.timeout, reactor)
+                response = yield d
+                yield readBody(response)
+            except Exception as e:
+                logger.error(f'Failed to post to {url} ({attempt + 1}/{retries + 1}): {e}')
+                continue
+            if response.code < 500:
+                return response.code < 400
+            logger.error(f'Failed to post to {url} ({attempt + 1}/{retries + 1}): HTTP {response.code}')
+        return False
+
+
+class MetricsResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, metrics):
+        super().__init__()
+        self.metrics = metrics
+
+    def render_GET(self, request):
+        self.metrics.update_gauges('prometheus')
+        request.setHeader(b'Content-Type', b'text/plain; version=0.0.4; charset=utf-8')
+        return registry.to_prometheus('car_finder').encode()
+
+
+class CrawlMetrics:
+    """
+    Collects crawl performance metrics: callback time (see car_finder.metrics.timed),
+    download latency and response codes per download slot, retry depth, items/sec,
+    in-flight requests and size of sampled request meta.
+    Metrics are appended to METRICS_JSONL_PATH every METRICS_INTERVAL seconds
+    and served in Prometheus text format on METRICS_PORT.
+    """
+
+    def __init__(self, crawler, jsonl_path, interval, host, port, meta_sample):
+        self.crawler = crawler
+        self.jsonl_path = jsonl_path
+        self.interval = interval
+        self.host = host
+        self.port = port
+        self.meta_sample = meta_sample
+        self.requests = 0
+        self.file = None
+        self.loop = None
+        self.listener = None
+        self.started = None
+        # (time, items) of the previous export by exporter, for items_per_second
+        self.last = {}
+
+    @classmethod
+    def from_crawler(cls, crawler: Crawler):
+        settings = crawler.settings
+        jsonl_path = settings.get('METRICS_JSONL_PATH')
+        port = settings.getint('METRICS_PORT')
+        if not jsonl_path and not port:
+            raise NotConfigured('Neither METRICS_JSONL_PATH nor METRICS_PORT is set')
+        metrics = cls(
+            crawler,
+            jsonl_path,
+            settings.getfloat('METRICS_INTERVAL'),
+            settings.get('METRICS_HOST'),
+            port,
+            settings.getint('METRICS_META_SAMPLE'),
+        )
+        enable_timing()
+        crawler.signals.connect(metrics.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(metrics.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(metrics.request_reached_downloader, signal=signals.request_reached_downloader)
+        crawler.signals.connect(metrics.response_received, signal=signals.response_received)
+        return metrics
+
+    def spider_opened(self, spider):
+        self.started = time.time()
+        if self.jsonl_path:
+            self.file = open(self.jsonl_path, 'a')
+            self.loop = task.LoopingCall(self.export, spider)
+            self.loop.start(self.interval, now=False)
+        if self.port:
+            from twisted.internet import reactor
+            self.listener = reactor.listenTCP(self.port, server.Site(MetricsResource(self)), interface=self.host)
+            logger.info(f'Serving metrics on http://{self.host}:{self.port}/metrics')
+
+    def spider_closed(self, spider, reason):
+        if self.loop and self.loop.running:
+            self.loop.stop()
+        if self.file:
+            self.export(spider)
+            self.file.close()
+        if self.listener:
+            return self.listener.stopListening()
+
+    def request_reached_downloader(self, request, spider):
+        self.requests += 1
+        if not self.meta_sample or self.requests % self.meta_sample:
+            return
+        try:
+            size = len(pickle.dumps(request.meta, protocol=pickle.HIGHEST_PROTOCOL))
+        except Exception:
+            return
+        registry.histogram('request_meta_bytes', SIZE_BUCKETS).observe(size)
+
+    def response_received(self, response, request, spider):
+        slot = request.meta.get('download_slot') or urlparse_cached(request).hostname
+        registry.histogram('download_latency_seconds', slot=slot).observe(request.meta.get('download_latency', 0))
+        registry.inc('responses', slot=slot, status=response.status)
+        registry.histogram('retry_depth', RETRY_BUCKETS).observe(request.meta.get('retry_times', 0))
+
+    def update_gauges(self, exporter):
+        """
+        :param exporter: 'jsonl' or 'prometheus', items_per_second is the rate since the previous export of the exporter
+        """
+        now = time.time()
+        items = self.crawler.stats.get_value('item_scraped_count', 0)
+        last_time, last_items = self.last.get(exporter, (self.started, 0))
+        if now > last_time:
+            registry.set('items_per_second', round((items - last_items) / (now - last_time), 3))
+        self.last[exporter] = (now, items)
+        registry.set('items', items)
+        registry.set('elapsed_seconds', round(now - self.started, 3))
+        engine = self.crawler.engine
+        if engine and engine.downloader:
+            registry.set('in_flight_requests', len(engine.downloader.active))
+
+    def export(self, spider):
+        self.update_gauges('jsonl')
+        line = {'time': time.time(), 'spider': spider.name}
+        line.update(registry.to_dict())
+        self.file.write(json.dumps(line) + '\n')
+        self.file.flush()
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import re
+
+from lxml import etree, html
+
+logger = logging.getLogger(__name__)
+
+base_url = 'https://www.drive2.com{}'
+
+SALE_INFO_FIELDS = ('years', 'mileage', 'engine', 'transmission', 'brand', 'model', 'generation')
+
+# Single pass over the sale description list and the car breadcrumbs links
+SALE_INFO_XPATH = etree.XPath("//div[@class='c-car-forsale']/ul/li | //a[@data-ym-target]")
+
+YM_TARGETS = {
+    'car2brand': 'brand',
+    'car2model': 'model',
+    'car2gen': 'generation',
+}
+LI_MARKERS = (
+    ('years', ('Manufactured', 'Purchased')),
+    ('mileage', ('Mileage',)),
+    ('engine', ('Engine',)),
+    ('transmission', ('Manual', 'Automatic')),
+)
+
+
+def classify_li(text):
+    for field, markers in LI_MARKERS:
+        if any(marker in text for marker in markers):
+            return field
+
+
+def extract_car_sale_info(body):
+    """
+    Parse car sale detail page once and collect raw field values.
+
+    :param body: detail page html
+    :return: dict with SALE_INFO_FIELDS keys, missing fields are None
+    """
+    info = dict.fromkeys(SALE_INFO_FIELDS)
+    tree = html.fromstring(body)
+    for el in SALE_INFO_XPATH(tree):
+        if el.tag == 'a':
+            field = YM_TARGETS.get(el.get('data-ym-target'))
+            text = el.text
+        else:
+            text = el.text_content()
+            field = classify_li(text)
+        if field and info[field] is None and text:
+            info[field] = text.strip()
+    return info
+
+
+CARD_FIELDS = ('price', 'title', 'url', 'image_url', 'geo')
+
+# Plain lxml elements, HtmlElement class lookup is not needed for the cards
+LISTING_PARSER = etree.HTMLParser()
+LISTING_CARDS_XPATH = etree.XPath('/html/body/div/div[contains(@class, "c-car-card-sa")]')
+CARD_SPANS = {
+    'c-car-card-sa__price': 'price',
+    'c-car-title  c-link': 'title',
+}
+
+
+def extract_card(el):
+    """
+    Collect card fields in one walk over the card subtree, the first match of a field wins.
+    Fields are matched at the paths of the card markup: a[@class="u-link-area"], div/div/img,
+    div/div[@class="c-car-card-sa__location"]/span and div//span of CARD_SPANS.
+
+    :param el: c-car-card-sa element
+    :return: dict with CARD_FIELDS keys, missing fields are None
+    """
+    card = dict.fromkeys(CARD_FIELDS)
+    for top in el:
+        if top.tag == 'a':
+            if card['url'] is None and top.get('class') == 'u-link-area':
+                card['url'] = base_url.format(top.get('href'))
+        elif top.tag == 'div':
+            extract_card_div(top, card)
+    return card
+
+
+def extract_card_div(top, card):
+    """
+    :param top: div child of a card
+    :param card: card fields to fill in
+    """
+    for child in top.iter('span', 'img', 'div'):
+        tag = child.tag
+        if tag == 'span':
+            field = CARD_SPANS.get(child.get('class'))
+            if field and card[field] is None:
+                card[field] = child.text
+        elif tag == 'div':
+            if card['geo'] is None and child.get('class') == 'c-car-card-sa__location' and child.getparent() is top:
+                span = child.find('span')
+                if span is not None:
+                    card['geo'] = span.text
+        elif card['image_url'] is None:
+            parent = child.getparent()
+            if parent.tag == 'div' and parent.getparent() is top:
+                card['image_url'] = child.get('src')
+
+
+def extract_listing_cards(s):
+    """
+    :param s: html of a carsearch page
+    :return: list of card dicts (price, title, url, image_url, geo) of cards having a title
+    """
+    cards = []
+    try:
+        tree = etree.fromstring(s, LISTING_PARSER)
+        if tree is None:
+            return cards
+        for el in LISTING_CARDS_XPATH(tree):
+            card = extract_card(el)
+            if card['title']:
+                cards.append(card)
+    except Exception as e:
+        logger.error(f'Failed to parse body. Error: {e}')
+    return cards
+
+
+BRAND_LINKS_XPATH = etree.XPath('//a[starts-with(@href, "/cars/")]')
+BRAND_HREF_RE = re.compile(r'^/cars/([a-z0-9_-]+)/?$')
+BRAND_CONTEXT_RE = re.compile(r'\bb_\d+\b')
+
+
+def parse_brand_catalog(body):
+    """
+    :param body: html of drive2's car catalog page
+    :return: dict of brand name -> carsearch context id, of brand links carrying the context id
+        in one of their attributes
+    """
+    brands = {}
+    tree = etree.fromstring(body, LISTING_PARSER) if body else None
+    if tree is None:
+        return brands
+    for el in BRAND_LINKS_XPATH(tree):
+        match = BRAND_HREF_RE.match(el.get('href'))
+        if not match:
+            continue
+        for value in el.attrib.values():
+            context = BRAND_CONTEXT_RE.search(value)
+            if context:
+                brands.setdefault(match.group(1), context.group())
+                break
+    return brands
+
+
+def parse_listing_page(body):
+    """
+    :param body: carsearch.cshtml json response body
+    :return: tuple of (next start offset, list of cards)
+    """
+    d = json.loads(body.strip())
+    return d.get('start', None), extract_listing_cards(d['html'])
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+import hashlib
+from weakref import WeakKeyDictionary
+
+from scrapy.utils.python import to_bytes
+from w3lib.url import canonicalize_url
+
+
+class LegacyRequestFingerprinter:
+    """
+    Request fingerprints of scrapy.utils.request.request_fingerprint, which Scrapy 2.13 removed:
+    sha1 of the method, the canonical url and the body. The url_fingerprint of items is the downstream
+    key of a listing, and the persistent dupefilter, the incremental listing index, the change snapshots
+    and the http cache are keyed by it, so fingerprints must not change with the Scrapy version.
+    """
+
+    def __init__(self):
+        self.cache = WeakKeyDictionary()
+
+    def fingerprint(self, request):
+        """
+        :return: 20 bytes sha1 digest, its hex digest is the url_fingerprint of items
+        """
+        if request not in self.cache:
+            fp = hashlib.sha1()
+            fp.update(to_bytes(request.method))
+            fp.update(to_bytes(canonicalize_url(request.url)))
+            fp.update(request.body or b'')
+            self.cache[request] = fp.digest()
+        return self.cache[request]
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import pickle
+import struct
+import time
+import zlib
+
+from scrapy.extensions.httpcache import DummyPolicy
+from scrapy.http import Headers
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.httpobj import urlparse_cached
+from scrapy.utils.project import data_path
+
+logger = logging.getLogger(__name__)
+
+# Throttling responses are never cached, whatever HTTPCACHE_IGNORE_HTTP_CODES is
+NEVER_CACHE_CODES = (429, 403)
+
+# request fingerprint, store time, length of the compressed record
+RECORD_HEADER = struct.Struct('<20sdI')
+
+
+class ListingAwarePolicy(DummyPolicy):
+    """
+    Caches everything but 429/403 responses. Cached carsearch.cshtml listing pages are fresh
+    for HTTPCACHE_LISTING_TTL seconds, detail pages (keyed by the request fingerprint, which is
+    the item url_fingerprint) for HTTPCACHE_DETAIL_TTL. Other responses, e.g. images,
+    expire after HTTPCACHE_EXPIRATION_SECS as usual. Requests with `refresh` meta key are always fetched.
+    """
+
+    def __init__(self, settings):
+        super().__init__(settings)
+        self.listing_ttl = settings.getint('HTTPCACHE_LISTING_TTL')
+        self.detail_ttl = settings.getint('HTTPCACHE_DETAIL_TTL')
+
+    def ttl(self, request):
+        if urlparse_cached(request).path.endswith('carsearch.cshtml'):
+            return self.listing_ttl
+        if request.meta.get('persist_fingerprint'):
+            return self.detail_ttl
+        return 0
+
+    def should_cache_response(self, response, request):
+        return response.status not in NEVER_CACHE_CODES and super().should_cache_response(response, request)
+
+    def is_cached_response_fresh(self, cachedresponse, request):
+        if request.meta.get('refresh'):
+            return False
+        ttl = self.ttl(request)
+        stored = request.meta.get('cache_timestamp')
+        return not ttl or stored is None or time.time() - stored < ttl
+
+
+class LogCacheStorage:
+    """
+    Appends zlib compressed responses to a single HTTPCACHE_DIR/<spider>.log file and keeps
+    an index of fingerprint -> (offset, length, store time) in memory.
+
+    The index is saved to <spider>.idx on close, records written after the saved index
+    (e.g. by a crashed run) are recovered by scanning the end of the log on open.
+    Replaced and expired records are dropped on close once they take HTTPCACHE_COMPACT_RATIO of the log.
+    """
+
+    def __init__(self, settings):
+        self.cachedir = data_path(settings['HTTPCACHE_DIR'], createdir=True)
+        self.expiration_secs = settings.getint('HTTPCACHE_EXPIRATION_SECS')
+        self.compress_level = settings.getint('HTTPCACHE_COMPRESS_LEVEL', 3)
+        self.compact_ratio = settings.getfloat('HTTPCACHE_COMPACT_RATIO', 0.5)
+        self.index = {}
+        self.size = 0
+        self.dead = 0
+        self.log_path = None
+        self.index_path = None
+        self.writer = None
+        self.reader = None
+        self._fingerprinter = None
+
+    def open_spider(self, spider):
+        self.log_path = os.path.join(self.cachedir, f'{spider.name}.log')
+        self.index_path = os.path.join(self.cachedir, f'{spider.name}.idx')
+        self._fingerprinter = spider.crawler.request_fingerprinter
+        open(self.log_path, 'ab').close()
+        self.load_index()
+        self.writer = open(self.log_path, 'ab')
+        self.reader = open(self.log_path, 'rb')
+        logger.info(f'Using log cache storage {self.log_path}: {len(self.index)} responses')
+
+    def close_spider(self, spider):
+        if self.dead > self.size * self.compact_ratio:
+            self.compact()
+        self.save_index()
+        self.writer.close()
+        self.reader.close()
+
+    def load_index(self):
+        size = os.path.getsize(self.log_path)
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, 'rb') as f:
+                    self.size, self.dead, self.index = pickle.load(f)
+            except (OSError, ValueError, EOFError, pickle.UnpicklingError) as e:
+                logger.error(f'Could not load cache index {self.index_path}, rebuilding it: {e}')
+                self.size, self.dead, self.index = 0, 0, {}
+        if self.size > size:
+            logger.error(f'Cache log {self.log_path} is shorter than its index, rebuilding it')
+            self.size, self.dead, self.index = 0, 0, {}
+        if self.size < size:
+            self.scan(size)
+
+    def scan(self, size):
+        with open(self.log_path, 'rb') as f:
+            f.seek(self.size)
+            while self.size + RECORD_HEADER.size <= size:
+                key, ts, length = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+                if self.size + RECORD_HEADER.size + length > size:
+                    break
+                f.seek(length, os.SEEK_CUR)
+                self._add(key, ts, length)
+        if self.size < size:
+            logger.warning(f'Dropping {size - self.size} bytes of a partially written record from {self.log_path}')
+            with open(self.log_path, 'r+b') as f:
+                f.truncate(self.size)
+
+    def save_index(self):
+        path = self.index_path + '.tmp'
+        with open(path, 'wb') as f:
+            pickle.dump((self.size, self.dead, self.index), f, protocol=4)
+        os.replace(path, self.index_path)
+
+    def _add(self, key, ts, length):
+        previous = self.index.get(key)
+        if previous is not None:
+            self.dead += RECORD_HEADER.size + previous[1]
+        self.index[key] = (self.size + RECORD_HEADER.size, length, ts)
+        self.size += RECORD_HEADER.size + length
+
+    def _expired(self, ts, now):
+        return 0 < self.expiration_secs < now - ts
+
+    def compact(self):
+        path = self.log_path + '.tmp'
+        now = time.time()
+        live = sorted((entry, key) for key, entry in self.index.items() if not self._expired(entry[2], now))
+        self.writer.flush()
+        self.index, self.size, self.dead = {}, 0, 0
+        with open(path, 'wb') as f:
+            for (offset, length, ts), key in live:
+                self.reader.seek(offset)
+                f.write(RECORD_HEADER.pack(key, ts, length) + self.reader.read(length))
+                self._add(key, ts, length)
+        os.replace(path, self.log_path)
+        logger.info(f'Compacted {self.log_path}: {len(self.index)} responses, {self.size} bytes')
+
+    def retrieve_response(self, spider, request):
+        entry = self.index.get(self._fingerprinter.fingerprint(request))
+        if entry is None:
+            return None
+        offset, length, ts = entry
+        if self._expired(ts, time.time()):
+            return None
+        self.reader.seek(offset)
+        data = pickle.loads(zlib.decompress(self.reader.read(length)))
+        request.meta['cache_timestamp'] = ts
+        headers = Headers(data['headers'])
+        respcls = responsetypes.from_args(headers=headers, url=data['url'], body=data['body'])
+        return respcls(url=data['url'], headers=headers, status=data['status'], body=data['body'])
+
+    def store_response(self, spider, request, response):
+        key = self._fingerprinter.fingerprint(request)
+        data = {
+            'url': response.url,
+            'status': response.status,
+            'headers': dict(response.headers),
+            'body': response.body,
+        }
+        record = zlib.compress(pickle.dumps(data, protocol=4), self.compress_level)
+        ts = time.time()
+        self.writer.write(RECORD_HEADER.pack(key, ts, len(record)) + record)
+        self.writer.flush()
+        self._add(key, ts, len(record))
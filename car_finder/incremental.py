@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import dbm
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+CARD_FIELDS = ('price', 'title', 'geo', 'image_url')
+
+
+class ListingIndex:
+    """
+    Persistent listing url -> (request fingerprint, list card fields) index
+    used by incremental crawls to skip detail pages of unchanged listings.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = None
+
+    @classmethod
+    def from_settings(cls, settings):
+        path = settings.get('INCREMENTAL_INDEX_PATH')
+        if path:
+            return cls(path)
+
+    def open(self):
+        self.db = dbm.open(self.path, 'c')
+        logger.info(f'Opened listing index: {self.path}')
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def get(self, url):
+        try:
+            return json.loads(self.db[url.encode()])
+        except KeyError:
+            return None
+
+    def lookup(self, card):
+        """
+        :return: tuple of (status, fingerprint), status is one of 'new', 'changed', 'unchanged'
+        """
+        entry = self.get(card['url'])
+        if entry is None:
+            return 'new', None
+        if all(entry['card'].get(field) == card.get(field) for field in CARD_FIELDS):
+            return 'unchanged', entry['fingerprint']
+        return 'changed', entry['fingerprint']
+
+    def remember(self, card, fingerprint):
+        entry = {'fingerprint': fingerprint, 'card': {field: card.get(field) for field in CARD_FIELDS}}
+        self.db[card['url'].encode()] = json.dumps(entry)
@@ -4,18 +4,14 @@
 #
 # See documentation in:
 # https://doc.scrapy.org/en/latest/topics/items.html
-import re
+from dataclasses import dataclass
+from typing import Optional
+
 import scrapy
 from itemloaders.processors import TakeFirst, MapCompose
 
-from car_finder import settings
-
-
-def extract_price(value):
-    if '$' in value:
-        return int(''.join([char for char in value if char.isdigit()])) * settings.RUB_IN_USD
-    elif '₽' in value:
-        return int(''.join([char for char in value if char.isdigit()]))
+from car_finder.normalizers import (extract_capacity, extract_engine_type, extract_horse_power, extract_manufactured,
+                                    extract_mileage, extract_price, extract_purchased, extract_transmission)
 
 
 def get_city(value):
@@ -32,20 +28,6 @@ def get_country(value):
         pass
 
 
-def extract_manufactured(value):
-    try:
-        return int(re.template('manufactured in (\d\d\d\d)', flags=re.IGNORECASE).findall(value)[0])
-    except IndexError:
-        pass
-
-
-def extract_purchased(value):
-    try:
-        return int(re.template('purchased in (\d\d\d\d)', flags=re.IGNORECASE).findall(value)[0])
-    except IndexError:
-        pass
-
-
 class CarItem(scrapy.Item):
     url_fingerprint = scrapy.Field(output_processor=TakeFirst())
     model = scrapy.Field(output_processor=TakeFirst())
@@ -60,6 +42,14 @@ class CarItem(scrapy.Item):
     url = scrapy.Field(output_processor=TakeFirst())
     image_urls = scrapy.Field()
     images = scrapy.Field()
+    profile = scrapy.Field(output_processor=TakeFirst())
+
+
+class ListingStatusItem(scrapy.Item):
+    url_fingerprint = scrapy.Field()
+    url = scrapy.Field()
+    price = scrapy.Field()
+    status = scrapy.Field()
 
 
 class BaseNameableItem(scrapy.Item):
@@ -93,22 +83,101 @@ class Car(scrapy.Item):
 
 
 class CarProfile(BaseNameableItem):
-    car = scrapy.Field()
+    car = scrapy.Field(output_processor=TakeFirst())
     title = scrapy.Field(output_processor=TakeFirst())
     manufactured = scrapy.Field(input_processor=MapCompose(extract_manufactured), output_processor=TakeFirst(), )
     purchased = scrapy.Field(input_processor=MapCompose(extract_purchased), output_processor=TakeFirst(), )
-    city = scrapy.Field()
-    country = scrapy.Field()
-    capacity = scrapy.Field()
-    mileage = scrapy.Field()
-    horse_power = scrapy.Field()
-    engine_type = scrapy.Field()
-    gear_type = scrapy.Field()
-    transmission = scrapy.Field()
-    url_fingerprint = scrapy.Field()
-    url = scrapy.Field()
+    city = scrapy.Field(input_processor=MapCompose(get_city), output_processor=TakeFirst())
+    country = scrapy.Field(input_processor=MapCompose(get_country), output_processor=TakeFirst())
+    capacity = scrapy.Field(input_processor=MapCompose(extract_capacity), output_processor=TakeFirst())
+    mileage = scrapy.Field(input_processor=MapCompose(extract_mileage), output_processor=TakeFirst())
+    horse_power = scrapy.Field(input_processor=MapCompose(extract_horse_power), output_processor=TakeFirst())
+    engine_type = scrapy.Field(input_processor=MapCompose(extract_engine_type), output_processor=TakeFirst())
+    gear_type = scrapy.Field(output_processor=TakeFirst())
+    transmission = scrapy.Field(input_processor=MapCompose(extract_transmission), output_processor=TakeFirst())
+    url_fingerprint = scrapy.Field(output_processor=TakeFirst())
+    url = scrapy.Field(output_processor=TakeFirst())
 
 
 class CarSaleItem(scrapy.Item):
     car_profile = scrapy.Field()
     price = scrapy.Field()
+
+
+def normalize(func, value):
+    if value is not None:
+        return func(value)
+
+
+@dataclass
+class CarRecord:
+    """
+    Compact eagerly normalized car sale, converted to CarItem by CarRecordPipeline.
+    """
+    __slots__ = ('url_fingerprint', 'url', 'title', 'price', 'city', 'country', 'image_urls',
+                 'brand', 'model', 'generation', 'manufactured', 'purchased', 'profile')
+    url_fingerprint: str
+    url: str
+    title: str
+    price: Optional[int]
+    city: Optional[str]
+    country: Optional[str]
+    image_urls: list
+    brand: Optional[str]
+    model: Optional[str]
+    generation: Optional[str]
+    manufactured: Optional[int]
+    purchased: Optional[int]
+    profile: Optional[dict]
+
+    @classmethod
+    def from_card(cls, card, info, fingerprint):
+        """
+        :param card: list card fields (price, title, url, image_url, geo)
+        :param info: detail page fields, see car_finder.extractors.extract_car_sale_info
+        """
+        city = normalize(get_city, card['geo'])
+        country = normalize(get_country, card['geo'])
+        manufactured = normalize(extract_manufactured, info['years'])
+        purchased = normalize(extract_purchased, info['years'])
+        engine = info['engine']
+        return cls(
+            url_fingerprint=fingerprint,
+            url=card['url'],
+            title=card['title'],
+            price=normalize(extract_price, card['price']),
+            city=city,
+            country=country,
+            image_urls=[card['image_url']] if card['image_url'] else [],
+            brand=info['brand'],
+            model=info['model'],
+            generation=info['generation'],
+            manufactured=manufactured,
+            purchased=purchased,
+            profile=dict(
+                name=card['title'],
+                title=card['title'],
+                url=card['url'],
+                url_fingerprint=fingerprint,
+                car=dict(model=info['model'], generation=info['generation']),
+                manufactured=manufactured,
+                purchased=purchased,
+                city=city,
+                country=country,
+                mileage=normalize(extract_mileage, info['mileage']),
+                capacity=normalize(extract_capacity, engine),
+                horse_power=normalize(extract_horse_power, engine),
+                engine_type=normalize(extract_engine_type, engine),
+                transmission=normalize(extract_transmission, info['transmission']),
+            ),
+        )
+
+    def to_item(self):
+        item = CarItem()
+        for field in self.__slots__:
+            value = getattr(self, field)
+            if value is not None:
+                item[field] = value
+        if self.profile is not None:
+            item['profile'] = CarProfile({field: value for field, value in self.profile.items() if value is not None})
+        return item
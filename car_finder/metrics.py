@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+import bisect
+import functools
+import inspect
+import time
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+RETRY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50)
+
+
+class Histogram:
+    """
+    Prometheus style histogram with fixed upper bounds of buckets.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """
+        :return: list of (upper bound, count of values <= bound), the last bound is +Inf
+        """
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def quantile(self, q):
+        """
+        :return: upper bound of the bucket holding the q-quantile, None without observations
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        for bound, total in self.cumulative():
+            if total >= rank:
+                return bound
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+        }
+
+
+def series(name, labels):
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{key}="{value}"' for key, value in sorted(labels.items())) + '}'
+
+
+class Registry:
+    """
+    Counters, gauges and histograms by series name, e.g. `download_latency_seconds{slot="proxy:tor1"}`.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.types = {}
+
+    def inc(self, name, value=1, **labels):
+        key = series(name, labels)
+        self.types[name] = 'counter'
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        self.types[name] = 'gauge'
+        self.gauges[series(name, labels)] = value
+
+    def histogram(self, name, buckets=LATENCY_BUCKETS, **labels):
+        key = series(name, labels)
+        if key not in self.histograms:
+            self.types[name] = 'histogram'
+            self.histograms[key] = (name, labels, Histogram(buckets))
+        return self.histograms[key][2]
+
+    def to_dict(self):
+        return {
+            'counters': dict(self.counters),
+            'gauges': dict(self.gauges),
+            'histograms': {key: histogram.to_dict() for key, (_, _, histogram) in self.histograms.items()},
+        }
+
+    def to_prometheus(self, prefix):
+        lines = []
+        for name, kind in sorted(self.types.items()):
+            lines.append(f'# TYPE {prefix}_{name} {kind}')
+            if kind == 'histogram':
+                for key, (hist_name, labels, histogram) in sorted(self.histograms.items()):
+                    if hist_name != name:
+                        continue
+                    for bound, total in histogram.cumulative():
+                        le = '+Inf' if bound == float('inf') else bound
+                        lines.append(f'{prefix}_{series(name + "_bucket", dict(labels, le=le))} {total}')
+                    lines.append(f'{prefix}_{series(name + "_sum", labels)} {histogram.sum}')
+                    lines.append(f'{prefix}_{series(name + "_count", labels)} {histogram.count}')
+                continue
+            values = self.counters if kind == 'counter' else self.gauges
+            for key, value in sorted(values.items()):
+                if key == name or key.startswith(name + '{'):
+                    lines.append(f'{prefix}_{key} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+class SelfTime:
+    """
+    Context manager timing a step of a callback without the timed steps nested in it, e.g. a timed
+    generator iterated by another timed callback, so nested callbacks are not counted twice.
+    """
+    # time of the timed steps finished inside the running one
+    nested = 0
+
+    def __init__(self):
+        self.elapsed = 0
+        self.outer = 0
+        self.start = 0
+
+    def __enter__(self):
+        self.outer, SelfTime.nested = SelfTime.nested, 0
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        total = time.perf_counter() - self.start
+        self.elapsed = total - SelfTime.nested
+        SelfTime.nested = self.outer + total
+
+
+class TimedSteps:
+    """
+    Awaitable measuring time the wrapped awaitable runs on the calling thread,
+    time spent waiting on the awaited results (e.g. offloaded parsing) is not included.
+    """
+
+    def __init__(self, awaitable):
+        self.awaitable = awaitable
+        self.elapsed = 0
+
+    def __await__(self):
+        steps = self.awaitable.__await__()
+        value, error = None, None
+        while True:
+            clock = SelfTime()
+            try:
+                with clock:
+                    yielded = steps.throw(error) if error is not None else steps.send(value)
+            except StopIteration as e:
+                return e.value
+            finally:
+                self.elapsed += clock.elapsed
+            try:
+                value, error = (yield yielded), None
+            except GeneratorExit:
+                steps.close()
+                raise
+            except BaseException as e:
+                value, error = None, e
+
+
+# callbacks decorated with timed are timed only once CrawlMetrics is enabled
+timing_enabled = False
+
+
+def enable_timing(enabled=True):
+    global timing_enabled
+    timing_enabled = enabled
+
+
+def timed(name=None):
+    """
+    Records self time of a spider callback to `callback_seconds{callback=name}` histogram: time spent
+    in other timed callbacks it calls is recorded for them only. Works for plain, generator and
+    async generator callbacks, generators are timed per step. The callback is called as is
+    unless timing is enabled, see enable_timing.
+    """
+
+    def decorator(func):
+        callback = name or func.__name__
+
+        if inspect.isasyncgenfunction(func):
+            async def timed_func(histogram, *args, **kwargs):
+                results = func(*args, **kwargs)
+                elapsed = 0
+                try:
+                    while True:
+                        step = TimedSteps(results.__anext__())
+                        try:
+                            result = await step
+                        except StopAsyncIteration:
+                            break
+                        finally:
+                            elapsed += step.elapsed
+                        yield result
+                finally:
+                    await results.aclose()
+                    histogram.observe(elapsed)
+        elif inspect.isgeneratorfunction(func):
+            def timed_func(histogram, *args, **kwargs):
+                results = func(*args, **kwargs)
+                elapsed = 0
+                try:
+                    while True:
+                        clock = SelfTime()
+                        try:
+                            with clock:
+                                result = next(results)
+                        except StopIteration:
+                            break
+                        finally:
+                            elapsed += clock.elapsed
+                        yield result
+                finally:
+                    results.close()
+                    histogram.observe(elapsed)
+        else:
+            def timed_func(histogram, *args, **kwargs):
+                clock = SelfTime()
+                try:
+                    with clock:
+                        return func(*args, **kwargs)
+                finally:
+                    histogram.observe(clock.elapsed)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not timing_enabled:
+                return func(*args, **kwargs)
+            histogram = registry.histogram('callback_seconds', LATENCY_BUCKETS, callback=callback)
+            return timed_func(histogram, *args, **kwargs)
+        return wrapper
+
+    return decorator
@@ -7,13 +7,22 @@
 import time
 import logging
 
+from urllib.parse import urlparse
+
 import requests
 from lxml import html
 from stem import Signal
 from stem.control import Controller
+from twisted.internet import defer, threads
+from twisted.python.failure import Failure
 
+from scrapy import signals
 from scrapy.crawler import Crawler
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.defer import maybe_deferred_to_future
+from scrapy.utils.misc import load_object
 from scrapy.downloadermiddlewares.retry import RetryMiddleware
+from scrapy.utils.httpobj import urlparse_cached
 from scrapy.utils.response import response_status_message
 
 from car_finder.settings import TOR_PROXY
@@ -21,71 +30,136 @@ from car_finder.settings import TOR_PROXY
 logger = logging.getLogger(__name__)
 
 
+class RingBuffer:
+    """
+    Fixed-size buffer of the last `size` values with O(1) running mean.
+    """
+
+    def __init__(self, size):
+        self.values = [0.0] * size
+        self.size = size
+        self.count = 0
+        self.index = 0
+        self.total = 0.0
+
+    def append(self, value):
+        self.total += value - self.values[self.index]
+        self.values[self.index] = value
+        self.index = (self.index + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def __len__(self):
+        return self.count
+
+
+class SlotThrottle:
+    """
+    AIMD download slot controller: delay is multiplied and concurrency halved
+    on 429/403, delay is decreased and concurrency increased additively while
+    the error rate and latency of the last responses stay under the targets.
+    """
+
+    def __init__(self, settings):
+        window = settings.getint('THROTTLE_WINDOW')
+        self.errors = RingBuffer(window)
+        self.latencies = RingBuffer(window)
+        self.delay = settings.getfloat('DOWNLOAD_DELAY')
+        self.min_delay = settings.getfloat('THROTTLE_MIN_DELAY')
+        self.max_delay = settings.getfloat('THROTTLE_MAX_DELAY')
+        self.delay_step = settings.getfloat('THROTTLE_DELAY_STEP')
+        self.backoff = settings.getfloat('THROTTLE_BACKOFF')
+        self.target_error_rate = settings.getfloat('THROTTLE_TARGET_ERROR_RATE')
+        self.target_latency = settings.getfloat('THROTTLE_TARGET_LATENCY')
+        self.max_concurrency = settings.getint('THROTTLE_MAX_CONCURRENCY')
+        self.concurrency = self.max_concurrency
+        self.successes = 0
+        self.last_backoff = 0
+
+    def error_rate(self):
+        return self.errors.mean()
+
+    def latency(self):
+        return self.latencies.mean()
+
+    def on_error(self, latency):
+        self.errors.append(1)
+        self.latencies.append(latency)
+        now = time.time()
+        # responses already in flight when backing off should not back off again
+        if now - self.last_backoff < self.delay + self.latency():
+            return
+        self.last_backoff = now
+        self.successes = 0
+        self.delay = min(max(self.delay * self.backoff, self.delay_step), self.max_delay)
+        self.concurrency = max(self.concurrency // 2, 1)
+
+    def on_success(self, latency):
+        self.errors.append(0)
+        self.latencies.append(latency)
+        if self.error_rate() > self.target_error_rate:
+            return
+        if self.target_latency and self.latency() > self.target_latency:
+            return
+        self.delay = max(self.delay - self.delay_step, self.min_delay)
+        self.successes += 1
+        if self.successes >= self.concurrency and self.concurrency < self.max_concurrency:
+            self.concurrency += 1
+            self.successes = 0
+
+
 class TooManyRequestsRetryMiddleware(RetryMiddleware):
-    TRACK_LAST_ERRORS = 10
-    WITHOUT_ERR_THRESHOLD = 30
+    THROTTLE_HTTP_CODES = (429, 403)
 
     def __init__(self, settings):
         super(TooManyRequestsRetryMiddleware, self).__init__(settings)
-        self.errors = []
-        self.last_err_rate = 0
-        self.delay = 0
-        self.delay_inc = 0.05
-        self.last_decrease_time = 0
+        self.settings = settings
+        self.throttle_enabled = settings.getbool('THROTTLE_ENABLED')
+        self.throttles = {}
 
     @classmethod
     def from_crawler(cls, crawler: Crawler):
         cls.crawler = crawler
         return cls(crawler.settings)
 
-    def get_error_rate(self):
-        if len(self.errors) < self.TRACK_LAST_ERRORS:
-            return 0
-        timedelta = self.errors[-1] - self.errors[-self.TRACK_LAST_ERRORS]
-        return self.TRACK_LAST_ERRORS / timedelta
-
-    def track_error(self):
-        if len(self.errors) > self.TRACK_LAST_ERRORS:
-            self.errors = self.errors[-self.TRACK_LAST_ERRORS:]
-        self.errors.append(time.time())
-
-    def compute_delay(self):
-        rate = self.get_error_rate()
-        base_delay_inc = self.delay_inc
-        rate_diff = rate - self.last_err_rate
-        delay_inc = min(base_delay_inc * max(abs(rate_diff), 0.1), base_delay_inc)
-        if rate_diff <= 0 and rate < 0.05 and self.delay > delay_inc:
-            self.delay -= delay_inc
-            # logger.info(f'Decreasing delay: {self.delay:.2f} (-{delay_inc})')
-        else:
-            self.delay += delay_inc
-            # logger.info(f'Increasing delay: {self.delay:.2f} (+{delay_inc})')
-        self.last_err_rate = rate
-        return self.delay
-
     def _get_slot(self, request):
-        key = request.meta.get('download_slot')
+        key = request.meta.get('download_slot') or urlparse_cached(request).hostname
         return key, self.crawler.engine.downloader.slots.get(key)
 
-    def _decrease_delay(self, slot):
-        now = time.time()
-        if self.errors and (now - self.errors[-1]) > self.WITHOUT_ERR_THRESHOLD and (now - self.last_decrease_time) > self.WITHOUT_ERR_THRESHOLD:
-            # logger.info(f'Decreasing delay: {self.delay}')
-            slot.delay = self.compute_delay()
-            self.last_decrease_time = now
+    def _throttle(self, request, response):
+        key, slot = self._get_slot(request)
+        if key not in self.throttles:
+            self.throttles[key] = SlotThrottle(self.settings)
+        throttle = self.throttles[key]
+        latency = request.meta.get('download_latency', 0)
+        if response.status in self.THROTTLE_HTTP_CODES:
+            throttle.on_error(latency)
+        else:
+            throttle.on_success(latency)
+        if slot is not None:
+            slot.delay = throttle.delay
+            slot.concurrency = throttle.concurrency
+        stats = self.crawler.stats
+        stats.set_value(f'throttle/{key}/delay', round(throttle.delay, 3))
+        stats.set_value(f'throttle/{key}/concurrency', throttle.concurrency)
+        stats.set_value(f'throttle/{key}/error_rate', round(throttle.error_rate(), 3))
+        stats.set_value(f'throttle/{key}/latency', round(throttle.latency(), 3))
+        return throttle
 
     def process_request(self, request, spider):
         if TOR_PROXY:
             request.meta["proxy"] = TOR_PROXY
 
     def process_response(self, request, response, spider):
-        # key, slot = self._get_slot(request)
+        # cached responses say nothing about the site load
+        cached = 'cached' in response.flags
+        throttle = self._throttle(request, response) if self.throttle_enabled and not cached else None
         if request.meta.get('dont_retry', False):
             return response
         elif response.status == 429:
-            logger.info(f'Got 429, rate: {self.get_error_rate()}')
-            self.track_error()
-            # slot.delay = self.compute_delay()
+            logger.info(f'Got 429, rate: {throttle.error_rate() if throttle else 0:.2f}')
             request.meta['max_retry_times'] = 1000
             reason = response_status_message(response.status)
             return self._retry(request, reason, spider) or response
@@ -95,30 +169,133 @@ class TooManyRequestsRetryMiddleware(RetryMiddleware):
         elif response.status == 403:
             logger.info('Got 403')
             request.meta['max_retry_times'] = 1000
-        # self._decrease_delay(slot)
 
         return response
 
 
+class ProxyState:
+    def __init__(self, url, window):
+        self.url = url
+        self.name = urlparse(url).hostname or url
+        self.slot = f'proxy:{self.name}'
+        self.errors = RingBuffer(window)
+        self.latencies = RingBuffer(window)
+        self.in_flight = 0
+        self.assigned = 0
+        self.quarantined_until = 0
+
+    def rank(self):
+        # expected wait for a new request, least used proxy first on ties
+        return (self.in_flight + 1) * max(self.latencies.mean(), 0.1), self.assigned
+
+
+class ProxyPoolMiddleware:
+    """
+    Spreads requests over PROXY_POOL backends, each with its own download slot.
+    A proxy whose error rate goes over PROXY_POOL_MAX_ERROR_RATE stops getting
+    new requests (in-flight ones drain) for PROXY_POOL_QUARANTINE seconds.
+    Errors are 429/403 responses and the transport errors of RETRY_EXCEPTIONS,
+    other exceptions (e.g. IgnoreRequest) say nothing about the proxy.
+    """
+    ERROR_HTTP_CODES = (429, 403)
+
+    def __init__(self, settings, stats):
+        self.stats = stats
+        self.window = settings.getint('PROXY_POOL_WINDOW')
+        self.max_error_rate = settings.getfloat('PROXY_POOL_MAX_ERROR_RATE')
+        self.quarantine = settings.getfloat('PROXY_POOL_QUARANTINE')
+        self.proxy_errors = tuple(load_object(error) if isinstance(error, str) else error
+                                  for error in settings.getlist('RETRY_EXCEPTIONS'))
+        self.proxies = {state.url: state for state in (ProxyState(url, self.window) for url in settings.getlist('PROXY_POOL'))}
+
+    @classmethod
+    def from_crawler(cls, crawler: Crawler):
+        if not crawler.settings.getlist('PROXY_POOL'):
+            raise NotConfigured('PROXY_POOL is empty')
+        return cls(crawler.settings, crawler.stats)
+
+    def choose(self):
+        now = time.time()
+        available = [state for state in self.proxies.values() if state.quarantined_until <= now]
+        if not available:
+            return min(self.proxies.values(), key=lambda state: state.quarantined_until)
+        return min(available, key=ProxyState.rank)
+
+    def process_request(self, request, spider):
+        state = self.choose()
+        state.in_flight += 1
+        state.assigned += 1
+        request.meta['proxy'] = state.url
+        request.meta['download_slot'] = state.slot
+        request.meta['proxy_pool_url'] = state.url
+
+    def _done(self, request, error):
+        state = self.proxies.get(request.meta.pop('proxy_pool_url', None))
+        if state is None:
+            return
+        state.in_flight -= 1
+        if error is None:
+            return
+        state.errors.append(1 if error else 0)
+        state.latencies.append(request.meta.get('download_latency', 0))
+        if error and len(state.errors) >= self.window // 2 and state.errors.mean() >= self.max_error_rate \
+                and state.quarantined_until <= time.time():
+            logger.info(f'Quarantine proxy {state.name}: error rate {state.errors.mean():.2f}')
+            state.quarantined_until = time.time() + self.quarantine
+            state.errors = RingBuffer(self.window)
+            self.stats.inc_value(f'proxy/{state.name}/quarantined')
+        self.stats.set_value(f'proxy/{state.name}/error_rate', round(state.errors.mean(), 3))
+        self.stats.set_value(f'proxy/{state.name}/latency', round(state.latencies.mean(), 3))
+
+    def process_response(self, request, response, spider):
+        # a cached response was not fetched through the proxy
+        cached = 'cached' in response.flags
+        self._done(request, None if cached else response.status in self.ERROR_HTTP_CODES)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        self._done(request, True if isinstance(exception, self.proxy_errors) else None)
+
+
 class ConnectionManager:
-    def __init__(self, tor_passw):
-        self.current_identity = None
+    """
+    Controls one Tor instance. Identity rotation runs in the reactor thread pool,
+    concurrent rotation requests wait for the same rotation.
+    """
+    MAX_ATTEMPTS = 20
+
+    def __init__(self, proxy, control_host, control_port, tor_passw):
+        self.proxy = proxy
+        self.control_host = control_host
+        self.control_port = control_port
         self.passw = tor_passw
-        self.controller = Controller.from_port(port=9900)
-        self.controller.authenticate(password='JlzLCVylvNsa1LsvCU')
+        self.controller = None
+        self.current_identity = None
+        self.waiters = None
+
+    def _get_controller(self):
+        if self.controller is None:
+            self.controller = Controller.from_port(address=self.control_host, port=self.control_port)
+            self.controller.authenticate(password=self.passw)
+        return self.controller
 
     def _get_connection(self):
         """
-        TOR new connection
+        TOR new connection, waits for the NEWNYM rate limit of the Tor instance
         """
-        self.controller.signal(Signal.NEWNYM)
+        controller = self._get_controller()
+        wait = controller.get_newnym_wait()
+        if wait > 0:
+            time.sleep(wait)
+        controller.signal(Signal.NEWNYM)
 
-    def __del__(self):
-        logger.info('Closing TOR connection manager')
-        self.controller.close()
+    def close(self):
+        if self.controller is not None:
+            logger.info(f'Closing TOR connection manager {self.control_host}:{self.control_port}')
+            self.controller.close()
+            self.controller = None
 
-    @staticmethod
-    def request(url):
+    def request(self, url):
         """
         TOR communication through local proxy
         :param url: web page to parser
@@ -126,8 +303,8 @@ class ConnectionManager:
         """
         try:
             return requests.get(url, proxies={
-                'http': TOR_PROXY,
-                'https': TOR_PROXY,
+                'http': self.proxy,
+                'https': self.proxy,
             }, timeout=5)
         except (requests.Timeout, requests.ConnectionError):
             pass
@@ -141,41 +318,86 @@ class ConnectionManager:
             except Exception as e:
                 logger.error(f'Could not parse ip addr from response: {e}')
 
-    def new_identity(self):
-        logger.info(f'Requesting new identity')
-        start = time.time()
+    def _new_identity(self):
         old_id = self.current_identity
-        counter = 0
-        while True:
-            counter += 1
+        new_id = None
+        for counter in range(1, self.MAX_ATTEMPTS + 1):
             self._get_connection()
             new_id = self.get_current_identity()
             if new_id and new_id != old_id:
                 break
-            time.sleep(0.1)
         self.current_identity = new_id
-        logger.info(f'Got new identity: {new_id}, {counter} iterations, {time.time() - start:.2f}sec')
+        return new_id, counter
+
+    @property
+    def rotating(self):
+        return self.waiters is not None
+
+    def new_identity(self):
+        """
+        :return: Deferred fired with the time spent on rotation in seconds
+        """
+        d = defer.Deferred()
+        if self.waiters is None:
+            logger.info(f'Requesting new identity for {self.proxy}')
+            self.waiters = []
+            threads.deferToThread(self._new_identity).addBoth(self._rotated, time.time())
+        self.waiters.append(d)
+        return d
+
+    def _rotated(self, result, start):
+        elapsed = time.time() - start
+        if isinstance(result, Failure):
+            logger.error(f'Failed to get new identity for {self.proxy}: {result.value}')
+        else:
+            new_id, counter = result
+            logger.info(f'Got new identity: {new_id}, {counter} iterations, {elapsed:.2f}sec')
+        waiters, self.waiters = self.waiters, None
+        for d in waiters:
+            d.callback(elapsed)
 
 
 class TorProxyDownloader:
-    def __init__(self, settings):
+    """
+    Rotates the Tor identity of the proxy a 403 came through. Only requests
+    bound to that proxy wait for the rotation, the engine keeps running.
+    """
+
+    def __init__(self, settings, stats):
         self.settings = settings
-        self.tor_mgr = ConnectionManager(settings.get('TOR_PASSWORD'))
-        self.tor_mgr.new_identity()
+        self.stats = stats
+        self.managers = {}
+        for proxy, control in settings.getdict('TOR_CONTROLLERS').items():
+            host, _, port = control.rpartition(':')
+            self.managers[proxy] = ConnectionManager(proxy, host, int(port), settings.get('TOR_PASSWORD'))
 
     @classmethod
     def from_crawler(cls, crawler: Crawler):
         cls.crawler = crawler
-        return cls(crawler.settings)
+        middleware = cls(crawler.settings, crawler.stats)
+        crawler.signals.connect(middleware.spider_closed, signal=signals.spider_closed)
+        return middleware
 
-    def process_request(self, request, spider):
-        request.meta["proxy"] = TOR_PROXY
+    def spider_closed(self, spider):
+        for manager in self.managers.values():
+            manager.close()
+
+    async def process_request(self, request, spider):
+        if not request.meta.get('proxy'):
+            request.meta["proxy"] = TOR_PROXY
+        manager = self.managers.get(request.meta['proxy'])
+        if manager is not None and manager.rotating:
+            await maybe_deferred_to_future(manager.new_identity())
 
     def process_response(self, request, response, spider):
-        if response.status == 403:
-            logger.info('GOT 403')
-            self.crawler.engine.pause()
+        manager = self.managers.get(request.meta.get('proxy'))
+        if response.status == 403 and manager is not None:
+            logger.info(f'GOT 403 from {manager.proxy}')
             request.meta['max_retry_times'] = 30
-            self.tor_mgr.new_identity()
-            self.crawler.engine.unpause()
+            if not manager.rotating:
+                self.stats.inc_value('tor/rotations')
+                manager.new_identity().addCallback(self._record_rotation)
         return response
+
+    def _record_rotation(self, elapsed):
+        self.stats.inc_value('tor/rotation_time', elapsed)
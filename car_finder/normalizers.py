@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import re
+
+from car_finder import settings
+
+NON_DIGITS_PATTERN = re.compile(r'\D+')
+MANUFACTURED_PATTERN = re.compile(r'manufactured in (\d{4})', flags=re.IGNORECASE)
+PURCHASED_PATTERN = re.compile(r'purchased in (\d{4})', flags=re.IGNORECASE)
+MILEAGE_PATTERN = re.compile(r'(\d[\d\s]*)\s*(?:km|км)', flags=re.IGNORECASE)
+CAPACITY_PATTERN = re.compile(r'(\d+[.,]\d+)\s*(?:l|л)\b', flags=re.IGNORECASE)
+HORSE_POWER_PATTERN = re.compile(r'(\d+)\s*(?:hp|л\.\s*с)', flags=re.IGNORECASE)
+ENGINE_TYPES = ('gasoline', 'petrol', 'diesel', 'hybrid', 'electric', 'gas')
+TRANSMISSION_TYPES = ('manual', 'automatic', 'robot', 'cvt')
+
+# Currency marks shown by drive2 -> currency code of settings.EXCHANGE_RATES
+CURRENCIES = {
+    '₽': 'RUB',
+    'руб': 'RUB',
+    '$': 'USD',
+    '€': 'EUR',
+    '₸': 'KZT',
+    '₴': 'UAH',
+    'Br': 'BYN',
+    '₾': 'GEL',
+}
+
+
+class PriceNormalizer:
+    """
+    Converts a price string in any of CURRENCIES to rubles.
+
+    :param rates: currency code -> price of one unit in rubles
+    """
+
+    def __init__(self, rates):
+        self.rates = dict(rates)
+
+    def __call__(self, value):
+        for mark, currency in CURRENCIES.items():
+            if mark in value:
+                break
+        else:
+            return None
+        rate = self.rates.get(currency)
+        digits = ''.join(value.replace(mark, '').split())
+        if not digits.isdigit():
+            digits = NON_DIGITS_PATTERN.sub('', digits)
+        if rate is None or not digits:
+            return None
+        return int(round(int(digits) * rate))
+
+
+price_normalizer = PriceNormalizer(settings.EXCHANGE_RATES)
+
+
+def set_exchange_rates(rates):
+    price_normalizer.rates.update(rates)
+
+
+def extract_price(value):
+    return price_normalizer(value)
+
+
+def _search_int(pattern, value):
+    match = pattern.search(value)
+    if match:
+        return int(match.group(1))
+
+
+def extract_manufactured(value):
+    return _search_int(MANUFACTURED_PATTERN, value)
+
+
+def extract_purchased(value):
+    return _search_int(PURCHASED_PATTERN, value)
+
+
+def extract_horse_power(value):
+    return _search_int(HORSE_POWER_PATTERN, value)
+
+
+def extract_mileage(value):
+    match = MILEAGE_PATTERN.search(value)
+    if match:
+        return int(NON_DIGITS_PATTERN.sub('', match.group(1)))
+
+
+def extract_capacity(value):
+    match = CAPACITY_PATTERN.search(value)
+    if match:
+        return float(match.group(1).replace(',', '.'))
+
+
+def _find_keyword(keywords, value):
+    value = value.lower()
+    for keyword in keywords:
+        if keyword in value:
+            return keyword
+
+
+def extract_engine_type(value):
+    return _find_keyword(ENGINE_TYPES, value)
+
+
+def extract_transmission(value):
+    return _find_keyword(TRANSMISSION_TYPES, value)
+
+
+NORMALIZERS = {
+    'price': price_normalizer,
+    'manufactured': extract_manufactured,
+    'purchased': extract_purchased,
+    'mileage': extract_mileage,
+    'capacity': extract_capacity,
+    'horse_power': extract_horse_power,
+    'engine_type': extract_engine_type,
+    'transmission': extract_transmission,
+}
+
+
+def normalize_batch(field, values):
+    """
+    Normalize a list of raw strings of one field, e.g. when re-processing archives.
+
+    :param field: one of NORMALIZERS keys
+    :return: list of normalized values, None for missing or unparsable values
+    """
+    func = NORMALIZERS[field]
+    return [func(value) if value else None for value in values]
+
+
+def normalize_columns(columns):
+    """
+    :param columns: dict of field -> list of raw strings
+    :return: dict of field -> list of normalized values
+    """
+    return {field: normalize_batch(field, values) for field, values in columns.items()}
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import logging
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from twisted.internet import defer
+
+logger = logging.getLogger(__name__)
+
+
+class ParseOffloader:
+    """
+    Runs CPU bound parsing functions outside of the reactor thread.
+
+    Functions must be module level (picklable) and take/return plain data,
+    item loading and request scheduling stay on the reactor.
+    Without an executor functions are run inline.
+    """
+
+    def __init__(self, executor=None):
+        self.executor = executor
+
+    @classmethod
+    def from_settings(cls, settings):
+        if not settings.getbool('PARSE_OFFLOAD_ENABLED'):
+            return cls()
+        pool_size = settings.getint('PARSE_OFFLOAD_POOL_SIZE') or None
+        if settings.get('PARSE_OFFLOAD_EXECUTOR') == 'thread':
+            executor = ThreadPoolExecutor(pool_size)
+        else:
+            executor = ProcessPoolExecutor(pool_size)
+        logger.info(f'Offloading parsing to {executor.__class__.__name__}, max workers: {executor._max_workers}')
+        return cls(executor)
+
+    def run(self, func, *args):
+        """
+        :return: Deferred fired with func(*args) result
+        """
+        if self.executor is None:
+            return defer.maybeDeferred(func, *args)
+        try:
+            future = self.executor.submit(func, *args)
+        except (BrokenProcessPool, RuntimeError) as e:
+            logger.error(f'Parse pool is not available, falling back to inline parsing: {e}')
+            self.close()
+            return defer.maybeDeferred(func, *args)
+        from twisted.internet import reactor
+        d = defer.Deferred()
+        future.add_done_callback(lambda f: reactor.callFromThread(self._fire, d, f, func, args))
+        return d
+
+    def _fire(self, d, future, func, args):
+        try:
+            result = future.result()
+        except BrokenProcessPool as e:
+            # a worker died after the function was submitted, the page is parsed inline
+            if self.executor is not None:
+                logger.error(f'Parse pool is broken, falling back to inline parsing: {e}')
+                self.close()
+            defer.maybeDeferred(func, *args).chainDeferred(d)
+            return
+        except Exception as e:
+            d.errback(e)
+            return
+        d.callback(result)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
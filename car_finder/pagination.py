@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+class BrandPages:
+    def __init__(self, total=None):
+        self.total = total
+        self.stride = None
+        self.next_start = None
+        self.end = None
+        self.in_flight = set()
+
+    @property
+    def finished(self):
+        return self.end is not None and not self.in_flight
+
+    def to_dict(self):
+        return {
+            'total': self.total,
+            'stride': self.stride,
+            'next_start': self.next_start,
+            'end': self.end,
+            'in_flight': sorted(self.in_flight),
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        pages = cls(state['total'])
+        pages.stride = state['stride']
+        pages.next_start = state['next_start']
+        pages.end = state['end']
+        pages.in_flight = set(state['in_flight'])
+        return pages
+
+
+class PaginationScheduler:
+    """
+    Fans out `start=` offsets of a brand up to the total seen on the previous run instead of
+    chaining pages one by one. At most `max_in_flight` pages per brand are requested at once.
+    Without a known total and past it pages are chained sequentially, so no empty pages
+    past the end of a brand are requested.
+    """
+
+    def __init__(self, max_in_flight=1, totals=None):
+        self.max_in_flight = max(max_in_flight, 1)
+        self.totals = totals or {}
+        self.brands = {}
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings.getint('PAGINATION_PAGES_IN_FLIGHT', 1), load_totals(settings.get('PAGINATION_STATS_PATH')))
+
+    def get(self, brand):
+        if brand not in self.brands:
+            self.brands[brand] = BrandPages(self.totals.get(brand))
+        return self.brands[brand]
+
+    def get_state(self):
+        return {brand: pages.to_dict() for brand, pages in self.brands.items()}
+
+    def set_state(self, state):
+        self.brands = {brand: BrandPages.from_dict(pages) for brand, pages in state.items()}
+
+    def page_failed(self, brand, start):
+        self.get(brand).in_flight.discard(start)
+
+    def stop(self, brand, offsets):
+        """
+        Ends pagination of the brand before `offsets` returned by `page_done` which will not be requested,
+        e.g. once the brand has spent its budget.
+        """
+        pages = self.get(brand)
+        end = min(offsets)
+        pages.end = end if pages.end is None else min(pages.end, end)
+        pages.in_flight.difference_update(offsets)
+
+    def page_done(self, brand, start, next_start, found):
+        """
+        :return: list of offsets to request next for the brand
+        """
+        pages = self.get(brand)
+        pages.in_flight.discard(start)
+        if not next_start or not found:
+            pages.end = start if pages.end is None else min(pages.end, start)
+            return []
+        if pages.stride is None and next_start > start:
+            pages.stride = next_start - start
+        if pages.stride is None:
+            # unknown stride, follow the chain as returned by the site
+            return [] if next_start in pages.in_flight else self._take(pages, [next_start])
+        if pages.next_start is None or pages.next_start < next_start:
+            pages.next_start = next_start
+        offsets = []
+        while len(pages.in_flight) + len(offsets) < self._window(pages):
+            if pages.end is not None and pages.next_start >= pages.end:
+                break
+            offsets.append(pages.next_start)
+            pages.next_start += pages.stride
+        return self._take(pages, offsets)
+
+    def _window(self, pages):
+        if pages.total is None or pages.next_start >= pages.total:
+            return 1
+        return self.max_in_flight
+
+    @staticmethod
+    def _take(pages, offsets):
+        pages.in_flight.update(offsets)
+        return offsets
+
+
+def load_totals(path):
+    if not path or not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logger.error(f'Could not load pagination stats from {path}: {e}')
+        return {}
+
+
+def save_totals(path, totals):
+    """
+    Updates the saved totals, brands not crawled by this run keep their previous totals.
+    """
+    if not path:
+        return
+    totals = dict(load_totals(path), **totals)
+    try:
+        with open(path, 'w') as f:
+            json.dump(totals, f)
+    except OSError as e:
+        logger.error(f'Could not save pagination stats to {path}: {e}')
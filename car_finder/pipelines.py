@@ -0,0 +1,524 @@
+# -*- coding: utf-8 -*-
+
+# Define your item pipelines here
+#
+# See documentation in:
+# https://doc.scrapy.org/en/latest/topics/item-pipeline.html
+import dbm
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime
+from urllib.parse import quote
+
+from itemadapter import ItemAdapter
+from scrapy.exceptions import NotConfigured
+from scrapy.pipelines.images import ImagesPipeline
+from scrapy.utils.python import to_unicode
+from scrapy.utils.serialize import ScrapyJSONEncoder
+from scrapy_redis import connection
+from twisted.internet import defer, task, threads
+
+from car_finder.items import CarItem, CarRecord
+
+logger = logging.getLogger(__name__)
+
+
+class CarRecordPipeline:
+    """
+    Converts compact CarRecord objects yielded by spiders to CarItem
+    before they reach the media and export pipelines.
+    """
+
+    def process_item(self, item, spider):
+        if isinstance(item, CarRecord):
+            return item.to_item()
+        return item
+
+
+# Pushes every item of the batch whose fingerprint was not seen yet, in a single round trip
+PUSH_UNIQUE_SCRIPT = """
+for i = 1, #ARGV, 2 do
+    if ARGV[i] == '' or redis.call('SADD', KEYS[1], ARGV[i]) == 1 then
+        redis.call('RPUSH', KEYS[2], ARGV[i + 1])
+    end
+end
+"""
+# Marks fingerprints as seen, returns flags of the new ones
+ADD_FINGERPRINTS_SCRIPT = """
+local new = {}
+for i = 1, #ARGV do
+    new[i] = ARGV[i] == '' and 1 or redis.call('SADD', KEYS[1], ARGV[i])
+end
+return new
+"""
+
+
+class BufferedRedisPipeline:
+    """
+    Pushes items to REDIS_ITEMS_KEY list in batches of REDIS_EXPORT_BATCH_SIZE items
+    or every REDIS_EXPORT_FLUSH_INTERVAL seconds, one pipelined round trip per batch.
+
+    REDIS_EXPORT_FORMAT:
+        json - one ScrapyJSONEncoder document per item, same as scrapy_redis RedisPipeline
+        json-rows - one document per batch: {"fields": [...], "rows": [[...], ...]}
+        msgpack - json-rows layout encoded with msgpack
+
+    A batch redis failed to take is kept for the next flush. At most REDIS_EXPORT_MAX_PENDING items
+    wait for redis, the oldest ones past it and the ones left when the spider closes are dropped
+    and counted in redis_export/dropped stat.
+    """
+    FORMATS = ('json', 'json-rows', 'msgpack')
+
+    def __init__(self, server, key, batch_size, flush_interval, export_format, dedupe_key=None, max_pending=0,
+                 stats=None):
+        if export_format not in self.FORMATS:
+            raise NotConfigured(f'Unknown REDIS_EXPORT_FORMAT: {export_format}')
+        self.server = server
+        self.key = key
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.format = export_format
+        self.dedupe_key = dedupe_key
+        self.max_pending = max(max_pending, batch_size)
+        self.stats = stats
+        self.encoder = ScrapyJSONEncoder()
+        self.buffer = []
+        # ids of buffered rows whose fingerprints were added to the dedupe set by a failed write
+        self.deduped = set()
+        self.flush_loop = None
+        self.push_unique = server.register_script(PUSH_UNIQUE_SCRIPT)
+        self.add_fingerprints = server.register_script(ADD_FINGERPRINTS_SCRIPT)
+        if export_format == 'msgpack':
+            import msgpack
+            self.packb = msgpack.packb
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        return cls(
+            connection.from_settings(settings),
+            settings.get('REDIS_ITEMS_KEY', '%(spider)s:items'),
+            settings.getint('REDIS_EXPORT_BATCH_SIZE'),
+            settings.getfloat('REDIS_EXPORT_FLUSH_INTERVAL'),
+            settings.get('REDIS_EXPORT_FORMAT'),
+            settings.get('REDIS_EXPORT_DEDUPE_KEY') if settings.getbool('REDIS_EXPORT_DEDUPE') else None,
+            settings.getint('REDIS_EXPORT_MAX_PENDING'),
+            crawler.stats,
+        )
+
+    def open_spider(self, spider):
+        self.key = self.key % {'spider': spider.name}
+        if self.dedupe_key:
+            self.dedupe_key = self.dedupe_key % {'spider': spider.name}
+        if self.flush_interval:
+            self.flush_loop = task.LoopingCall(self.flush)
+            self.flush_loop.start(self.flush_interval, now=False)
+
+    def close_spider(self, spider):
+        if self.flush_loop and self.flush_loop.running:
+            self.flush_loop.stop()
+        d = self.flush()
+        d.addCallback(lambda _: self.drop(len(self.buffer)))
+        return d
+
+    def process_item(self, item, spider):
+        self.buffer.append(ItemAdapter(item).asdict())
+        if len(self.buffer) < self.batch_size:
+            return item
+        # the item is passed on once its batch is written, throttling producers to redis speed
+        d = self.flush()
+        d.addCallback(lambda _: item)
+        return d
+
+    def flush(self):
+        if not self.buffer:
+            return defer.succeed(None)
+        batch, self.buffer = self.buffer, []
+        d = threads.deferToThread(self.write, batch)
+        d.addCallbacks(lambda _: self.deduped.difference_update(map(id, batch)), self.write_failed,
+                       errbackArgs=(batch,))
+        return d
+
+    def write_failed(self, failure, batch):
+        logger.error(f'Failed to export {len(batch)} items to redis, retrying on the next flush: {failure.value}')
+        self.buffer[:0] = batch
+        self.drop(len(self.buffer) - self.max_pending)
+
+    def drop(self, count):
+        """
+        Drops `count` oldest buffered items.
+        """
+        if count <= 0:
+            return
+        logger.error(f'Dropped {count} items not exported to redis')
+        self.deduped.difference_update(map(id, self.buffer[:count]))
+        del self.buffer[:count]
+        if self.stats:
+            self.stats.inc_value('redis_export/dropped', count)
+
+    def write(self, batch):
+        if self.format == 'json':
+            payloads = [self.encoder.encode(row) for row in batch]
+            if self.dedupe_key:
+                args = []
+                for row, payload in zip(batch, payloads):
+                    args.extend((row.get('url_fingerprint') or '', payload))
+                self.push_unique(keys=[self.dedupe_key, self.key], args=args)
+            else:
+                self.server.rpush(self.key, *payloads)
+            return
+        if self.dedupe_key:
+            fingerprints = ['' if id(row) in self.deduped else row.get('url_fingerprint') or '' for row in batch]
+            new = self.add_fingerprints(keys=[self.dedupe_key], args=fingerprints)
+            batch = [row for row, is_new in zip(batch, new) if is_new]
+            if not batch:
+                return
+            # a retry of the batch must not take its rows for duplicates
+            self.deduped.update(map(id, batch))
+        self.server.rpush(self.key, self.pack(batch))
+
+    def pack(self, batch):
+        fields = list({field: None for row in batch for field in row})
+        rows = [[row.get(field) for field in fields] for row in batch]
+        if self.format == 'msgpack':
+            return self.packb({'fields': fields, 'rows': rows}, default=str)
+        return self.encoder.encode({'fields': fields, 'rows': rows})
+
+
+# Partition value of items without a brand, read back as null
+NULL_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+# Flattened CarItem columns of ParquetExportPipeline, crawl date and brand are partition keys
+PARQUET_PROFILE_FIELDS = ('mileage', 'capacity', 'horse_power', 'engine_type', 'transmission')
+
+
+def parquet_schema():
+    import pyarrow as pa
+    return pa.schema([
+        ('url_fingerprint', pa.binary(20)),
+        ('url', pa.string()),
+        ('title', pa.string()),
+        ('price', pa.int64()),
+        ('model', pa.string()),
+        ('generation', pa.string()),
+        ('manufactured', pa.int16()),
+        ('purchased', pa.int16()),
+        ('city', pa.string()),
+        ('country', pa.string()),
+        ('mileage', pa.int32()),
+        ('capacity', pa.float32()),
+        ('horse_power', pa.int16()),
+        ('engine_type', pa.string()),
+        ('transmission', pa.string()),
+        ('image_urls', pa.list_(pa.string())),
+        ('crawled_at', pa.timestamp('s')),
+    ])
+
+
+def parquet_row(item, crawled_at):
+    """
+    :return: CarItem fields by parquet_schema column, url_fingerprint hex digest as bytes
+    """
+    profile = item.get('profile') or {}
+    fingerprint = item.get('url_fingerprint')
+    row = {
+        'url_fingerprint': bytes.fromhex(fingerprint) if fingerprint else None,
+        'url': item.get('url'),
+        'title': item.get('title'),
+        'price': item.get('price'),
+        'model': item.get('model'),
+        'generation': item.get('generation'),
+        'manufactured': item.get('manufactured'),
+        'purchased': item.get('purchased'),
+        'city': item.get('city'),
+        'country': item.get('country'),
+        'image_urls': item.get('image_urls') or [],
+        'crawled_at': crawled_at,
+    }
+    for field in PARQUET_PROFILE_FIELDS:
+        row[field] = profile.get(field)
+    return row
+
+
+class ParquetExportPipeline:
+    """
+    Streams CarItem records to PARQUET_EXPORT_PATH as parquet files partitioned by crawl date and brand,
+    <path>/crawl_date=2024-01-31/brand=Toyota/<spider>-<crawl start>.parquet. The whole directory
+    loads as one table with pyarrow.parquet.read_table(path) or pandas.read_parquet(path).
+
+    Rows are buffered column-wise per brand and written as a row group of PARQUET_ROW_GROUP_SIZE rows,
+    once PARQUET_MAX_BUFFERED_ROWS rows are buffered in total the largest buffer is written early.
+    Files are hidden from readers by a dot prefix until the spider is closed.
+
+    Rows of a failed write go back to their buffer and are written with the next row group of the brand.
+    Rows which do not fit in PARQUET_MAX_BUFFERED_ROWS any more or fail again when the spider closes
+    are dropped and counted in parquet_export/dropped stat.
+    """
+
+    def __init__(self, path, row_group_size, max_buffered_rows, compression, stats=None):
+        self.path = path
+        self.row_group_size = row_group_size
+        self.max_buffered_rows = max(max_buffered_rows, row_group_size)
+        self.compression = compression
+        self.schema = parquet_schema()
+        self.buffers = {}
+        self.buffered = 0
+        self.writers = {}
+        self.lock = defer.DeferredLock()
+        self.stats = stats
+        self.closing = False
+        self.crawl_date = None
+        self.file_name = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        path = settings.get('PARQUET_EXPORT_PATH')
+        if not path:
+            raise NotConfigured('PARQUET_EXPORT_PATH is not set')
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise NotConfigured('ParquetExportPipeline requires pyarrow')
+        return cls(
+            path,
+            settings.getint('PARQUET_ROW_GROUP_SIZE'),
+            settings.getint('PARQUET_MAX_BUFFERED_ROWS'),
+            settings.get('PARQUET_COMPRESSION'),
+            crawler.stats,
+        )
+
+    def open_spider(self, spider):
+        started = datetime.now()
+        self.crawl_date = started.strftime('%Y-%m-%d')
+        self.file_name = f'{spider.name}-{started:%Y%m%dT%H%M%S}.parquet'
+
+    def close_spider(self, spider):
+        self.closing = True
+        d = defer.DeferredList([self.flush(partition) for partition in list(self.buffers)])
+        d.addCallback(lambda _: self.lock.run(threads.deferToThread, self.close_writers))
+        return d
+
+    def process_item(self, item, spider):
+        if not isinstance(item, CarItem):
+            return item
+        brand = item.get('brand')
+        partition = quote(brand, safe='') if brand else NULL_PARTITION
+        columns = self.buffers.get(partition)
+        if columns is None:
+            columns = self.buffers[partition] = {name: [] for name in self.schema.names}
+        # the column is timestamp('s')
+        crawled_at = datetime.now().replace(microsecond=0)
+        for name, value in parquet_row(item, crawled_at).items():
+            columns[name].append(value)
+        self.buffered += 1
+        if len(columns['url']) >= self.row_group_size:
+            d = self.flush(partition)
+        elif self.buffered >= self.max_buffered_rows:
+            d = self.flush(max(self.buffers, key=lambda key: len(self.buffers[key]['url'])))
+        else:
+            return item
+        # the item is passed on once its row group is written, memory stays bounded
+        d.addCallback(lambda _: item)
+        return d
+
+    def flush(self, partition):
+        columns = self.buffers.pop(partition)
+        rows = len(columns['url'])
+        self.buffered -= rows
+        d = self.lock.run(threads.deferToThread, self.write, partition, columns)
+        d.addErrback(self.write_failed, partition, columns)
+        return d
+
+    def write_failed(self, failure, partition, columns):
+        rows = len(columns['url'])
+        if self.closing or self.buffered + rows > self.max_buffered_rows:
+            logger.error(f'Dropped {rows} items not exported to parquet: {failure.value}')
+            if self.stats:
+                self.stats.inc_value('parquet_export/dropped', rows)
+            return
+        logger.error(f'Failed to export {rows} items to parquet, retrying with the next row group: {failure.value}')
+        buffered = self.buffers.get(partition)
+        if buffered:
+            for name, values in columns.items():
+                values.extend(buffered[name])
+        self.buffers[partition] = columns
+        self.buffered += rows
+
+    def write(self, partition, columns):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        if partition not in self.writers:
+            directory = os.path.join(self.path, f'crawl_date={self.crawl_date}', f'brand={partition}')
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, f'.{self.file_name}')
+            self.writers[partition] = (pq.ParquetWriter(path, self.schema, compression=self.compression), path)
+        writer, _ = self.writers[partition]
+        writer.write_table(pa.Table.from_pydict(columns, schema=self.schema))
+
+    def close_writers(self):
+        for writer, path in self.writers.values():
+            writer.close()
+            os.replace(path, os.path.join(os.path.dirname(path), self.file_name))
+        logger.info(f'Exported {len(self.writers)} parquet partitions to {self.path}')
+        self.writers = {}
+
+
+class ImageIndex:
+    """
+    Persistent image url -> (content hash, validators) index and content hash -> stored path.
+    """
+
+    def __init__(self, path):
+        self.db = dbm.open(path, 'c')
+
+    def _get(self, key):
+        try:
+            return json.loads(self.db[key])
+        except KeyError:
+            return None
+
+    def get(self, url):
+        return self._get(f'url:{url}')
+
+    def get_content(self, checksum):
+        return self._get(f'sha:{checksum}')
+
+    def remember(self, url, entry):
+        self.db[f'url:{url}'] = json.dumps(entry)
+        self.db[f'sha:{entry["checksum"]}'] = json.dumps(entry['path'])
+
+    def close(self):
+        self.db.close()
+
+
+class CachedImagesPipeline(ImagesPipeline):
+    """
+    ImagesPipeline storing images by content hash, so an image shared by several
+    listings is kept once, and remembering downloaded urls across crawls:
+
+    IMAGES_CACHE_MODE = 'skip' - known urls are not requested again
+    IMAGES_CACHE_MODE = 'conditional' - known urls are requested with If-None-Match/If-Modified-Since
+
+    Known images whose file is gone from IMAGES_STORE, e.g. a wiped /tmp, are downloaded again.
+    Image decoding and thumbnails run in the reactor thread pool.
+    """
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        pipeline = super().from_crawler(crawler)
+        pipeline.cache_stats = crawler.stats
+        pipeline.cache_mode = crawler.settings.get('IMAGES_CACHE_MODE')
+        pipeline.index = ImageIndex(crawler.settings.get('IMAGES_CACHE_INDEX'))
+        return pipeline
+
+    def close_spider(self, spider):
+        # MediaPipeline has no close_spider in current Scrapy versions
+        close_spider = getattr(super(), 'close_spider', None)
+        if close_spider:
+            close_spider(spider)
+        self.index.close()
+
+    def file_path(self, request, response=None, info=None, *, item=None):
+        if response is None:
+            return super().file_path(request, response=response, info=info, item=item)
+        return f'full/{hashlib.sha1(response.body).hexdigest()}.jpg'
+
+    def thumb_path(self, request, thumb_id, response=None, info=None, *, item=None):
+        if response is None:
+            return super().thumb_path(request, thumb_id, response=response, info=info, item=item)
+        return f'thumbs/{thumb_id}/{hashlib.sha1(response.body).hexdigest()}.jpg'
+
+    def stored(self, entry, info):
+        """
+        :return: Deferred firing True if the image of the index entry is still in IMAGES_STORE
+        """
+        def found(stat):
+            if not stat:
+                self.cache_stats.inc_value('images_cache/missing')
+            return bool(stat)
+
+        d = defer.maybeDeferred(self.store.stat_file, entry['path'], info)
+        d.addCallback(found)
+        d.addErrback(lambda failure: False)
+        return d
+
+    def media_to_download(self, request, info, *, item=None):
+        entry = self.index.get(request.url)
+        if not entry or self.cache_mode not in ('skip', 'conditional'):
+            return None
+        d = self.stored(entry, info)
+        d.addCallback(self.cached_or_validated, request, entry)
+        return d
+
+    def cached_or_validated(self, stored, request, entry):
+        """
+        Skips or makes conditional the request of a known image, unless its stored file is gone.
+        """
+        if not stored:
+            return None
+        if self.cache_mode == 'skip':
+            self.cache_stats.inc_value('images_cache/skipped')
+            return self.cached_result(request, entry)
+        if entry.get('etag'):
+            request.headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            request.headers['If-Modified-Since'] = entry['last_modified']
+        return None
+
+    def media_downloaded(self, response, request, info, *, item=None):
+        entry = self.index.get(request.url)
+        if response.status == 304 and entry:
+            # only requests of stored images are conditional
+            self.cache_stats.inc_value('images_cache/not_modified')
+            return self.cached_result(request, entry)
+        if response.status != 200 or not response.body:
+            return super().media_downloaded(response, request, info, item=item)
+        entry = {
+            'checksum': hashlib.sha1(response.body).hexdigest(),
+            'path': self.file_path(request, response=response, info=info, item=item),
+            'etag': to_unicode(response.headers.get('ETag') or b'') or None,
+            'last_modified': to_unicode(response.headers.get('Last-Modified') or b'') or None,
+            'size': len(response.body),
+            'latency': response.meta.get('download_latency', 0),
+        }
+        if not self.index.get_content(entry['checksum']):
+            return self.store_images(response, request, info, item, entry)
+        d = self.stored(entry, info)
+        d.addCallback(self.deduplicated, response, request, info, item, entry)
+        return d
+
+    def deduplicated(self, stored, response, request, info, item, entry):
+        if not stored:
+            return self.store_images(response, request, info, item, entry)
+        self.cache_stats.inc_value('images_cache/duplicates')
+        self.cache_stats.inc_value('images_cache/bytes_deduplicated', entry['size'])
+        self.index.remember(request.url, entry)
+        return self.downloaded_result(request, entry)
+
+    def store_images(self, response, request, info, item, entry):
+        d = threads.deferToThread(lambda: list(self.get_images(response, request, info, item=item)))
+        d.addCallback(self.persist_images, request, info, entry)
+        return d
+
+    @defer.inlineCallbacks
+    def persist_images(self, images, request, info, entry):
+        for path, image, buf in images:
+            width, height = image.size
+            yield defer.maybeDeferred(self.store.persist_file, path, buf, info,
+                                      meta={'width': width, 'height': height}, headers={'Content-Type': 'image/jpeg'})
+        self.index.remember(request.url, entry)
+        return self.downloaded_result(request, entry)
+
+    def downloaded_result(self, request, entry):
+        self.cache_stats.inc_value('file_count')
+        self.cache_stats.inc_value('file_status_count/downloaded')
+        return {'url': request.url, 'path': entry['path'], 'checksum': entry['checksum'], 'status': 'downloaded'}
+
+    def cached_result(self, request, entry):
+        self.cache_stats.inc_value('file_count')
+        self.cache_stats.inc_value('file_status_count/uptodate')
+        self.cache_stats.inc_value('images_cache/bytes_saved', entry['size'])
+        self.cache_stats.inc_value('images_cache/time_saved', entry['latency'])
+        return {'url': request.url, 'path': entry['path'], 'checksum': entry['checksum'], 'status': 'uptodate'}
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+from collections import Counter
+
+from scrapy import signals
+
+
+class PriorityPolicy:
+    """
+    Request priorities of Drive2Spider, requests with higher priority are scheduled first.
+
+    * detail pages of cheaper listings (below PRIORITY_PRICE_BANDS, in rubles) and of listings
+      new to the incremental index go first
+    * every PRIORITY_BRAND_QUOTA detail pages of a brand lower the priority of its next ones,
+      so a big brand does not starve the others
+    * next listing pages of a brand go before the most expensive listings while it has few
+      detail pages waiting and fall behind as its backlog grows
+    """
+    STATUS_BONUS = {'new': 2, 'changed': 1}
+
+    def __init__(self, price_bands, brand_quota):
+        self.price_bands = sorted(price_bands)
+        self.brand_quota = max(brand_quota, 1)
+        self.scheduled = Counter()
+        self.backlog = Counter()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('PRIORITY_ENABLED'):
+            return None
+        policy = cls([int(bound) for bound in settings.getlist('PRIORITY_PRICE_BANDS')],
+                     settings.getint('PRIORITY_BRAND_QUOTA'))
+        crawler.signals.connect(policy.request_dropped, signal=signals.request_dropped)
+        return policy
+
+    def detail(self, brand, price, status=None):
+        """
+        :param price: listing price in rubles, None if unknown
+        :param status: incremental index status of the listing, None without the index
+        :return: priority of the detail page request
+        """
+        band = sum(1 for bound in self.price_bands if price is not None and price <= bound)
+        priority = band + self.STATUS_BONUS.get(status, 0) - self.scheduled[brand] // self.brand_quota
+        self.scheduled[brand] += 1
+        self.backlog[brand] += 1
+        return priority
+
+    def detail_done(self, brand):
+        if self.backlog[brand] > 0:
+            self.backlog[brand] -= 1
+
+    def page(self, brand):
+        """
+        :return: priority of the next listing page request of the brand
+        """
+        return 1 - self.backlog[brand] // self.brand_quota
+
+    def request_dropped(self, request, spider):
+        # detail page filtered by the dupefilter
+        if 'card' in request.meta and 'brand' in request.meta:
+            self.detail_done(request.meta['brand'])
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+import base64
+import gzip
+import json
+import logging
+import random
+from urllib.parse import urlparse
+
+from scrapy import signals
+from scrapy.core.downloader.handlers.http11 import HTTP11DownloadHandler
+from scrapy.exceptions import NotConfigured
+from scrapy.http import TextResponse
+from twisted.web import resource, server
+
+logger = logging.getLogger(__name__)
+
+# Hop-by-hop or recomputed by the replay server
+SKIP_HEADERS = {'content-length', 'transfer-encoding', 'connection', 'keep-alive'}
+
+
+def archive_key(url):
+    """
+    :return: host, path and query of the url, the key of its response in a replay archive
+    """
+    parsed = urlparse(url)
+    return parsed.netloc + parsed.path + (f'?{parsed.query}' if parsed.query else '')
+
+
+class ReplayArchive:
+    """
+    Recorded responses in a gzip compressed JSON lines file, appending starts a new gzip member
+    so several recording runs can go into one archive.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def write(self, url, status, headers, body):
+        """
+        :param headers: dict of header name -> list of values
+        :param body: bytes
+        """
+        if self.file is None:
+            self.file = gzip.open(self.path, 'at', encoding='utf-8')
+        self.file.write(json.dumps({
+            'url': url,
+            'status': status,
+            'headers': headers,
+            'body': base64.b64encode(body).decode(),
+        }) + '\n')
+
+    def read(self):
+        """
+        :return: dict of archive_key(url) -> record, the latest record of a url wins
+        """
+        records = {}
+        with gzip.open(self.path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                record = json.loads(line)
+                record['body'] = base64.b64decode(record['body'])
+                records[archive_key(record['url'])] = record
+        return records
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class ReplayRecorder:
+    """
+    Downloader middleware saving 200 responses to REPLAY_RECORD_PATH archive,
+    binary responses (images) only with REPLAY_RECORD_BINARY.
+    """
+
+    def __init__(self, archive, record_binary):
+        self.archive = archive
+        self.record_binary = record_binary
+        self.recorded = 0
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        path = crawler.settings.get('REPLAY_RECORD_PATH')
+        if not path:
+            raise NotConfigured('REPLAY_RECORD_PATH is not set')
+        recorder = cls(ReplayArchive(path), crawler.settings.getbool('REPLAY_RECORD_BINARY'))
+        crawler.signals.connect(recorder.spider_closed, signal=signals.spider_closed)
+        return recorder
+
+    def process_response(self, request, response, spider):
+        if response.status == 200 and (self.record_binary or isinstance(response, TextResponse)):
+            headers = {name.decode('latin-1'): [value.decode('latin-1') for value in values]
+                       for name, values in response.headers.items()}
+            self.archive.write(request.url, response.status, headers, response.body)
+            self.recorded += 1
+        return response
+
+    def spider_closed(self, spider):
+        logger.info(f'Recorded {self.recorded} responses to {self.archive.path}')
+        self.archive.close()
+
+
+def replay_url(server_url, url):
+    return f'{server_url}/{archive_key(url)}'
+
+
+class ReplayDownloadHandler(HTTP11DownloadHandler):
+    """
+    Sends every request to the replay server at REPLAY_SERVER_URL instead of the site.
+    The response gets the original url back, so middlewares and the spider see the usual crawl.
+    """
+
+    def __init__(self, crawler):
+        super().__init__(crawler)
+        self.server_url = crawler.settings.get('REPLAY_SERVER_URL').rstrip('/')
+
+    async def download_request(self, request):
+        replayed = request.replace(url=replay_url(self.server_url, request.url), meta=dict(request.meta, proxy=None))
+        response = await super().download_request(replayed)
+        return response.replace(url=request.url)
+
+
+class ReplayResource(resource.Resource):
+    """
+    Serves a replay archive, request path is archive_key of the original url.
+
+    :param latency: mean response delay in seconds
+    :param jitter: delay is uniformly distributed within latency +- jitter
+    :param error_rate: share of requests answered with one of error_codes
+    """
+    isLeaf = True
+
+    def __init__(self, records, latency=0, jitter=0, error_rate=0, error_codes=(429, 403), seed=None):
+        super().__init__()
+        self.records = records
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_codes = error_codes
+        self.random = random.Random(seed)
+
+    def render_GET(self, request):
+        from twisted.internet import reactor
+        delay = max(self.latency + self.random.uniform(-self.jitter, self.jitter), 0)
+        call = reactor.callLater(delay, self.respond, request)
+        request.notifyFinish().addErrback(lambda _: call.active() and call.cancel())
+        return server.NOT_DONE_YET
+
+    def respond(self, request):
+        record = self.records.get(request.uri.decode('latin-1')[1:])
+        if self.random.random() < self.error_rate:
+            status, body = self.random.choice(self.error_codes), b''
+        elif record is None:
+            status, body = 404, b''
+        else:
+            status, body = record['status'], record['body']
+            for name, values in record['headers'].items():
+                if name.lower() not in SKIP_HEADERS:
+                    request.responseHeaders.setRawHeaders(name, values)
+        request.setResponseCode(status)
+        request.write(body)
+        request.finish()
+
+
+def serve(path, port, latency=0, jitter=0, error_rate=0, seed=None, ready=None):
+    """
+    Run the replay server of the archive at path until the process is stopped.
+    :param ready: multiprocessing.Event set once the server listens on the port
+    """
+    from twisted.internet import reactor
+    records = ReplayArchive(path).read()
+    reactor.listenTCP(port, server.Site(ReplayResource(records, latency, jitter, error_rate, seed=seed)),
+                      interface='127.0.0.1')
+    if ready is not None:
+        ready.set()
+    logger.info(f'Replaying {len(records)} responses of {path} on port {port}')
+    reactor.run()
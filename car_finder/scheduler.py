@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import logging
+import shutil
+import tempfile
+
+from scrapy.core.scheduler import Scheduler
+
+logger = logging.getLogger(__name__)
+
+
+class SpillingScheduler(Scheduler):
+    """
+    Keeps at most SPILL_THRESHOLD pending requests in memory. Requests past it are spilled to
+    a SCHEDULER_DISK_QUEUE in a temporary directory under SPILL_DIR and loaded back, highest priority
+    first, once the memory queue drains below half of the threshold. A spilled request of a higher
+    priority than all requests in memory is popped from disk right away (with ScrapyPriorityQueue).
+
+    With JOBDIR pending requests are kept on disk by the stock scheduler already, so it is not changed.
+    Spilled requests of a crawl without JOBDIR are removed on close, as memory queues are.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.threshold = self.crawler.settings.getint('SPILL_THRESHOLD')
+        self.spill_dir = None
+
+    def open(self, spider):
+        if self.dqdir is None and self.threshold > 0:
+            self.spill_dir = tempfile.mkdtemp(prefix=f'{spider.name}-spill-', dir=self.crawler.settings.get('SPILL_DIR'))
+            self.dqdir = self.spill_dir
+        return super().open(spider)
+
+    def close(self, reason):
+        result = super().close(reason)
+        if self.spill_dir:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+        return result
+
+    def _dqpush(self, request):
+        if self.spill_dir and len(self.mqs) < self.threshold:
+            return False
+        return super()._dqpush(request)
+
+    def next_request(self):
+        if self.spill_dir and self.spilled_first():
+            request = self.dqs.pop()
+            self.stats.inc_value('scheduler/dequeued/disk')
+            self.stats.inc_value('scheduler/dequeued')
+        else:
+            request = super().next_request()
+        if self.spill_dir and len(self.mqs) < self.threshold // 2 and len(self.dqs):
+            self.reload()
+        return request
+
+    def spilled_first(self):
+        """
+        :return: True if the disk queue holds a request of a higher priority than the memory queue
+        """
+        # curprio is the negated priority of the first request, None when empty
+        memory, disk = getattr(self.mqs, 'curprio', None), getattr(self.dqs, 'curprio', None)
+        return memory is not None and disk is not None and disk < memory
+
+    def reload(self):
+        count = 0
+        while len(self.mqs) < self.threshold:
+            request = self.dqs.pop()
+            if request is None:
+                break
+            self.mqs.push(request)
+            count += 1
+        self.stats.inc_value('scheduler/reloaded', count)
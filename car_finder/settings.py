@@ -9,12 +9,15 @@
 #     https://doc.scrapy.org/en/latest/topics/downloader-middleware.html
 #     https://doc.scrapy.org/en/latest/topics/spider-middleware.html
 import os
+from urllib.parse import urlparse
 
 LOG_LEVEL = 'INFO'
 BOT_NAME = 'car_finder'
 
 SPIDER_MODULES = ['car_finder.spiders']
 NEWSPIDER_MODULE = 'car_finder.spiders'
+# Keeps the url_fingerprint of items, and everything keyed by it, as computed by Scrapy < 2.13
+REQUEST_FINGERPRINTER_CLASS = 'car_finder.fingerprints.LegacyRequestFingerprinter'
 
 # Crawl responsibly by identifying yourself (and your website) on the user-agent
 USER_AGENTS = [
@@ -46,9 +49,29 @@ USER_AGENTS = [
 # Obey robots.txt rules
 ROBOTSTXT_OBEY = False
 RUB_IN_USD = 75
+# Price of one currency unit in rubles, prices are normalized to rubles
+EXCHANGE_RATES = {
+    'RUB': 1,
+    'USD': RUB_IN_USD,
+    'EUR': 90,
+    'KZT': 0.2,
+    'UAH': 2.2,
+    'BYN': 30,
+    'GEL': 33,
+}
+
+# Privoxy/Tor backends used directly by ProxyPoolMiddleware, e.g. http://privoxy1:8118,http://privoxy2:8118
+PROXY_POOL = [proxy for proxy in os.getenv('PROXY_POOL', '').split(',') if proxy]
+PROXY_POOL_CONCURRENCY = 2
+PROXY_POOL_WINDOW = 20
+PROXY_POOL_MAX_ERROR_RATE = 0.5
+PROXY_POOL_QUARANTINE = 120
+# PROXY_POOL_CONCURRENCY requests at once through each proxy, download slots are named proxy:<host>
+DOWNLOAD_SLOTS = {f'proxy:{urlparse(proxy).hostname or proxy}': {'concurrency': PROXY_POOL_CONCURRENCY}
+                  for proxy in PROXY_POOL}
 
 # Configure maximum concurrent requests performed by Scrapy (default: 16)
-CONCURRENT_REQUESTS = 6
+CONCURRENT_REQUESTS = max(6, len(PROXY_POOL) * PROXY_POOL_CONCURRENCY)
 
 # Configure a delay for requests for the same website (default: 0)
 # See https://doc.scrapy.org/en/latest/topics/settings.html#download-delay
@@ -57,6 +80,9 @@ DOWNLOAD_DELAY = 0.3
 # The download delay setting will honor only one of:
 CONCURRENT_REQUESTS_PER_DOMAIN = 6
 CONCURRENT_REQUESTS_PER_IP = 6
+# The default DownloaderAwarePriorityQueue rejects CONCURRENT_REQUESTS_PER_IP,
+# drive2 requests share the spider download slot anyway
+SCHEDULER_PRIORITY_QUEUE = 'scrapy.pqueues.ScrapyPriorityQueue'
 # RANDOMIZE_DOWNLOAD_DELAY = False
 
 # Disable cookies (enabled by default)
@@ -82,26 +108,88 @@ RETRY_TIMES = 10
 DOWNLOADER_MIDDLEWARES = {
     'scrapy.downloadermiddlewares.retry.RetryMiddleware': None,
     'car_finder.middlewares.TooManyRequestsRetryMiddleware': 110,
+    'car_finder.middlewares.ProxyPoolMiddleware': 115,
     # 'car_finder.middlewares.TorProxyDownloader': 120,
     'scrapy.downloadermiddlewares.useragent.UserAgentMiddleware': None,
     'scrapy_useragents.downloadermiddlewares.useragents.UserAgentsMiddleware': 500,
+    'car_finder.replay.ReplayRecorder': 950,
+}
+# Keep-alive connections, up to DOWNLOAD_POOL_SIZE idle ones per proxy and host. Through haproxy (TOR_PROXY)
+# every open connection holds a privoxy backend, keep DOWNLOAD_POOL_SIZE <= backends * `maxconn` of
+# docker/haproxy/haproxy.cfg and DOWNLOAD_POOL_KEEPALIVE below its `timeout client`.
+# HTTP/2 (requires h2) is used only for https requests without a proxy.
+DOWNLOAD_HANDLERS = {
+    'http': 'car_finder.connections.PooledDownloadHandler',
+    'https': 'car_finder.connections.PooledDownloadHandler',
 }
+DOWNLOAD_POOL_SIZE = PROXY_POOL_CONCURRENCY if PROXY_POOL else CONCURRENT_REQUESTS_PER_DOMAIN
+DOWNLOAD_POOL_KEEPALIVE = 40
+HTTP2_ENABLED = os.getenv('HTTP2_ENABLED', '1') == '1'
+# Offline replay, see benchmarks/replay_crawl.py. REPLAY_RECORD_PATH records 200 responses to a gzip archive
+# (images too with REPLAY_RECORD_BINARY), REPLAY_SERVER_URL sends all requests to a replay server instead.
+REPLAY_RECORD_PATH = os.getenv('REPLAY_RECORD_PATH')
+REPLAY_RECORD_BINARY = False
+REPLAY_SERVER_URL = os.getenv('REPLAY_SERVER_URL')
+if REPLAY_SERVER_URL:
+    DOWNLOAD_HANDLERS = {
+        'http': 'car_finder.replay.ReplayDownloadHandler',
+        'https': 'car_finder.replay.ReplayDownloadHandler',
+    }
+# AIMD throttle of TooManyRequestsRetryMiddleware, adjusts delay and concurrency of every download slot
+# from the 429/403 rate and latency of the last THROTTLE_WINDOW responses, starting from DOWNLOAD_DELAY.
+THROTTLE_ENABLED = True
+THROTTLE_WINDOW = 50
+THROTTLE_MIN_DELAY = 0
+THROTTLE_MAX_DELAY = 30
+THROTTLE_DELAY_STEP = 0.05
+THROTTLE_BACKOFF = 2
+THROTTLE_TARGET_ERROR_RATE = 0.05
+THROTTLE_TARGET_LATENCY = 0
+THROTTLE_MAX_CONCURRENCY = PROXY_POOL_CONCURRENCY if PROXY_POOL else CONCURRENT_REQUESTS_PER_DOMAIN
 TOR_PROXY = os.getenv('TOR_PROXY')
-TOR_PASSWORD = 'qweasd12'
+TOR_PASSWORD = os.getenv('TOR_PASSWORD', 'JlzLCVylvNsa1LsvCU')
+# Tor control address of every proxy for TorProxyDownloader. TOR_PROXY, the haproxy front-end, is rotated
+# through TOR_CONTROL_HOST. Privoxy and tor of a PROXY_POOL backend share a container, so its control port
+# is on the proxy host
+TOR_CONTROL_HOST = os.getenv('TOR_CONTROL_HOST', '127.0.0.1')
+TOR_CONTROL_PORT = int(os.getenv('TOR_CONTROL_PORT', 9900))
+if PROXY_POOL:
+    TOR_CONTROLLERS = {proxy: f'{urlparse(proxy).hostname}:{TOR_CONTROL_PORT}' for proxy in PROXY_POOL}
+else:
+    TOR_CONTROLLERS = {TOR_PROXY: f'{TOR_CONTROL_HOST}:{TOR_CONTROL_PORT}'} if TOR_PROXY else {}
 # Enable or disable extensions
 # See https://doc.scrapy.org/en/latest/topics/extensions.html
 # EXTENSIONS = {
 #    'scrapy.extensions.telnet.TelnetConsole': None,
 # }
+EXTENSIONS = {
+    'car_finder.extensions.CrawlNotifier': 500,
+    'car_finder.extensions.CrawlMetrics': 510,
+}
+# CrawlMetrics: callback time, latency per download slot, response codes, retry depth, items/sec,
+# in-flight requests and request meta size, appended as JSON lines and/or served for Prometheus.
+# Enabled when METRICS_JSONL_PATH or METRICS_PORT is set.
+METRICS_JSONL_PATH = os.getenv('METRICS_JSONL_PATH')
+METRICS_INTERVAL = 30
+METRICS_HOST = '0.0.0.0'
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+# pickle meta of every Nth request to measure its size
+METRICS_META_SAMPLE = 100
 
 # Configure item pipelines
 # See https://doc.scrapy.org/en/latest/topics/item-pipeline.html
 ITEM_PIPELINES = {
-    'scrapy.pipelines.images.ImagesPipeline': 1,
-    'scrapy_redis.pipelines.RedisPipeline': 400,
+    'car_finder.pipelines.CarRecordPipeline': 0,
+    'car_finder.pipelines.CachedImagesPipeline': 1,
+    'car_finder.pipelines.BufferedRedisPipeline': 400,
+    'car_finder.pipelines.ParquetExportPipeline': 500,
 }
 
-IMAGES_STORE = '/tmp'
+# Mount a volume here to keep images and the images cache index between containers
+IMAGES_STORE = os.getenv('IMAGES_STORE', '/tmp')
+IMAGES_CACHE_INDEX = os.getenv('IMAGES_CACHE_INDEX', os.path.join(IMAGES_STORE, 'images-index'))
+# 'skip' known image urls or re-check them with 'conditional' requests
+IMAGES_CACHE_MODE = 'conditional'
 TELNETCONSOLE_ENABLED = False
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://doc.scrapy.org/en/latest/topics/autothrottle.html
@@ -118,13 +206,135 @@ TELNETCONSOLE_ENABLED = False
 
 # Enable and configure HTTP caching (disabled by default)
 # See https://doc.scrapy.org/en/latest/topics/downloader-middleware.html#httpcache-middleware-settings
-# HTTPCACHE_ENABLED = True
-# HTTPCACHE_EXPIRATION_SECS = 0
-# HTTPCACHE_DIR = 'httpcache'
+# Responses are appended to one compressed log per spider, 429/403 are never cached.
+# Listing pages are re-fetched after HTTPCACHE_LISTING_TTL, detail pages after HTTPCACHE_DETAIL_TTL seconds.
+HTTPCACHE_ENABLED = os.getenv('HTTPCACHE_ENABLED', '0') == '1'
+HTTPCACHE_EXPIRATION_SECS = 0
+HTTPCACHE_DIR = os.getenv('HTTPCACHE_DIR', 'httpcache')
 # HTTPCACHE_IGNORE_HTTP_CODES = []
-# HTTPCACHE_STORAGE = 'scrapy.extensions.httpcache.FilesystemCacheStorage'
+HTTPCACHE_POLICY = 'car_finder.httpcache.ListingAwarePolicy'
+HTTPCACHE_STORAGE = 'car_finder.httpcache.LogCacheStorage'
+HTTPCACHE_LISTING_TTL = 15 * 60
+HTTPCACHE_DETAIL_TTL = 7 * 24 * 3600
+# zlib level, 3 is as small as 6 for the pages at a third of its cost
+HTTPCACHE_COMPRESS_LEVEL = 3
+# Rewrite the log on close once replaced and expired responses take this share of it
+HTTPCACHE_COMPACT_RATIO = 0.5
 REDIS_HOST = os.getenv('REDIS_HOST', 'localhost')
 REDIS_PORT = 6379
+REDIS_ITEMS_KEY = '%(spider)s:items'
+# BufferedRedisPipeline: batch by size or time, format is one of json (item per list element), json-rows, msgpack
+REDIS_EXPORT_BATCH_SIZE = 500
+REDIS_EXPORT_FLUSH_INTERVAL = 5
+REDIS_EXPORT_FORMAT = 'json'
+# Skip items whose url_fingerprint is already in REDIS_EXPORT_DEDUPE_KEY set
+REDIS_EXPORT_DEDUPE = False
+REDIS_EXPORT_DEDUPE_KEY = '%(spider)s:fingerprints'
+# Items kept for the next flush while redis is unavailable, older ones are dropped
+REDIS_EXPORT_MAX_PENDING = 20000
+
+# ParquetExportPipeline (requires pyarrow): CarItem rows partitioned by crawl date and brand under
+# PARQUET_EXPORT_PATH. At most PARQUET_MAX_BUFFERED_ROWS rows are kept in memory.
+PARQUET_EXPORT_PATH = os.getenv('PARQUET_EXPORT_PATH')
+PARQUET_ROW_GROUP_SIZE = 10000
+PARQUET_MAX_BUFFERED_ROWS = 50000
+PARQUET_COMPRESSION = 'zstd'
+
+# Incremental crawl: listings whose list card is unchanged since the previous run
+# are reported as ListingStatusItem instead of re-fetching their detail page.
+INCREMENTAL_INDEX_PATH = os.getenv('INCREMENTAL_INDEX_PATH')
+
+# Number of listing pages per brand requested concurrently up to the total of the brand on the previous run,
+# kept in PAGINATION_STATS_PATH. Brands without a known total are paginated one page at a time.
+PAGINATION_PAGES_IN_FLIGHT = 4
+PAGINATION_STATS_PATH = os.getenv('PAGINATION_STATS_PATH', 'pagination.json')
+
+# Detail page fingerprints shared between crawls, PERSISTENT_DUPEFILTER_BACKEND is 'bloom', 'redis' or None.
+# Fingerprints expire after PERSISTENT_DUPEFILTER_TTL seconds so re-listed cars are fetched again.
+DUPEFILTER_CLASS = 'car_finder.dupefilters.PersistentDupeFilter'
+PERSISTENT_DUPEFILTER_BACKEND = os.getenv('PERSISTENT_DUPEFILTER_BACKEND')
+PERSISTENT_DUPEFILTER_TTL = 7 * 24 * 3600
+PERSISTENT_DUPEFILTER_PATH = os.getenv('PERSISTENT_DUPEFILTER_PATH', 'dupefilter')
+PERSISTENT_DUPEFILTER_CAPACITY = 10000000
+PERSISTENT_DUPEFILTER_ERROR_RATE = 0.001
+PERSISTENT_DUPEFILTER_GENERATIONS = 4
+PERSISTENT_DUPEFILTER_REDIS_KEY = '%(spider)s:seen'
+
+# Bounded memory: past SPILL_THRESHOLD pending requests the scheduler spills requests to a disk queue
+# in SPILL_DIR (the system temporary directory by default) and loads them back as the memory queue drains.
+# 0 keeps all pending requests in memory. Marshal is more compact and faster than pickle for request dicts.
+SCHEDULER = 'car_finder.scheduler.SpillingScheduler'
+SCHEDULER_DISK_QUEUE = 'scrapy.squeues.MarshalLifoDiskQueue'
+SPILL_THRESHOLD = 2000
+SPILL_DIR = os.getenv('SPILL_DIR')
+
+# Distributed mode: any number of workers share the job through redis. The first worker seeds brand start
+# requests, detail requests go to the shared queue and a brand is paginated by the worker holding its lease.
+# Try it locally with a local redis and `DISTRIBUTED_ENABLED=1 scrapy crawl Drive2` in several terminals.
+DISTRIBUTED_ENABLED = os.getenv('DISTRIBUTED_ENABLED', '0') == '1'
+DISTRIBUTED_KEY = '%(spider)s:job'
+DISTRIBUTED_LEASE_TTL = 60
+DISTRIBUTED_HEARTBEAT_INTERVAL = 15
+if DISTRIBUTED_ENABLED:
+    SCHEDULER = 'car_finder.distributed.DistributedScheduler'
+    SCHEDULER_QUEUE_CLASS = 'scrapy_redis.queue.PriorityQueue'
+    # detail page fingerprints must be shared by workers
+    PERSISTENT_DUPEFILTER_BACKEND = PERSISTENT_DUPEFILTER_BACKEND or 'redis'
+
+# Detail pages of cheaper (below PRIORITY_PRICE_BANDS rubles) and new listings are fetched first.
+# Every PRIORITY_BRAND_QUOTA detail pages of a brand lower its priority, so brands are crawled evenly.
+PRIORITY_ENABLED = True
+PRIORITY_PRICE_BANDS = [500000, 1000000, 2000000]
+PRIORITY_BRAND_QUOTA = 100
+
+# Checkpoints of long crawls: brand pagination cursors, pending detail pages and counters are saved
+# every CHECKPOINT_INTERVAL seconds to CHECKPOINT_BACKEND 'file' or 'redis'. The file is CHECKPOINT_PATH,
+# by default <spider>.checkpoint.json in JOBDIR. CHECKPOINT_RESUME=1 continues from the last checkpoint.
+CHECKPOINT_BACKEND = os.getenv('CHECKPOINT_BACKEND')
+CHECKPOINT_PATH = os.getenv('CHECKPOINT_PATH')
+CHECKPOINT_REDIS_KEY = '%(spider)s:checkpoint'
+CHECKPOINT_INTERVAL = 5
+CHECKPOINT_RESUME = os.getenv('CHECKPOINT_RESUME', '0') == '1'
+
+# Brand catalog: BRAND_CATALOG_PATH is a JSON file of brand -> carsearch context id (or -> {"id": ..., and policy
+# fields}). With BRAND_CATALOG_URL the brands are read from drive2's catalog page, cached in BRAND_CATALOG_CACHE
+# and fetched again every BRAND_CATALOG_REFRESH seconds. The built-in list is used otherwise.
+BRAND_CATALOG_PATH = os.getenv('BRAND_CATALOG_PATH')
+BRAND_CATALOG_URL = os.getenv('BRAND_CATALOG_URL')
+BRAND_CATALOG_CACHE = os.getenv('BRAND_CATALOG_CACHE', 'brands.json')
+BRAND_CATALOG_REFRESH = 7 * 24 * 3600
+
+# Per-brand crawl policy. With BRAND_SCHEDULE_PATH a run crawls only the brands crawled more than BRAND_INTERVAL
+# seconds ago, so hourly runs crawl hot brands every hour and the long tail daily. A brand requests at most
+# BRAND_MAX_PAGES listing pages and BRAND_MAX_REQUESTS detail pages per crawl, 0 for no limit.
+# BRAND_POLICIES overrides them per brand. `scrapy crawl Drive2 -a brands=toyota,bmw` crawls just these brands.
+BRAND_SCHEDULE_PATH = os.getenv('BRAND_SCHEDULE_PATH')
+BRAND_INTERVAL = 24 * 3600
+BRAND_MAX_PAGES = 0
+BRAND_MAX_REQUESTS = 0
+BRAND_POLICIES = {
+    brand: {'interval': 3600} for brand in ('toyota', 'volkswagen', 'kia', 'hyundai', 'bmw', 'mercedes')
+}
+
+# Change detection against the previous crawl: new listings, price changes and delistings are pushed to
+# CHANGES_REDIS_KEY as JSON documents, in batches of CHANGES_BATCH_SIZE. CHANGES_SNAPSHOT_PATH keeps url
+# fingerprints and prices of the last crawl (28 bytes per listing).
+CHANGES_SNAPSHOT_PATH = os.getenv('CHANGES_SNAPSHOT_PATH')
+CHANGES_REDIS_KEY = '%(spider)s:changes'
+CHANGES_BATCH_SIZE = 500
+
+# Parse listing and detail pages in a worker pool ('process' or 'thread') instead of the reactor thread.
+# PARSE_OFFLOAD_POOL_SIZE = 0 means one worker per CPU.
+PARSE_OFFLOAD_ENABLED = False
+PARSE_OFFLOAD_EXECUTOR = 'process'
+PARSE_OFFLOAD_POOL_SIZE = 0
 
 REST_API_HOST = os.getenv('REST_API_HOST', 'localhost')
 REST_API_PORT = os.getenv('REST_API_PORT', 8000)
+NOTIFIER_FINISHED_URL = f'http://{REST_API_HOST}:{REST_API_PORT}/spider-finished'
+# Progress heartbeats with the current stats, disabled with 0 interval
+NOTIFIER_PROGRESS_URL = f'http://{REST_API_HOST}:{REST_API_PORT}/spider-progress'
+NOTIFIER_HEARTBEAT_INTERVAL = 0
+NOTIFIER_TIMEOUT = 10
+NOTIFIER_RETRIES = 3
+NOTIFIER_RETRY_DELAY = 2
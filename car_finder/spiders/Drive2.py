@@ -2,172 +2,259 @@
 import logging
 from urllib import parse
 
-import requests
 import scrapy
-import json
-from lxml import html
 from scrapy import signals
-from scrapy.loader import ItemLoader
-from scrapy.utils.request import request_fingerprint
+from scrapy.utils.defer import maybe_deferred_to_future
 
-from car_finder.items import CarItem, Country
-from car_finder.settings import REST_API_HOST, REST_API_PORT
+from car_finder.brands import BrandCatalog
+from car_finder.changes import ChangeTracker
+from car_finder.checkpoint import Checkpointer
+from car_finder.distributed import JobCoordinator
+from car_finder.incremental import ListingIndex
+from car_finder.extractors import extract_car_sale_info, parse_brand_catalog, parse_listing_page
+from car_finder.items import CarRecord, ListingStatusItem, extract_price, normalize
+from car_finder.metrics import timed
+from car_finder.normalizers import set_exchange_rates
+from car_finder.offload import ParseOffloader
+from car_finder.pagination import PaginationScheduler, save_totals
+from car_finder.priorities import PriorityPolicy
 
 logger = logging.getLogger(__name__)
 
-car_brands_map = {
-    'alfaromeo': 'b_17',
-    'audi': 'b_2',
-    'bmw': 'b_3',
-    'chevrolet': 'b_20',
-    'citroen': 'b_4',
-    'ford': 'b_40',
-    'honda': 'b_43',
-    'infiniti': 'b_7',
-    'kia': 'b_25',
-    'lexus': 'b_9',
-    'mazda': 'b_29',
-    'mercedes': 'b_47',
-    'mitsubishi': 'b_51',
-    'nissan': 'b_52',
-    'opel': 'b_54',
-    'saab': 'b_30',
-    'seat': 'b_14',
-    'skoda': 'b_15',
-    'subaru': 'b_62',
-    'suzuki': 'b_63',
-    'toyota': 'b_64',
-    'volvo': 'b_16',
-    'volkswagen': 'b_65',
-    'hyundai': 'b_6',
-}
-inverted_map = {a: b for b, a in car_brands_map.items()}
 url_template = 'https://www.drive2.com/ajax/carsearch.cshtml?context={brand_id}&start={start}&sort=Selling'
-base_url = 'https://www.drive2.com{}'
 
 
 class Drive2Spider(scrapy.Spider):
     name = 'Drive2'
     handle_httpstatus_list = [429]
-    allowed_domains = ['www.drive2.com', 'drive2.com', 'www.drive2.ru', 'drive2.ru']
-    start_urls = [url_template.format(brand_id=brand_id, start=0) for _, brand_id in car_brands_map.items()]
-    counter = {brand: 0 for brand in car_brands_map.keys()}
+    # listing photos are served from a.d-cd.net
+    allowed_domains = ['www.drive2.com', 'drive2.com', 'www.drive2.ru', 'drive2.ru', 'd-cd.net']
+
+    def __init__(self, brands=None, *args, **kwargs):
+        """
+        :param brands: comma separated brands to crawl, e.g. `scrapy crawl Drive2 -a brands=toyota,bmw`,
+            by default the brands which are due according to their crawl intervals
+        """
+        super().__init__(*args, **kwargs)
+        self.brand_names = [name.strip() for name in brands.split(',') if name.strip()] if brands else None
+        self.brands = []
+        self.counter = {}
 
     @classmethod
     def from_crawler(cls, crawler, *args, **kwargs):
         spider = super().from_crawler(crawler, *args, **kwargs)
+        set_exchange_rates(crawler.settings.getdict('EXCHANGE_RATES'))
+        spider.catalog = BrandCatalog.from_settings(crawler.settings)
+        spider.listing_index = ListingIndex.from_settings(crawler.settings)
+        if spider.listing_index:
+            spider.listing_index.open()
+        spider.pagination = PaginationScheduler.from_settings(crawler.settings)
+        spider.offloader = ParseOffloader.from_settings(crawler.settings)
+        spider.checkpointer = Checkpointer.from_crawler(crawler)
+        spider.priorities = PriorityPolicy.from_crawler(crawler)
+        spider.changes = ChangeTracker.from_crawler(crawler)
+        spider.select_brands()
+        spider.coordinator = JobCoordinator.from_crawler(crawler, spider.brands)
         crawler.signals.connect(spider.spider_closed, signal=signals.spider_closed)
         return spider
 
+    def select_brands(self):
+        self.brands = self.catalog.select(self.brand_names)
+        self.counter = {brand: self.counter.get(brand, 0) for brand in self.brands}
+        if self.changes and len(self.brands) < len(self.catalog.brands):
+            self.changes.mark_incomplete(f'{len(self.brands)} of {len(self.catalog.brands)} brands are crawled')
+
     def spider_closed(self, spider):
         spider.logger.info('Spider closed: %s', spider.name)
-        url = f'http://{REST_API_HOST}:{REST_API_PORT}/spider-finished'
-        requests.post(url)
+        if self.listing_index:
+            self.listing_index.close()
+        save_totals(self.settings.get('PAGINATION_STATS_PATH'), self.counter)
+        self.catalog.save()
+        self.offloader.close()
 
-    def parse(self, response, **kwargs):
-        d = json.loads(response.body.strip())
-        next_start = d.get('start', None)
-        brand_id = self.get_brand_id(response.url)
-        brand = inverted_map[brand_id]
-        for item in self.parse_list_of_sales(d['html'], brand_id):
-            yield item
-        if next_start and brand_id:
-            yield scrapy.Request(url_template.format(brand_id=brand_id, start=next_start), meta=dict(download_slot=self.name))
+    async def start(self):
+        if self.coordinator and not self.coordinator.seed():
+            return
+        checkpoint = self.checkpointer.resume() if self.checkpointer else None
+        if checkpoint is not None:
+            if self.changes:
+                self.changes.mark_incomplete('crawl resumed from a checkpoint')
+            for request in self.resume(checkpoint):
+                yield request
+            return
+        if self.catalog.stale():
+            yield scrapy.Request(self.catalog.url, meta={'download_slot': self.name}, dont_filter=True,
+                                 callback=self.parse_catalog, errback=self.catalog_failed)
+            return
+        for request in self.start_brands():
+            yield request
+
+    def start_brands(self):
+        for brand in self.brands:
+            if self.catalog.take_page(brand):
+                # any worker may take the first page of a brand and its lease
+                yield self.brand_request(brand, lease=False)
+
+    def parse_catalog(self, response):
+        brands = parse_brand_catalog(response.text)
+        if brands:
+            self.catalog.update(brands)
+            self.select_brands()
         else:
-            logger.info(f'Finished to parse brand: {brand}. Found {self.counter[inverted_map[brand_id]]} cars.')
+            logger.error(f'No brands found in the catalog {response.url}, using {len(self.catalog.brands)} known brands')
+        return self.start_brands()
 
-    def parse_list_of_sales(self, s, brand_id):
-        try:
-            tree = html.fromstring(s)
-            for el in tree.xpath('//body/div/div[contains(@class, "c-car-card-sa")]'):
-                price = self.get_price(el)
-                title = self.get_title(el)
-                url = self.get_url(el)
-                image_url = self.get_img_url(el)
-                geo = self.get_geo(el)
-                if title:
-                    self.counter[inverted_map[brand_id]] += 1
-                    country_loader = ItemLoader(item=Country())
-                    country_loader.add_value('country', geo)
-                    loader = ItemLoader(item=CarItem())
-                    loader.add_value('price', price)
-                    loader.add_value('title', title)
-                    loader.add_value('url', url)
-                    loader.add_value('city', geo)
-                    loader.add_value('country', geo)
-                    loader.add_value('image_urls', image_url)
-                    yield scrapy.Request(url, meta={'loader': loader, 'download_slot': self.name}, callback=self.parse_car_sale_info)
-        except Exception as e:
-            logger.error(f'Failed to parse body. Error: {e}')
+    def catalog_failed(self, failure):
+        logger.error(f'Failed to fetch the brand catalog: {failure.value}')
+        return self.start_brands()
 
-    def parse_car_sale_info(self, response):
-        loader = response.meta['loader']
-        try:
-            loader.add_value('url_fingerprint', request_fingerprint(response.request))
-            loader.add_value('manufactured', self.get_years(response))
-            loader.add_value('purchased', self.get_years(response))
-            loader.add_value('brand', self.get_brand(response))
-            loader.add_value('model', self.get_model(response))
-            loader.add_value('generation', self.get_generation(response))
-            yield loader.load_item()
-        except Exception as e:
-            logger.error(f'Can not parse car info: {e}')
+    def checkpoint_state(self):
+        return {'counter': self.counter, 'pagination': self.pagination.get_state()}
 
-    def get_img_url(self, el):
-        try:
-            return el.xpath('div/div/img')[0].attrib['src']
-        except Exception as e:
-            logger.error(f'Can not parse image url: {e}')
+    def resume(self, checkpoint):
+        """
+        Restores counters and pagination cursors, requests pages which were in flight and
+        brands which were not started yet. Requests seen before the crash are not filtered again.
+        """
+        self.counter.update(checkpoint['counter'])
+        self.pagination.set_state(checkpoint['pagination'])
+        if checkpoint['queued']:
+            # pending requests are in the JOBDIR scheduler queue
+            return
+        for brand in self.brands:
+            pages = self.pagination.brands.get(brand)
+            if pages is None:
+                yield self.brand_request(brand)
+            elif not pages.finished and not pages.in_flight:
+                yield self.restart_brand(brand)
+            else:
+                for start in sorted(pages.in_flight):
+                    yield self.brand_request(brand, start).replace(dont_filter=True)
+        for pending in checkpoint['pending'].values():
+            yield self.detail_request(pending['brand'], pending['card']).replace(dont_filter=True)
 
-    def get_years(self, response):
-        try:
-            years_pattern = "//div[@class='c-car-forsale']/ul/li[contains(text(), 'Manufactured') or contains(text(), 'Purchased')]"
-            return response.xpath(years_pattern)[0].extract()
-        except (IndexError, AttributeError):
-            logger.debug('Can not parse years')
+    def brand_request(self, brand, start=0, lease=True):
+        """
+        :param lease: in distributed mode the request stays on this worker, which holds the brand lease
+        """
+        meta = dict(download_slot=self.name)
+        if self.coordinator and lease:
+            # pagination of a leased brand stays on this worker
+            meta['lease'] = brand
+        priority = self.priorities.page(brand) if self.priorities else 0
+        return scrapy.Request(url_template.format(brand_id=self.catalog.brand_id(brand), start=start), meta=meta,
+                              priority=priority, dont_filter=not start, errback=self.page_failed)
 
-    def get_brand(self, response):
-        try:
-            return response.xpath('//a[@data-ym-target="car2brand"]/text()')[0].extract()
-        except (IndexError, AttributeError):
-            logger.debug('Can not parse brand')
+    def restart_brand(self, brand):
+        self.pagination.brands.pop(brand, None)
+        self.counter[brand] = 0
+        return self.brand_request(brand)
 
-    def get_model(self, response):
-        try:
-            return response.xpath('//a[@data-ym-target="car2model"]/text()')[0].extract()
-        except (IndexError, AttributeError):
-            logger.debug('Can not parse model')
+    @timed()
+    async def parse(self, response, **kwargs):
+        brand_id = self.get_brand_id(response.url)
+        brand = self.catalog.brand_of(brand_id)
+        if self.coordinator and not self.coordinator.hold(brand):
+            logger.info(f'Brand {brand} is crawled by another worker')
+            return
+        next_start, cards = await maybe_deferred_to_future(self.offloader.run(parse_listing_page, response.body))
+        found = len(cards)
+        for item in self.parse_list_of_sales(cards, brand_id):
+            yield item
+        start = self.get_start(response.url)
+        offsets = self.pagination.page_done(brand, start, int(next_start or 0), found)
+        for i, offset in enumerate(offsets):
+            if not self.catalog.take_page(brand):
+                self.pagination.stop(brand, offsets[i:])
+                self.budget_spent(brand)
+                break
+            yield self.brand_request(brand, offset)
+        if self.pagination.get(brand).finished:
+            logger.info(f'Finished to parse brand: {brand}. Found {self.counter[brand]} cars.')
+            self.catalog.crawled(brand)
+            if self.coordinator:
+                self.coordinator.brand_finished(brand, self.counter[brand])
 
-    def get_generation(self, response):
-        try:
-            return response.xpath('//a[@data-ym-target="car2gen"]/text()')[0].extract()
-        except (IndexError, AttributeError):
-            logger.debug('Can not parse generation')
+    def page_failed(self, failure):
+        url = failure.request.url
+        logger.error(f'Failed to fetch page {url}: {failure.value}')
+        brand = self.catalog.brand_of(self.get_brand_id(url))
+        self.pagination.page_failed(brand, self.get_start(url))
+        if self.changes:
+            self.changes.mark_incomplete(f'listing page {url} was lost')
+        if self.coordinator and self.pagination.get(brand).finished:
+            self.coordinator.brand_finished(brand, self.counter[brand])
 
-    def get_price(self, el):
-        try:
-            return el.xpath('div//span[@class="c-car-card-sa__price"]')[0].text
-        except (IndexError, AttributeError):
-            logger.debug(f'Can not parse price from elem: {el}')
+    @timed()
+    def parse_list_of_sales(self, cards, brand_id):
+        brand = self.catalog.brand_of(brand_id)
+        for card in cards:
+            self.counter[brand] += 1
+            status = None
+            if self.listing_index:
+                status, fingerprint = self.listing_index.lookup(card)
+                self.crawler.stats.inc_value(f'incremental/{status}')
+                if status == 'unchanged':
+                    item = ListingStatusItem(url_fingerprint=fingerprint, url=card['url'], price=normalize(extract_price, card['price']), status=status)
+                    if self.changes:
+                        self.changes.observe(fingerprint, item['price'], card['url'])
+                    yield item
+                    continue
+            if not self.catalog.take_request(brand):
+                self.budget_spent(brand)
+                continue
+            request = self.detail_request(brand, card, status)
+            if self.changes:
+                # known listings may never reach the detail page callback (persistent dupefilter)
+                self.changes.observe(request.meta['persist_fingerprint'], normalize(extract_price, card['price']),
+                                     card['url'])
+            yield request
 
-    def get_title(self, el):
-        try:
-            return el.xpath('div//span[@class="c-car-title  c-link"]')[0].text
-        except (IndexError, AttributeError):
-            logger.debug(f'Can not parse title from elem: {el}')
+    def budget_spent(self, brand):
+        self.crawler.stats.inc_value('brands/over_budget')
+        if self.changes:
+            self.changes.mark_incomplete(f'brand {brand} has spent its budget')
 
-    def get_url(self, el):
-        try:
-            url = el.xpath('a[@class="u-link-area"]')[0].attrib['href']
-            return base_url.format(url)
-        except (IndexError, AttributeError):
-            logger.debug(f'Can not parse url from elem: {el}')
+    def detail_request(self, brand, card, status=None):
+        meta = {'card': card, 'brand': brand, 'download_slot': self.name}
+        if self.checkpointer:
+            meta['checkpoint'] = {'brand': brand, 'card': card}
+        if status == 'changed':
+            # fetched by the previous crawl, neither the dupefilter nor the http cache may skip it
+            meta['refresh'] = True
+        priority = 0
+        if self.priorities:
+            priority = self.priorities.detail(brand, normalize(extract_price, card['price']), status)
+        request = scrapy.Request(card['url'], meta=meta, priority=priority, dont_filter=status == 'changed',
+                                 callback=self.parse_car_sale_info, errback=self.detail_failed)
+        # url_fingerprint of the listing, kept through redirects
+        request.meta['persist_fingerprint'] = self.fingerprint(request)
+        return request
 
-    def get_geo(self, el):
+    def detail_failed(self, failure):
+        logger.error(f'Failed to fetch car sale {failure.request.url}: {failure.value}')
+        if self.priorities:
+            self.priorities.detail_done(failure.request.meta['brand'])
+
+    @timed()
+    async def parse_car_sale_info(self, response):
+        card = response.meta['card']
+        if self.priorities:
+            self.priorities.detail_done(response.meta['brand'])
         try:
-            return el.xpath('div/div[@class="c-car-card-sa__location"]/span')[0].text
-        except (IndexError, AttributeError):
-            logger.debug(f'Can not parse geo from elem: {el}')
+            fingerprint = response.meta['persist_fingerprint']
+            info = await maybe_deferred_to_future(self.offloader.run(extract_car_sale_info, response.text))
+            yield CarRecord.from_card(card, info, fingerprint)
+            if self.listing_index:
+                self.listing_index.remember(card, fingerprint)
+        except Exception as e:
+            logger.error(f'Can not parse car info: {e}')
+
+    def fingerprint(self, request):
+        """
+        :return: hex request fingerprint, the url_fingerprint of items
+        """
+        return self.crawler.request_fingerprinter.fingerprint(request).hex()
 
     def get_brand_id(self, url):
         try:
@@ -177,20 +264,11 @@ class Drive2Spider(scrapy.Spider):
         except IndexError:
             logger.debug(f'Can\'t get brand id from url: f{url}.')
 
-    def get_car_attr(self, el, filter_str):
+    def get_start(self, url):
         try:
-            return el.xpath(f"//div[@class='c-car-forsale']/ul/li[contains(text(), {filter_str})]")[0].extract()
-        except IndexError:
-            logger.debug(f'Could not get attribute by filter {filter_str}')
-
-    def get_mileage(self, el):
-        return self.get_car_attr(el, 'Mileage')
-
-    def get_engine_info(self, el):
-        return self.get_car_attr(el, 'Engine')
-
-    def get_gearbox_type(self, el):
-        try:
-            return el.xpath("//div[@class='c-car-forsale']/ul/li[contains(text(), 'Manual') or contains(text(), 'Automatic')]")[0].extract()
-        except IndexError:
-            logger.debug(f'Could not get gearbox type')
+            parsed = parse.urlparse(url)
+            qs = parse.parse_qs(parsed.query)
+            return int(qs['start'][0])
+        except (KeyError, IndexError, ValueError):
+            logger.debug(f'Can\'t get start offset from url: {url}.')
+            return 0
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import json
+
+from scrapy import Request, Spider
+from scrapy.utils.test import get_crawler
+from twisted.trial import unittest
+
+from car_finder.checkpoint import Checkpointer
+
+
+class MemoryStore:
+    def __init__(self):
+        self.saved = []
+
+    def save(self, data):
+        self.saved.append(json.loads(data))
+
+
+class CheckpointSpider(Spider):
+    name = 'test'
+    counter = {}
+
+    def checkpoint_state(self):
+        return {'counter': dict(self.counter)}
+
+
+class CheckpointerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.spider = CheckpointSpider()
+        self.spider.counter = {'toyota': 0}
+        self.store = MemoryStore()
+        self.checkpointer = Checkpointer(get_crawler(CheckpointSpider, {'TWISTED_REACTOR': None}), self.store, 5, False)
+        self.checkpointer.spider = self.spider
+
+    def test_saves_only_changes(self):
+        request = Request('https://www.drive2.com/cars/1/', meta={'checkpoint': {'brand': 'toyota'}})
+        self.checkpointer.save()
+        self.checkpointer.save()
+        self.assertEqual(len(self.store.saved), 1)
+
+        self.checkpointer.request_scheduled(request, self.spider)
+        self.checkpointer.save()
+        self.assertEqual(self.store.saved[-1]['pending'], {request.url: {'brand': 'toyota'}})
+
+        self.spider.counter['toyota'] = 20
+        self.checkpointer.save()
+        self.assertEqual(self.store.saved[-1]['counter'], {'toyota': 20})
+
+        self.checkpointer.request_done(Request('https://www.drive2.com/cars/2/'), self.spider)
+        self.checkpointer.save()
+        self.assertEqual(len(self.store.saved), 3)
+
+        self.checkpointer.request_done(request, self.spider)
+        self.checkpointer.save()
+        self.assertEqual(self.store.saved[-1]['pending'], {})
+        self.assertEqual(len(self.store.saved), 4)
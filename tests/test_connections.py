@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from h2.exceptions import ProtocolError
+from twisted.internet.error import ConnectionLost, TimeoutError
+from twisted.python.failure import Failure
+from twisted.web._newclient import ResponseFailed
+
+from car_finder.connections import http2_unsupported
+
+
+def wrapped(error):
+    """
+    :return: `error` as raised by Scrapy download handlers wrapping twisted errors
+    """
+    try:
+        raise RuntimeError(str(error)) from error
+    except RuntimeError as e:
+        return e
+
+
+class Http2UnsupportedTest(unittest.TestCase):
+
+    def test_protocol_errors(self):
+        self.assertTrue(http2_unsupported(ProtocolError('invalid frame')))
+        self.assertTrue(http2_unsupported(wrapped(ResponseFailed([ProtocolError('invalid frame')]))))
+
+    def test_network_errors(self):
+        self.assertFalse(http2_unsupported(wrapped(TimeoutError())))
+        self.assertFalse(http2_unsupported(wrapped(ResponseFailed([Failure(ConnectionLost())]))))
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import tempfile
+
+from scrapy import Request, Spider, signals
+from scrapy.http import HtmlResponse
+from scrapy.utils.test import get_crawler
+from twisted.trial import unittest
+
+from car_finder.dupefilters import PersistentDupeFilter
+
+
+class DetailSpider(Spider):
+    name = 'test'
+
+
+class PersistentDupeFilterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.crawler = get_crawler(DetailSpider, {
+            'TWISTED_REACTOR': None,
+            'PERSISTENT_DUPEFILTER_BACKEND': 'bloom',
+            'PERSISTENT_DUPEFILTER_PATH': self.path,
+            'PERSISTENT_DUPEFILTER_CAPACITY': 1000,
+            'PERSISTENT_DUPEFILTER_ERROR_RATE': 0.001,
+            'PERSISTENT_DUPEFILTER_TTL': 3600,
+            'PERSISTENT_DUPEFILTER_GENERATIONS': 4,
+        })
+
+    def open_dupefilter(self):
+        dupefilter = PersistentDupeFilter.from_crawler(self.crawler)
+        dupefilter.open()
+        self.addCleanup(dupefilter.close, 'finished')
+        return dupefilter
+
+    def fetched(self, request, status=200):
+        response = HtmlResponse(request.url, status=status, request=request)
+        self.crawler.signals.send_catch_log(signals.response_received, response=response, request=request,
+                                            spider=self.crawler.spider)
+
+    def test_fetched_pages_are_filtered_by_next_crawl(self):
+        fetched = Request('https://www.drive2.com/cars/1/', meta={'persist_fingerprint': True})
+        failed = Request('https://www.drive2.com/cars/2/', meta={'persist_fingerprint': True})
+        dupefilter = self.open_dupefilter()
+        self.assertFalse(dupefilter.request_seen(fetched))
+        self.assertFalse(dupefilter.request_seen(failed))
+        self.assertTrue(dupefilter.request_seen(failed.copy()))
+        self.fetched(fetched)
+        self.fetched(failed, status=500)
+        dupefilter.close('finished')
+
+        dupefilter = self.open_dupefilter()
+        self.assertTrue(dupefilter.request_seen(fetched.copy()))
+        self.assertFalse(dupefilter.request_seen(failed.copy()))
+
+    def test_keeps_given_fingerprint(self):
+        request = Request('https://www.drive2.com/cars/1/', meta={'persist_fingerprint': True})
+        fingerprint = self.crawler.request_fingerprinter.fingerprint(request).hex()
+        redirected = request.replace(url='https://www.drive2.ru/cars/1/',
+                                     meta={'persist_fingerprint': fingerprint})
+        dupefilter = self.open_dupefilter()
+        self.fetched(redirected)
+        self.assertIn(fingerprint, dupefilter.store)
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+from types import SimpleNamespace
+
+from scrapy import Spider
+from scrapy.utils.test import get_crawler
+from twisted.internet import defer, reactor, task
+from twisted.trial import unittest
+from twisted.web import resource, server
+
+from car_finder.extensions import CrawlMetrics, CrawlNotifier, registry
+from car_finder.metrics import enable_timing
+
+
+class StubApi(resource.Resource):
+    """
+    Records posted JSON payloads. Answers with `codes` in turn, None never answers.
+    """
+    isLeaf = True
+
+    def __init__(self, codes=()):
+        super().__init__()
+        self.codes = list(codes)
+        self.payloads = []
+
+    def render_POST(self, request):
+        self.payloads.append(json.loads(request.content.read()))
+        code = self.codes.pop(0) if self.codes else 200
+        if code is None:
+            return server.NOT_DONE_YET
+        request.setResponseCode(code)
+        return b'{}'
+
+
+class NotifiedSpider(Spider):
+    name = 'test'
+
+
+class CrawlNotifierTest(unittest.TestCase):
+
+    def start_api(self, codes=()):
+        api = StubApi(codes)
+        port = reactor.listenTCP(0, server.Site(api), interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        return api, f'http://127.0.0.1:{port.getHost().port}'
+
+    def make_notifier(self, url, **settings):
+        settings = dict({
+            'TWISTED_REACTOR': None,
+            'NOTIFIER_FINISHED_URL': f'{url}/spider-finished',
+            'NOTIFIER_PROGRESS_URL': f'{url}/spider-progress',
+            'NOTIFIER_HEARTBEAT_INTERVAL': 0,
+            'NOTIFIER_TIMEOUT': 1,
+            'NOTIFIER_RETRIES': 2,
+            'NOTIFIER_RETRY_DELAY': 0.01,
+        }, **settings)
+        crawler = get_crawler(NotifiedSpider, settings)
+        spider = NotifiedSpider()
+        spider.counter = {'toyota': 3}
+        crawler.stats.set_value('item_scraped_count', 3)
+        notifier = CrawlNotifier.from_crawler(crawler)
+        notifier.spider_opened(spider)
+        self.addCleanup(notifier.pool.closeCachedConnections)
+        return notifier, spider
+
+    @defer.inlineCallbacks
+    def test_finished_payload(self):
+        api, url = self.start_api()
+        notifier, spider = self.make_notifier(url)
+        yield notifier.spider_closed(spider, 'finished')
+        self.assertEqual(len(api.payloads), 1)
+        payload = api.payloads[0]
+        self.assertEqual(payload['spider'], 'test')
+        self.assertEqual(payload['reason'], 'finished')
+        self.assertEqual(payload['brands'], {'toyota': 3})
+        self.assertEqual(payload['items'], 3)
+
+    @defer.inlineCallbacks
+    def test_retries_server_errors(self):
+        api, url = self.start_api(codes=[503, 502])
+        notifier, spider = self.make_notifier(url)
+        accepted = yield notifier.post(notifier.finished_url, {'n': 1})
+        self.assertTrue(accepted)
+        self.assertEqual(len(api.payloads), 3)
+
+    @defer.inlineCallbacks
+    def test_retries_timeouts(self):
+        api, url = self.start_api(codes=[None])
+        notifier, spider = self.make_notifier(url, NOTIFIER_TIMEOUT=0.2)
+        accepted = yield notifier.post(notifier.finished_url, {'n': 1})
+        self.assertTrue(accepted)
+        self.assertEqual(len(api.payloads), 2)
+
+    @defer.inlineCallbacks
+    def test_gives_up(self):
+        api, url = self.start_api(codes=[500, 500, 500])
+        notifier, spider = self.make_notifier(url)
+        accepted = yield notifier.post(notifier.finished_url, {'n': 1})
+        self.assertFalse(accepted)
+        self.assertEqual(len(api.payloads), 3)
+
+    @defer.inlineCallbacks
+    def test_heartbeats(self):
+        api, url = self.start_api()
+        notifier, spider = self.make_notifier(url, NOTIFIER_HEARTBEAT_INTERVAL=0.1)
+        yield task.deferLater(reactor, 0.35, lambda: None)
+        yield notifier.spider_closed(spider, 'finished')
+        self.assertFalse(notifier.heartbeat.running)
+        reasons = [payload.get('reason') for payload in api.payloads]
+        self.assertGreaterEqual(reasons.count(None), 2)
+        self.assertEqual(reasons[-1], 'finished')
+
+
+class CrawlMetricsTest(unittest.TestCase):
+
+    def test_items_per_second_by_exporter(self):
+        crawler = get_crawler(NotifiedSpider, {'TWISTED_REACTOR': None, 'METRICS_PORT': 9999})
+        crawler.engine = SimpleNamespace(downloader=SimpleNamespace(active=set()))
+        metrics = CrawlMetrics.from_crawler(crawler)
+        self.addCleanup(enable_timing, False)
+        metrics.started = time.time() - 10
+        crawler.stats.set_value('item_scraped_count', 100)
+        metrics.update_gauges('jsonl')
+        # trial's assertAlmostEqual has no delta, the rate is 100 items over a little more than 10s
+        self.assertLess(abs(registry.gauges['items_per_second'] - 10), 0.1)
+        # a scrape right after the JSON lines export still covers the whole crawl
+        metrics.update_gauges('prometheus')
+        self.assertLess(abs(registry.gauges['items_per_second'] - 10), 0.1)
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+import json
+import unittest
+
+from car_finder.extractors import base_url, parse_listing_page
+
+CARD = ('<div class="c-car-card-sa">'
+        '<div class="c-badge"><a class="u-link-area" href="/users/dealer/"><img src="https://a.d-cd.net/badge.png"></a>'
+        '</div>'
+        '<a class="u-link-area" href="/cars/toyota/camry/1/"></a>'
+        '<div><div><img src="https://a.d-cd.net/photo.jpg"></div>'
+        '<div><div class="c-car-card-sa__location"><span>Elsewhere</span></div></div>'
+        '<div class="c-car-card-sa__location"><span>Moscow</span></div>'
+        '<span class="c-car-card-sa__price">1 500 000 ₽</span>'
+        '<span class="c-car-title  c-link">Toyota Camry</span></div>'
+        '</div>')
+
+
+def page(cards):
+    return json.dumps({'start': 20, 'html': f'<div>{cards}</div>'}).encode()
+
+
+class ParseListingPageTest(unittest.TestCase):
+
+    def test_card_fields_at_their_paths(self):
+        next_start, cards = parse_listing_page(page(CARD))
+        self.assertEqual(next_start, 20)
+        self.assertEqual(cards, [{
+            'price': '1 500 000 ₽',
+            'title': 'Toyota Camry',
+            'url': base_url.format('/cars/toyota/camry/1/'),
+            'image_url': 'https://a.d-cd.net/photo.jpg',
+            'geo': 'Moscow',
+        }])
+
+    def test_cards_without_title_are_skipped(self):
+        self.assertEqual(parse_listing_page(page('<div class="c-car-card-sa"><div></div></div>'))[1], [])
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from scrapy import Request, Spider
+from scrapy.utils.test import get_crawler
+from twisted.trial import unittest
+
+from car_finder.fingerprints import LegacyRequestFingerprinter
+
+
+class FingerprintSpider(Spider):
+    name = 'test'
+
+
+class LegacyRequestFingerprinterTest(unittest.TestCase):
+
+    def test_matches_request_fingerprint(self):
+        # hex digests of scrapy.utils.request.request_fingerprint on Scrapy 2.6
+        fingerprinter = LegacyRequestFingerprinter()
+        self.assertEqual(fingerprinter.fingerprint(Request('https://www.drive2.com/cars/toyota/1/')).hex(),
+                         '0f59a336b0d0156eeee2f3c4ebb3d882b4c2b517')
+        self.assertEqual(fingerprinter.fingerprint(Request('https://www.drive2.com/cars/?b=2&a=1#photo')).hex(),
+                         '80e4b5f46e20a465882424d6290cd6f94d1974f0')
+
+    def test_is_the_crawler_fingerprinter(self):
+        crawler = get_crawler(FingerprintSpider, {
+            'TWISTED_REACTOR': None,
+            'REQUEST_FINGERPRINTER_CLASS': 'car_finder.fingerprints.LegacyRequestFingerprinter',
+        })
+        self.assertIsInstance(crawler.request_fingerprinter, LegacyRequestFingerprinter)
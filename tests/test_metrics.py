@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import time
+import unittest
+
+from car_finder import metrics
+from car_finder.metrics import Registry, enable_timing, timed
+
+
+class TimedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(setattr, metrics, 'registry', metrics.registry)
+        self.registry = metrics.registry = Registry()
+        enable_timing()
+        self.addCleanup(enable_timing, False)
+
+    def seconds(self, callback):
+        return self.registry.histogram('callback_seconds', callback=callback).sum
+
+    def test_nested_callbacks_report_self_time(self):
+        @timed('inner')
+        def inner():
+            for i in range(3):
+                time.sleep(0.05)
+                yield i
+
+        @timed('outer')
+        async def outer():
+            for i in inner():
+                time.sleep(0.01)
+                yield i
+            await asyncio.sleep(0.2)
+
+        async def consume():
+            return [i async for i in outer()]
+
+        self.assertEqual(asyncio.run(consume()), [0, 1, 2])
+        # bounds leave room for sleep overshoot on a loaded machine
+        self.assertGreaterEqual(self.seconds('inner'), 0.15)
+        self.assertLess(self.seconds('inner'), 0.3)
+        # neither the 0.15s of inner nor the 0.2s await
+        self.assertGreaterEqual(self.seconds('outer'), 0.03)
+        self.assertLess(self.seconds('outer'), 0.15)
+
+    def test_async_generator_is_closed(self):
+        closed = []
+
+        @timed('callback')
+        async def callback():
+            try:
+                yield 1
+                yield 2
+            finally:
+                closed.append(True)
+
+        async def take_one():
+            results = callback()
+            await results.__anext__()
+            await results.aclose()
+            # not left to the event loop shutdown
+            return list(closed)
+
+        self.assertEqual(asyncio.run(take_one()), [True])
+        self.assertEqual(self.registry.histogram('callback_seconds', callback='callback').count, 1)
+
+    def test_not_timed_unless_enabled(self):
+        enable_timing(False)
+
+        @timed('callback')
+        def callback():
+            yield 1
+
+        self.assertEqual(list(callback()), [1])
+        self.assertEqual(self.registry.to_dict()['histograms'], {})
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from scrapy import Request, Spider
+from scrapy.exceptions import IgnoreRequest
+from scrapy.utils.test import get_crawler
+from twisted.internet.error import TimeoutError
+from twisted.trial import unittest
+
+from car_finder.middlewares import ProxyPoolMiddleware
+
+PROXY = 'http://privoxy1:8118'
+
+
+class ProxySpider(Spider):
+    name = 'test'
+
+
+class ProxyPoolMiddlewareTest(unittest.TestCase):
+
+    def setUp(self):
+        crawler = get_crawler(ProxySpider, {
+            'TWISTED_REACTOR': None,
+            'PROXY_POOL': [PROXY],
+            'PROXY_POOL_WINDOW': 4,
+            'PROXY_POOL_MAX_ERROR_RATE': 0.5,
+            'PROXY_POOL_QUARANTINE': 120,
+        })
+        self.spider = ProxySpider()
+        self.middleware = ProxyPoolMiddleware.from_crawler(crawler)
+        self.state = self.middleware.proxies[PROXY]
+
+    def fail(self, exception, times=4):
+        for i in range(times):
+            request = Request(f'https://www.drive2.com/cars/{i}/')
+            self.middleware.process_request(request, self.spider)
+            self.assertEqual(request.meta['download_slot'], 'proxy:privoxy1')
+            self.middleware.process_exception(request, exception, self.spider)
+
+    def test_transport_errors_quarantine(self):
+        self.fail(TimeoutError())
+        self.assertGreater(self.state.quarantined_until, 0)
+        self.assertEqual(self.state.in_flight, 0)
+
+    def test_ignored_requests_are_not_errors(self):
+        self.fail(IgnoreRequest())
+        self.assertEqual(self.state.quarantined_until, 0)
+        self.assertEqual(len(self.state.errors), 0)
+        self.assertEqual(self.state.in_flight, 0)
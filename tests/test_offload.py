@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from car_finder.offload import ParseOffloader
+
+
+def parse_in_parent(text):
+    if multiprocessing.parent_process() is not None:
+        # the worker dies while parsing
+        os._exit(1)
+    return text.upper()
+
+
+class ParseOffloaderTest(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def test_parses_in_pool(self):
+        offloader = ParseOffloader(ProcessPoolExecutor(1))
+        self.addCleanup(offloader.close)
+        result = yield offloader.run(str.upper, 'page')
+        self.assertEqual(result, 'PAGE')
+
+    @defer.inlineCallbacks
+    def test_dead_worker_falls_back_to_inline(self):
+        offloader = ParseOffloader(ProcessPoolExecutor(1))
+        self.addCleanup(offloader.close)
+        results = yield defer.gatherResults([offloader.run(parse_in_parent, 'page'),
+                                             offloader.run(parse_in_parent, 'next page')])
+        self.assertEqual(results, ['PAGE', 'NEXT PAGE'])
+        self.assertIsNone(offloader.executor)
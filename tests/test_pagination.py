@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import tempfile
+
+from twisted.trial import unittest
+
+from car_finder.pagination import PaginationScheduler, save_totals
+
+STRIDE = 20
+
+
+def crawl_brand(scheduler, pages):
+    """
+    Paginates a brand of `pages` full listing pages, responses arrive in request order.
+    :return: requested offsets
+    """
+    requested = [0]
+    pending = [0]
+    while pending:
+        start = pending.pop(0)
+        found = STRIDE if start < pages * STRIDE else 0
+        next_start = start + STRIDE if start + STRIDE < pages * STRIDE else None
+        offsets = scheduler.page_done('toyota', start, next_start or 0, found)
+        requested.extend(offsets)
+        pending.extend(offsets)
+    return requested
+
+
+class PaginationSchedulerTest(unittest.TestCase):
+
+    def test_unknown_total_is_chained(self):
+        scheduler = PaginationScheduler(max_in_flight=4)
+        self.assertEqual(crawl_brand(scheduler, 5), [page * STRIDE for page in range(5)])
+        self.assertTrue(scheduler.get('toyota').finished)
+
+    def test_known_total_fans_out_without_extra_requests(self):
+        scheduler = PaginationScheduler(max_in_flight=4, totals={'toyota': 5 * STRIDE})
+        self.assertEqual(sorted(crawl_brand(scheduler, 5)), [page * STRIDE for page in range(5)])
+        self.assertEqual(scheduler.get('toyota').in_flight, set())
+
+    def test_fan_out_is_bounded(self):
+        scheduler = PaginationScheduler(max_in_flight=4, totals={'toyota': 10 * STRIDE})
+        self.assertEqual(scheduler.page_done('toyota', 0, STRIDE, STRIDE), [20, 40, 60, 80])
+        self.assertEqual(scheduler.page_done('toyota', 20, 40, STRIDE), [100])
+
+    def test_grown_brand_is_chained_past_total(self):
+        scheduler = PaginationScheduler(max_in_flight=4, totals={'toyota': 3 * STRIDE})
+        self.assertEqual(sorted(crawl_brand(scheduler, 6)), [page * STRIDE for page in range(6)])
+
+    def test_save_totals_keeps_other_brands(self):
+        path = os.path.join(tempfile.mkdtemp(), 'pagination.json')
+        save_totals(path, {'toyota': 100, 'bmw': 40})
+        save_totals(path, {'toyota': 120})
+        with open(path) as f:
+            self.assertEqual(json.load(f), {'toyota': 120, 'bmw': 40})
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+import glob
+import os
+import tempfile
+
+from scrapy import Request, Spider
+from scrapy.utils.test import get_crawler
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from car_finder.items import CarItem
+from car_finder.pipelines import BufferedRedisPipeline, CachedImagesPipeline, ParquetExportPipeline
+
+
+class FlakyRedis:
+    """
+    In-memory list and set standing in for redis, the first `failures` pushes raise.
+    """
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.items = []
+        self.seen = set()
+
+    def register_script(self, script):
+        def add_fingerprints(keys, args):
+            new = [1 if not fingerprint or fingerprint not in self.seen else 0 for fingerprint in args]
+            self.seen.update(fingerprint for fingerprint in args if fingerprint)
+            return new
+        return add_fingerprints
+
+    def rpush(self, key, *values):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError('redis is down')
+        self.items.extend(values)
+
+
+class NamedSpider:
+    name = 'test'
+
+
+class BufferedRedisPipelineTest(unittest.TestCase):
+
+    def make_pipeline(self, server, export_format='json', dedupe_key=None):
+        self.stats = get_crawler(settings_dict={'TWISTED_REACTOR': None}).stats
+        pipeline = BufferedRedisPipeline(server, '%(spider)s:items', 2, 0, export_format, dedupe_key,
+                                         max_pending=4, stats=self.stats)
+        pipeline.open_spider(NamedSpider())
+        return pipeline
+
+    @defer.inlineCallbacks
+    def test_failed_batch_is_written_by_next_flush(self):
+        server = FlakyRedis(failures=1)
+        pipeline = self.make_pipeline(server)
+        for i in range(4):
+            yield pipeline.process_item({'n': i}, None)
+        yield pipeline.close_spider(None)
+        self.assertEqual(server.items, ['{"n": 0}', '{"n": 1}', '{"n": 2}', '{"n": 3}'])
+        self.assertIsNone(self.stats.get_value('redis_export/dropped'))
+
+    @defer.inlineCallbacks
+    def test_retry_keeps_deduplicated_rows(self):
+        server = FlakyRedis(failures=1)
+        pipeline = self.make_pipeline(server, 'json-rows', 'fingerprints')
+        for i in range(4):
+            yield pipeline.process_item({'url_fingerprint': str(i)}, None)
+        yield pipeline.close_spider(None)
+        self.assertEqual(server.items, ['{"fields": ["url_fingerprint"], "rows": [["0"], ["1"], ["2"]]}',
+                                        '{"fields": ["url_fingerprint"], "rows": [["3"]]}'])
+        self.assertFalse(pipeline.deduped)
+
+    @defer.inlineCallbacks
+    def test_drops_are_counted(self):
+        server = FlakyRedis(failures=100)
+        pipeline = self.make_pipeline(server)
+        for i in range(7):
+            yield pipeline.process_item({'n': i}, None)
+        self.assertEqual(len(pipeline.buffer), 4)
+        yield pipeline.close_spider(None)
+        self.assertEqual(self.stats.get_value('redis_export/dropped'), 7)
+        self.assertFalse(pipeline.buffer)
+
+
+    @defer.inlineCallbacks
+    def test_dedupe_scripts(self):
+        import fakeredis
+        server = fakeredis.FakeRedis()
+        pipeline = self.make_pipeline(server, 'json', 'test:fingerprints')
+        for fingerprint in ('a', 'b', 'a', 'c'):
+            yield pipeline.process_item({'url_fingerprint': fingerprint}, None)
+        yield pipeline.close_spider(None)
+        self.assertEqual(server.lrange('test:items', 0, -1), [b'{"url_fingerprint": "a"}', b'{"url_fingerprint": "b"}',
+                                                              b'{"url_fingerprint": "c"}'])
+
+
+class ParquetExportPipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.stats = get_crawler(settings_dict={'TWISTED_REACTOR': None}).stats
+        self.pipeline = ParquetExportPipeline(self.path, 2, 4, 'zstd', self.stats)
+        self.pipeline.open_spider(NamedSpider())
+        self.failures = 0
+        write = self.pipeline.write
+
+        def flaky_write(partition, columns):
+            if self.failures:
+                self.failures -= 1
+                raise OSError('No space left on device')
+            write(partition, columns)
+        self.pipeline.write = flaky_write
+
+    @defer.inlineCallbacks
+    def export(self, count):
+        for i in range(count):
+            yield self.pipeline.process_item(CarItem(url=f'https://www.drive2.com/cars/{i}/', brand='Toyota'), None)
+        yield self.pipeline.close_spider(None)
+
+    def exported_urls(self):
+        import pyarrow.parquet as pq
+        files = glob.glob(os.path.join(self.path, '*', 'brand=Toyota', '*.parquet'))
+        return sorted(url for name in files for url in pq.read_table(name).column('url').to_pylist())
+
+    @defer.inlineCallbacks
+    def test_failed_row_group_is_written_with_next_one(self):
+        self.failures = 1
+        yield self.export(5)
+        self.assertEqual(len(self.exported_urls()), 5)
+        self.assertIsNone(self.stats.get_value('parquet_export/dropped'))
+
+    @defer.inlineCallbacks
+    def test_drops_are_counted(self):
+        self.failures = 100
+        yield self.export(5)
+        self.assertEqual(self.exported_urls(), [])
+        self.assertEqual(self.stats.get_value('parquet_export/dropped'), 5)
+
+
+class ImagesSpider(Spider):
+    name = 'test'
+
+
+class CachedImagesPipelineTest(unittest.TestCase):
+    URL = 'https://a.d-cd.net/1.jpg'
+
+    def make_pipeline(self, mode):
+        self.store = tempfile.mkdtemp()
+        crawler = get_crawler(ImagesSpider, {
+            'TWISTED_REACTOR': None,
+            'IMAGES_STORE': self.store,
+            'IMAGES_CACHE_INDEX': os.path.join(self.store, 'images-index'),
+            'IMAGES_CACHE_MODE': mode,
+        })
+        pipeline = CachedImagesPipeline.from_crawler(crawler)
+        self.addCleanup(pipeline.index.close)
+        self.info = pipeline.SpiderInfo(ImagesSpider())
+        os.makedirs(os.path.join(self.store, 'full'))
+        with open(os.path.join(self.store, 'full', 'abc.jpg'), 'wb') as f:
+            f.write(b'jpeg')
+        pipeline.index.remember(self.URL, {'checksum': 'abc', 'path': 'full/abc.jpg', 'etag': '"abc"',
+                                           'last_modified': None, 'size': 4, 'latency': 0.1})
+        return pipeline
+
+    def test_skips_stored_images(self):
+        pipeline = self.make_pipeline('skip')
+        result = self.successResultOf(pipeline.media_to_download(Request(self.URL), self.info))
+        self.assertEqual(result['path'], 'full/abc.jpg')
+        self.assertEqual(result['status'], 'uptodate')
+
+    def test_downloads_missing_images(self):
+        pipeline = self.make_pipeline('skip')
+        os.remove(os.path.join(self.store, 'full', 'abc.jpg'))
+        self.assertIsNone(self.successResultOf(pipeline.media_to_download(Request(self.URL), self.info)))
+        self.assertEqual(pipeline.cache_stats.get_value('images_cache/missing'), 1)
+
+    def test_conditional_request_only_for_stored_images(self):
+        pipeline = self.make_pipeline('conditional')
+        request = Request(self.URL)
+        self.assertIsNone(self.successResultOf(pipeline.media_to_download(request, self.info)))
+        self.assertEqual(request.headers['If-None-Match'], b'"abc"')
+        os.remove(os.path.join(self.store, 'full', 'abc.jpg'))
+        request = Request(self.URL)
+        self.assertIsNone(self.successResultOf(pipeline.media_to_download(request, self.info)))
+        self.assertNotIn('If-None-Match', request.headers)
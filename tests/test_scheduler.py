@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from scrapy import Request, Spider
+from scrapy.utils.test import get_crawler
+from twisted.trial import unittest
+
+from car_finder.scheduler import SpillingScheduler
+
+
+class SpillSpider(Spider):
+    name = 'test'
+
+
+class SpillingSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        crawler = get_crawler(SpillSpider, {
+            'TWISTED_REACTOR': None,
+            'SPILL_THRESHOLD': 4,
+            'SCHEDULER_PRIORITY_QUEUE': 'scrapy.pqueues.ScrapyPriorityQueue',
+            'SCHEDULER_DISK_QUEUE': 'scrapy.squeues.MarshalLifoDiskQueue',
+        })
+        crawler.spider = SpillSpider()
+        self.scheduler = SpillingScheduler.from_crawler(crawler)
+        self.scheduler.open(crawler.spider)
+        self.addCleanup(self.scheduler.close, 'finished')
+
+    def enqueue(self, *priorities):
+        for priority in priorities:
+            self.scheduler.enqueue_request(Request(f'https://www.drive2.com/cars/{priority}/', priority=priority,
+                                                   dont_filter=True))
+
+    def dequeue_all(self):
+        priorities = []
+        while True:
+            request = self.scheduler.next_request()
+            if request is None:
+                return priorities
+            priorities.append(request.priority)
+
+    def test_spills_past_threshold(self):
+        self.enqueue(*range(10))
+        self.assertEqual(len(self.scheduler.mqs), 4)
+        self.assertEqual(len(self.scheduler.dqs), 6)
+        self.assertEqual(sorted(self.dequeue_all()), list(range(10)))
+
+    def test_spilled_high_priority_goes_first(self):
+        self.enqueue(0, 0, 0, 0, 10, 5)
+        self.assertEqual(len(self.scheduler.dqs), 2)
+        self.assertEqual(self.dequeue_all(), [10, 5, 0, 0, 0, 0])